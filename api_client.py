@@ -1,35 +1,137 @@
+import asyncio
 import json
 import logging
+import time
 from abc import ABC
+from contextlib import nullcontext
 from dataclasses import dataclass
 from http import HTTPStatus
-from typing import Tuple, Union
-from urllib.error import HTTPError
-from urllib.parse import urlencode
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode, urlsplit
 from urllib.request import Request, urlopen
 
+import httpx
+from pymongo.errors import PyMongoError
+
+import decoding
+import metrics
+from cache import TTLCache, quantize_coordinates
 from city_repository import CityRepository
 from settings import (
     ERR_MESSAGE_TEMPLATE,
+    FORECAST_CACHE_GRID,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP_MAX_CONNECTIONS_PER_HOST,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_TIMEOUT,
+    RETRY_ATTEMPTS,
+    RETRY_BACKOFF,
+    RETRY_BACKOFF_MAX,
+    YANDEX_GEO_API_BURST,
+    YANDEX_GEO_API_CONCURRENCY,
     YANDEX_GEO_API_KEY,
     YANDEX_GEO_API_LANGUAGE,
+    YANDEX_GEO_API_RATE,
     YANDEX_GEO_API_URL,
+    YANDEX_WEATHER_API_BURST,
+    YANDEX_WEATHER_API_CONCURRENCY,
     YANDEX_WEATHER_API_KEY,
     YANDEX_WEATHER_API_LANGUAGE,
+    YANDEX_WEATHER_API_RATE,
     YANDEX_WEATHER_API_URL,
 )
+from throttling import RetryPolicy, Throttle
+
+if TYPE_CHECKING:
+    from forecast_repository import ForecastRepository
 
 logger = logging.getLogger()
 
 ERROR_HTTP = "Error during execute request. {status}: {reason}"
 ERROR_NO_CITY = "Please check that city {city} exists"
 ERROR_RESPONSE = "Invalid response format: {error}"
+WARNING_RETRY = "Request failed: {error}. Retry {attempt} in {delay:.2f} s"
+WARNING_STORE = "Forecast store is unavailable: {error}"
+
+DEFAULT_RETRY_POLICY = RetryPolicy(
+    attempts=RETRY_ATTEMPTS,
+    backoff=RETRY_BACKOFF,
+    backoff_max=RETRY_BACKOFF_MAX,
+)
+# Limits are shared by all clients of an API
+WEATHER_API_THROTTLE = Throttle(
+    rate=YANDEX_WEATHER_API_RATE,
+    burst=YANDEX_WEATHER_API_BURST,
+    concurrency=YANDEX_WEATHER_API_CONCURRENCY,
+)
+GEO_API_THROTTLE = Throttle(
+    rate=YANDEX_GEO_API_RATE,
+    burst=YANDEX_GEO_API_BURST,
+    concurrency=YANDEX_GEO_API_CONCURRENCY,
+)
 
 
 class YandexAPIError(RuntimeError):
     pass
 
 
+class RetryableError(YandexAPIError):
+    """Failure which may pass on a next attempt."""
+
+    def __init__(self, error: Exception, retry_after: Optional[str] = None):
+        super().__init__(error)
+        self.retry_after = retry_after
+
+
+class ValidatedResponse(NamedTuple):
+    """Decoded response kept with its validators for revalidation."""
+
+    etag: Optional[str]
+    last_modified: Optional[str]
+    result: Any
+
+
+_async_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def get_async_client(url: str) -> httpx.AsyncClient:
+    """
+    Shared HTTP/1.1 keep-alive client for the host of `url`.
+    One pool per host, so connection limits are applied per upstream host.
+    """
+    host = urlsplit(url).netloc
+    client = _async_clients.get(host)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS_PER_HOST,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        )
+        _async_clients[host] = client
+    return client
+
+
+async def close_async_clients() -> None:
+    """Close all pooled connections."""
+    while _async_clients:
+        _, client = _async_clients.popitem()
+        await client.aclose()
+
+
 @dataclass
 class YandexAPI(ABC):
     """Base class for requests."""
@@ -39,24 +141,197 @@ class YandexAPI(ABC):
     exception_class: RuntimeError = YandexAPIError
     language: str = "ru_RU"
 
+    throttle: Optional[Throttle] = None
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY
+    # Content codings offered to the API
+    accept_encoding: str = decoding.ACCEPT_ENCODING
+    # Responses with an ETag or Last-Modified by URL: they are asked
+    # for conditionally, and 304 Not Modified reuses the kept result
+    validated: Optional[TTLCache] = None
+
+    # Value of the "api" label of upstream metrics
+    metrics_label = "yandex"
+
+    @property
+    def concurrency(self) -> Optional[int]:
+        return None if self.throttle is None else self.throttle.concurrency
+
+    def _get_headers(self) -> Dict[str, str]:
+        return {"X-Yandex-API-Key": self.api_key} if self.api_key else {}
+
+    def _get_request_headers(
+        self, url: str
+    ) -> Tuple[Dict[str, str], Optional[ValidatedResponse]]:
+        headers = self._get_headers()
+        headers["Accept-Encoding"] = self.accept_encoding
+        cached = None if self.validated is None else self.validated.get(url)
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+        return headers, cached
+
+    def _validate(self, url: str, headers: Mapping[str, str], result: Any):
+        """Keep a result with validators of its response."""
+        if self.validated is not None:
+            etag = headers.get("ETag")
+            last_modified = headers.get("Last-Modified")
+            if etag or last_modified:
+                self.validated.set(
+                    url, ValidatedResponse(etag, last_modified, result)
+                )
+        return result
+
+    def _reuse(
+        self, url: str, headers: Mapping[str, str], cached: ValidatedResponse
+    ):
+        """Result of a response confirmed by 304 Not Modified."""
+        return self._validate(
+            url,
+            {
+                "ETag": headers.get("ETag") or cached.etag,
+                "Last-Modified": (
+                    headers.get("Last-Modified") or cached.last_modified
+                ),
+            },
+            cached.result,
+        )
+
+    def _get_slot(self):
+        return self.throttle.slot() if self.throttle else nullcontext()
+
+    def _get_slot_async(self):
+        return self.throttle.slot_async() if self.throttle else nullcontext()
+
+    def _get_retry_delay(self, error: RetryableError, attempt: int) -> float:
+        """Delay before next attempt; error is raised if none is left."""
+        if attempt + 1 >= self.retry_policy.attempts:
+            raise error
+        delay = self.retry_policy.get_delay(attempt, error.retry_after)
+        metrics.UPSTREAM_RETRIES.inc(self.metrics_label)
+        logger.warning(
+            WARNING_RETRY.format(error=error, attempt=attempt + 1, delay=delay)
+        )
+        return delay
+
+    def _decode(self, content: bytes):
+        return decoding.loads(content)
+
+    def _observe_request(self, status: Union[int, str], started: float):
+        metrics.UPSTREAM_REQUESTS.inc(self.metrics_label, status)
+        metrics.UPSTREAM_DURATION.observe(
+            time.perf_counter() - started, self.metrics_label
+        )
+
+    def _do_single_req(self, url: str):
+        headers, cached = self._get_request_headers(url)
+        status, started = "error", time.perf_counter()
+        try:
+            with urlopen(
+                Request(url, headers=headers), timeout=HTTP_TIMEOUT
+            ) as request:
+                status = request.status
+                content, received = decoding.read_body(
+                    request, request.headers.get("Content-Encoding")
+                )
+        except HTTPError as error:
+            status = error.code
+            if error.code == HTTPStatus.NOT_MODIFIED and cached is not None:
+                return self._reuse(url, error.headers, cached)
+            if RetryPolicy.is_retryable(error.code):
+                raise RetryableError(error, error.headers.get("Retry-After"))
+            raise
+        except (URLError, TimeoutError, ConnectionError) as error:
+            raise RetryableError(error)
+        finally:
+            self._observe_request(status, started)
+        metrics.UPSTREAM_RECEIVED_BYTES.inc(
+            self.metrics_label, amount=received
+        )
+        if HTTPStatus.OK != request.status:
+            raise self.exception_class(
+                ERROR_HTTP.format(status=request.status, reason=request.reason)
+            )
+        return self._validate(url, request.headers, self._decode(content))
+
     def _do_req(self, url: str):
         """Base request method."""
-        headers = {"X-Yandex-API-Key": self.api_key} if self.api_key else {}
         try:
-            with urlopen(Request(url, headers=headers)) as request:
-                response = request.read().decode("utf-8")
-                result = json.loads(response)
-            if HTTPStatus.OK != request.status:
-                raise self.exception_class(
-                    ERROR_HTTP.format(response.status, response.reason)
+            for attempt in range(self.retry_policy.attempts):
+                try:
+                    with self._get_slot():
+                        return self._do_single_req(url)
+                except RetryableError as error:
+                    time.sleep(self._get_retry_delay(error, attempt))
+        except (
+            KeyError,
+            TypeError,
+            json.decoder.JSONDecodeError,
+            decoding.ContentEncodingError,
+        ) as error:
+            logger.error(ERROR_RESPONSE.format(error=error))
+            raise RuntimeError(error)
+        except (HTTPError, YandexAPIError) as error:
+            logger.exception(ERR_MESSAGE_TEMPLATE)
+            raise RuntimeError(error)
+
+
+class AsyncYandexAPIMixin:
+    """Non-blocking requests over the shared keep-alive client."""
+
+    async def _do_single_req(self, url: str):
+        headers, cached = self._get_request_headers(url)
+        started = time.perf_counter()
+        try:
+            # The client decompresses the body as it is received
+            response = await get_async_client(url).get(url, headers=headers)
+        except httpx.TransportError as error:
+            self._observe_request("error", started)
+            raise RetryableError(error)
+        self._observe_request(response.status_code, started)
+        metrics.UPSTREAM_RECEIVED_BYTES.inc(
+            self.metrics_label, amount=response.num_bytes_downloaded
+        )
+        if (
+            response.status_code == HTTPStatus.NOT_MODIFIED
+            and cached is not None
+        ):
+            return self._reuse(url, response.headers, cached)
+        if RetryPolicy.is_retryable(response.status_code):
+            raise RetryableError(
+                ERROR_HTTP.format(
+                    status=response.status_code,
+                    reason=response.reason_phrase,
+                ),
+                response.headers.get("Retry-After"),
+            )
+        if HTTPStatus.OK != response.status_code:
+            raise self.exception_class(
+                ERROR_HTTP.format(
+                    status=response.status_code,
+                    reason=response.reason_phrase,
                 )
-            return result
-        except (TypeError, json.decoder.JSONDecodeError) as error:
-            logger.error(ERROR_RESPONSE.format(error))
+            )
+        return self._validate(
+            url, response.headers, self._decode(response.content)
+        )
+
+    async def _do_req(self, url: str):
+        """Base request method."""
+        try:
+            for attempt in range(self.retry_policy.attempts):
+                try:
+                    async with self._get_slot_async():
+                        return await self._do_single_req(url)
+                except RetryableError as error:
+                    await asyncio.sleep(self._get_retry_delay(error, attempt))
+        except (KeyError, TypeError, json.decoder.JSONDecodeError) as error:
+            logger.error(ERROR_RESPONSE.format(error=error))
             raise RuntimeError(error)
-        except (HTTPError, self.exception_class):
+        except (httpx.HTTPError, YandexAPIError) as error:
             logger.exception(ERR_MESSAGE_TEMPLATE)
-            raise RuntimeError
+            raise RuntimeError(error)
 
 
 class YandexWeatherAPIError(YandexAPIError):
@@ -71,13 +346,35 @@ class YandexWeatherAPI(YandexAPI):
     api_key: str = YANDEX_WEATHER_API_KEY
     exception_class: YandexAPIError = YandexWeatherAPIError
     language: str = YANDEX_WEATHER_API_LANGUAGE
-    city_service: CityRepository
+    throttle: Optional[Throttle] = WEATHER_API_THROTTLE
+    city_service: Optional[CityRepository] = None
+    cache: Optional[TTLCache] = None
+    cache_grid: float = FORECAST_CACHE_GRID
+    # Responses fetched by other bot replicas
+    store: Optional["ForecastRepository"] = None
 
-    def _get_url_by_city_name(self, city_name: str) -> str:
+    metrics_label = "weather"
+
+    def _decode(self, content: bytes):
+        """Only the fields used by calculation are kept."""
+        return decoding.decode_forecast(content)
+
+    def _get_coords_by_city_name(self, city_name: str) -> Tuple[float, float]:
         if (city := self.city_service.first(name=city_name)) is None:
             raise self.exception_class(ERROR_NO_CITY.format(city=city_name))
-        latitude, longitude = city
-        return self._get_url_by_coords(latitude, longitude)
+        return city.latitude, city.longitude
+
+    def _get_coords(
+        self, location: Union[str, Tuple[float, float]]
+    ) -> Tuple[float, float]:
+        if isinstance(location, tuple):
+            return location
+        elif isinstance(location, str):
+            return self._get_coords_by_city_name(location)
+        raise self.exception_class(
+            "City parameter should be a string"
+            " or a tuple of two float coordinates"
+        )
 
     def _get_url_by_coords(self, latitude: float, longitude: float) -> str:
         query = urlencode(
@@ -90,21 +387,69 @@ class YandexWeatherAPI(YandexAPI):
         )
         return f"{self.api_url}?{query}"
 
+    def _get_cache_key(
+        self, latitude: float, longitude: float
+    ) -> Tuple[float, float]:
+        return quantize_coordinates(latitude, longitude, self.cache_grid)
+
+    def _get_cached(self, key: Tuple[float, float]):
+        return None if self.cache is None else self.cache.get(key)
+
+    def _set_cached(self, key: Tuple[float, float], response) -> None:
+        if self.cache is not None:
+            self.cache.set(key, response)
+
+    def _get_stored(self, key: Tuple[float, float]):
+        try:
+            return self.store.find_response(key)
+        except PyMongoError as error:
+            logger.warning(WARNING_STORE.format(error=error))
+            return None
+
+    def _set_stored(self, key: Tuple[float, float], response) -> None:
+        try:
+            self.store.save_response(key, response)
+        except PyMongoError as error:
+            logger.warning(WARNING_STORE.format(error=error))
+
     def get_forecasting(self, location: Union[str, Tuple[float, float]]):
         """
         :param location: string or a tuple of two float coordinates
         :return: response data as json
         """
-        if isinstance(location, tuple):
-            latitude, longitude = location
-            location_url = self._get_url_by_coords(latitude, longitude)
-        elif isinstance(location, str):
-            location_url = self._get_url_by_city_name(location)
-        else:
-            raise self.exception_class(
-                "City parameter should be a string or a tuple of two float coordinates"
+        latitude, longitude = self._get_coords(location)
+        key = self._get_cache_key(latitude, longitude)
+        if (response := self._get_cached(key)) is not None:
+            return response
+        if self.store is None or (response := self._get_stored(key)) is None:
+            response = self._do_req(
+                self._get_url_by_coords(latitude, longitude)
             )
-        return self._do_req(location_url)
+            if self.store is not None:
+                self._set_stored(key, response)
+        self._set_cached(key, response)
+        return response
+
+
+@dataclass
+class AsyncYandexWeatherAPI(AsyncYandexAPIMixin, YandexWeatherAPI):
+    """Non-blocking requests to YandexWeatherAPI."""
+
+    async def get_forecasting(self, location: Union[str, Tuple[float, float]]):
+        latitude, longitude = self._get_coords(location)
+        key = self._get_cache_key(latitude, longitude)
+        if (response := self._get_cached(key)) is not None:
+            return response
+        if self.store is None or (
+            response := await asyncio.to_thread(self._get_stored, key)
+        ) is None:
+            response = await self._do_req(
+                self._get_url_by_coords(latitude, longitude)
+            )
+            if self.store is not None:
+                await asyncio.to_thread(self._set_stored, key, response)
+        self._set_cached(key, response)
+        return response
 
 
 class YandexGeoAPIError(YandexAPIError):
@@ -119,6 +464,9 @@ class YandexGeoAPI(YandexAPI):
     api_key: str = YANDEX_GEO_API_KEY
     exception_class: YandexAPIError = YandexGeoAPIError
     language: str = YANDEX_GEO_API_LANGUAGE
+    throttle: Optional[Throttle] = GEO_API_THROTTLE
+
+    metrics_label = "geo"
 
     def get_geolocation(self, address: str):
         """
@@ -133,3 +481,11 @@ class YandexGeoAPI(YandexAPI):
             }
         )
         return self._do_req(f"{self.api_url}?{query}")
+
+
+@dataclass
+class AsyncYandexGeoAPI(AsyncYandexAPIMixin, YandexGeoAPI):
+    """Non-blocking requests to YandexGeoAPI."""
+
+    async def get_geolocation(self, address: str):
+        return await super().get_geolocation(address)
@@ -0,0 +1,91 @@
+"""
+Compare DataCalculationTask modes on synthetic forecasts.
+
+    python -m benchmarks.calculation [--sizes 15 1000 50000]
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import random
+import time
+
+from executors import ExecutorService
+from models import HourlyBlock
+from tasks import DataCalculationTask
+
+RESPONSE_FILE = os.path.join(
+    os.path.dirname(__file__), "..", "examples", "response.json"
+)
+TEMPLATES_COUNT = 100
+
+
+def make_templates(count: int, seed: int = 0) -> list:
+    """City responses with shifted temperatures and shuffled conditions."""
+    with open(RESPONSE_FILE, encoding="utf-8") as file:
+        response = json.load(file)
+    conditions = [
+        hour["condition"]
+        for forecast in response["forecasts"]
+        for hour in forecast["hours"]
+    ] + ["clear", "partly-cloudy"]
+    rnd = random.Random(seed)
+    templates = []
+    for _ in range(count):
+        template = copy.deepcopy(response)
+        shift = rnd.randint(-5, 15)
+        for forecast in template["forecasts"]:
+            for hour in forecast["hours"]:
+                hour["temp"] += shift
+                hour["condition"] = rnd.choice(conditions)
+        templates.append(template)
+    return templates
+
+
+def make_forecasts(size: int, templates: list) -> list:
+    return [
+        HourlyBlock.from_response(
+            (float(index), float(index)), templates[index % len(templates)]
+        )
+        for index in range(size)
+    ]
+
+
+def measure(mode: str, forecasts: list, executor: ExecutorService) -> tuple:
+    started = time.perf_counter()
+    result = DataCalculationTask(forecasts, mode, executor).worker()
+    return time.perf_counter() - started, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[15, 1_000, 50_000]
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    templates = make_templates(TEMPLATES_COUNT)
+    # Processes are started once, as in the bot
+    executor = ExecutorService()
+    executor.warm()
+    print(
+        f"{'cities':>8} {'pool, s':>10} {'vectorized, s':>14} {'speedup':>8}"
+    )
+    for size in args.sizes:
+        forecasts = make_forecasts(size, templates)
+        pool_time, pool_result = measure("pool", forecasts, executor)
+        vector_time, vector_result = measure(
+            "vectorized", forecasts, executor
+        )
+        assert pool_result == vector_result, "Results differ"
+        print(
+            f"{size:>8} {pool_time:>10.3f} {vector_time:>14.3f}"
+            f" {pool_time / vector_time:>7.1f}x"
+        )
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Memory and pickling cost of forecast structures against plain dicts.
+"fields" is CityForecast pickled as a dataclass is by default.
+
+    python -m benchmarks.models [--cities 1000]
+"""
+import argparse
+import json
+import pickle
+import time
+import tracemalloc
+from dataclasses import fields
+
+from benchmarks.calculation import TEMPLATES_COUNT, make_templates
+from decoding import decode_forecast
+from models import CityForecast, HourlyBlock
+from tasks import DataCalculationTask
+
+
+def measure_memory(build) -> tuple:
+    tracemalloc.start()
+    objects = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return objects, size
+
+
+class FieldsCityForecast(CityForecast):
+    """CityForecast pickled field by field, as dataclasses are by default."""
+
+    __slots__ = ()
+    __reduce__ = object.__reduce__
+
+
+def measure_pickling(objects: list, repeat: int = 5) -> tuple:
+    """Pickle size and the best time of a round trip."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        content = pickle.dumps(objects, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.loads(content)
+        best = min(best, time.perf_counter() - started)
+    return len(content), best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cities", type=int, default=1_000)
+    args = parser.parse_args()
+
+    templates = [
+        json.dumps(template).encode()
+        for template in make_templates(TEMPLATES_COUNT)
+    ]
+    locations = [(float(index), float(index)) for index in range(args.cities)]
+
+    # Every city gets its own objects, as fetched responses do
+    def build_responses() -> list:
+        return [
+            dict(
+                location=location,
+                **decode_forecast(templates[index % len(templates)]),
+            )
+            for index, location in enumerate(locations)
+        ]
+
+    def build_blocks() -> list:
+        return [
+            HourlyBlock.from_response(
+                location, decode_forecast(templates[index % len(templates)])
+            )
+            for index, location in enumerate(locations)
+        ]
+
+    def build_cities() -> list:
+        return DataCalculationTask(build_blocks(), mode="pool").worker()
+
+    candidates = (
+        ("hourly", "dict", build_responses),
+        ("hourly", "HourlyBlock", build_blocks),
+        ("city", "dict", lambda: [city.to_dict() for city in build_cities()]),
+        (
+            "city",
+            "fields",
+            lambda: [
+                FieldsCityForecast(
+                    *(getattr(city, field.name) for field in fields(city))
+                )
+                for city in build_cities()
+            ],
+        ),
+        ("city", "CityForecast", build_cities),
+    )
+    print(
+        f"{'data':>8} {'structure':>14} {'memory/city, B':>15}"
+        f" {'pickle/city, B':>15} {'pickling, ms':>13}"
+    )
+    for data, structure, build in candidates:
+        objects, memory = measure_memory(build)
+        pickled, elapsed = measure_pickling(objects)
+        print(
+            f"{data:>8} {structure:>14} {memory / args.cities:>15.0f}"
+            f" {pickled / args.cities:>15.0f} {elapsed * 1000:>13.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
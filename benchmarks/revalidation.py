@@ -0,0 +1,110 @@
+"""
+Traffic of a full-catalog forecast refresh with and without compression
+and conditional requests.
+
+    python -m benchmarks.revalidation [--cities 1000] [--latency 0.01]
+
+Every mode downloads forecasts for all cities, then refreshes them once
+more, as the report does when the forecast cache has expired. Bytes are
+counted by the local stand-in server.
+"""
+import argparse
+import asyncio
+import random
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from benchmarks.stub_server import StubConfig, StubServer
+
+Position = Tuple[float, float]
+MODES = {
+    "plain": {"accept_encoding": "identity", "revalidate": False},
+    "gzip": {"accept_encoding": None, "revalidate": False},
+    "gzip+revalidation": {"accept_encoding": None, "revalidate": True},
+}
+
+
+async def fetch_all(api, positions: List[Position], concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(position: Position) -> None:
+        async with semaphore:
+            await api._do_req(api._get_url_by_coords(*position))
+
+    await asyncio.gather(*map(fetch, positions))
+
+
+def measure(
+    server: StubServer,
+    positions: List[Position],
+    concurrency: int,
+    accept_encoding: Optional[str],
+    revalidate: bool,
+) -> Dict[str, Any]:
+    import api_client
+    from cache import TTLCache
+
+    options = {"accept_encoding": accept_encoding} if accept_encoding else {}
+    api = api_client.AsyncYandexWeatherAPI(
+        api_url=server.weather_url,
+        api_key="benchmark",
+        throttle=None,
+        validated=TTLCache(len(positions), 3600) if revalidate else None,
+        **options,
+    )
+
+    async def run() -> List[Dict[str, Any]]:
+        rounds = []
+        try:
+            for _ in range(2):
+                before = server.stats()
+                started = time.perf_counter()
+                await fetch_all(api, positions, concurrency)
+                elapsed = time.perf_counter() - started
+                after = server.stats()
+                rounds.append(
+                    {
+                        "seconds": elapsed,
+                        "bytes": after["bytes"] - before["bytes"],
+                        "not_modified": (
+                            after["not_modified"] - before["not_modified"]
+                        ),
+                    }
+                )
+        finally:
+            await api_client.close_async_clients()
+        return rounds
+
+    first, refresh = asyncio.run(run())
+    return {"first": first, "refresh": refresh}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cities", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    positions = [
+        (round(rnd.uniform(-60, 70), 4), round(rnd.uniform(-180, 180), 4))
+        for _ in range(args.cities)
+    ]
+    print(
+        f"{'mode':>18} {'round':>8} {'seconds':>8} {'KiB':>9} {'304':>6}"
+    )
+    with StubServer(StubConfig(latency=args.latency)) as server:
+        for mode, options in MODES.items():
+            result = measure(server, positions, args.concurrency, **options)
+            for name, values in result.items():
+                print(
+                    f"{mode:>18} {name:>8} {values['seconds']:>8.2f}"
+                    f" {values['bytes'] / 1024:>9.0f}"
+                    f" {values['not_modified']:>6}"
+                )
+
+
+if __name__ == "__main__":
+    main()
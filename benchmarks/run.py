@@ -0,0 +1,275 @@
+"""
+Offline benchmark of forecasting against the local stand-in server.
+
+    python -m benchmarks.run [--sizes 15 100 1000] [--latency 0.05]
+        [--output benchmark.json]
+
+Needs a running MongoDB; cities are seeded into a separate database
+(MONGODB_DBNAME, "weather_benchmark" by default) and replaced on every
+run. Results are written as JSON, so runs can be compared.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Sequence
+
+from benchmarks.stub_server import StubConfig, StubServer
+
+PERCENTILES = (50, 95, 99)
+
+
+def get_peak_rss() -> Dict[str, int]:
+    """Peak resident set size in KiB, of the benchmark and its children."""
+    return {
+        "self_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children_kib": resource.getrusage(
+            resource.RUSAGE_CHILDREN
+        ).ru_maxrss,
+    }
+
+
+def summarize(latencies: List[float], wall_time: float) -> Dict[str, Any]:
+    latencies = sorted(latencies)
+    cuts = (
+        statistics.quantiles(latencies, n=100, method="inclusive")
+        if len(latencies) > 1
+        else []
+    )
+    return {
+        "calls": len(latencies),
+        "wall_time": wall_time,
+        "throughput": len(latencies) / wall_time if wall_time else None,
+        "mean": statistics.fmean(latencies) if latencies else None,
+        **{
+            f"p{percentile}": (
+                cuts[percentile - 1] if cuts else next(iter(latencies), None)
+            )
+            for percentile in PERCENTILES
+        },
+        "max": latencies[-1] if latencies else None,
+    }
+
+
+def make_cities(size: int, located_share: float, rnd: random.Random):
+    # Imported after the environment is configured, as settings are
+    from city_repository import City
+
+    cities = []
+    for number in range(size):
+        city = City(f"Benchmark city {number}")
+        if rnd.random() < located_share:
+            city.latitude = round(rnd.uniform(-60, 70), 4)
+            city.longitude = round(rnd.uniform(-180, 180), 4)
+        cities.append(city)
+    return cities
+
+
+def reset_state(forecasting, cities: list) -> None:
+    """Fresh catalog and cold caches, so every scenario fetches upstream."""
+    services = forecasting.services
+    city_service = services.city_service
+    city_service.db[city_service.collection_name].delete_many({})
+    city_service.create_multi(cities)
+    services.forecast_cache.clear()
+    services.geocoder_cache.clear()
+    services.reset("spatial_index")
+
+
+def run_stages(forecasting, tasks) -> Dict[str, float]:
+    """process_tasks, timing every task."""
+    stages = {}
+    data = None
+    for task, params in tasks:
+        started = time.perf_counter()
+        data = task(**forecasting._prepare_params(params, data)).worker()
+        stages[task.__name__] = time.perf_counter() - started
+    return stages
+
+
+def measure_forecast(forecasting, size: int) -> Dict[str, Any]:
+    started = time.perf_counter()
+    stages = run_stages(
+        forecasting,
+        forecasting._forecast_weather_tasks(
+            forecasting.services.geo_api, forecasting.services.weather_api
+        ),
+    )
+    wall_time = time.perf_counter() - started
+    return {
+        "stages": stages,
+        "wall_time": wall_time,
+        "throughput": size / wall_time,
+    }
+
+
+def measure_forecast_async(forecasting, size: int) -> Dict[str, Any]:
+    async def run() -> None:
+        try:
+            await forecasting.forecast_weather_async()
+        finally:
+            await forecasting.shutdown()
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    wall_time = time.perf_counter() - started
+    return {"wall_time": wall_time, "throughput": size / wall_time}
+
+
+def measure_calls(
+    func: Callable, calls: Sequence[tuple], concurrency: int
+) -> Dict[str, Any]:
+    def timed(args: tuple) -> float:
+        started = time.perf_counter()
+        func(*args)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = list(executor.map(timed, calls))
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def measure_calls_async(
+    forecasting, func: Callable, calls: Sequence[tuple], concurrency: int
+) -> Dict[str, Any]:
+    async def run() -> List[float]:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def timed(args: tuple) -> float:
+            async with semaphore:
+                started = time.perf_counter()
+                await func(*args)
+                return time.perf_counter() - started
+
+        try:
+            return await asyncio.gather(*(timed(args) for args in calls))
+        finally:
+            # Pooled clients are bound to this event loop
+            await forecasting.shutdown()
+
+    started = time.perf_counter()
+    latencies = asyncio.run(run())
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def run_size(forecasting, args, size: int) -> Dict[str, Any]:
+    rnd = random.Random(args.seed)
+    cities = make_cities(size, args.located_share, rnd)
+    addresses = [(f"Benchmark place {number}",) for number in range(size)]
+    positions = [
+        (rnd.uniform(-60, 70), rnd.uniform(-180, 180)) for _ in range(size)
+    ]
+    result = {"cities": size, "scenarios": {}}
+    scenarios = {
+        "forecast_weather": lambda: measure_forecast(forecasting, size),
+        "forecast_weather_async": lambda: measure_forecast_async(
+            forecasting, size
+        ),
+        "get_weather": lambda: measure_calls(
+            forecasting.get_weather, addresses, args.concurrency
+        ),
+        "get_weather_async": lambda: measure_calls_async(
+            forecasting,
+            forecasting.get_weather_async,
+            addresses,
+            args.concurrency,
+        ),
+        "get_weather_by_position": lambda: measure_calls(
+            forecasting.get_weather_by_position, positions, args.concurrency
+        ),
+        "get_weather_by_position_async": lambda: measure_calls_async(
+            forecasting,
+            forecasting.get_weather_by_position_async,
+            positions,
+            args.concurrency,
+        ),
+    }
+    for name, measure in scenarios.items():
+        if args.scenarios and name not in args.scenarios:
+            continue
+        reset_state(forecasting, cities)
+        logging.warning(f"{size} cities: {name}")
+        result["scenarios"][name] = {**measure(), "peak_rss": get_peak_rss()}
+    return result
+
+
+def configure_environment(args, server: StubServer) -> None:
+    """Point settings at the stand-in server before they are imported."""
+    environment = {
+        "YANDEX_WEATHER_API_URL": server.weather_url,
+        "YANDEX_GEO_API_URL": server.geo_url,
+        "YANDEX_WEATHER_API_KEY": "benchmark",
+        "YANDEX_GEO_API_KEY": "benchmark",
+        "MONGODB_DBNAME": args.db_name,
+        "GEOCODER_CACHE_BACKEND": "file",
+        "GEOCODER_CACHE_FILE": os.path.join(
+            tempfile.mkdtemp(), "geocoder_cache.json"
+        ),
+    }
+    for api in ("WEATHER", "GEO"):
+        environment[f"YANDEX_{api}_API_RATE"] = str(args.rate)
+        environment[f"YANDEX_{api}_API_BURST"] = str(args.rate)
+        environment[f"YANDEX_{api}_API_CONCURRENCY"] = str(args.concurrency)
+    os.environ.update(environment)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[15, 100])
+    parser.add_argument(
+        "--scenarios", nargs="*", help="Scenarios to run, all by default"
+    )
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument(
+        "--rate", type=float, default=1000, help="Upstream requests per second"
+    )
+    parser.add_argument(
+        "--located-share",
+        type=float,
+        default=0.5,
+        help="Share of cities with known coordinates",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db-name", default="weather_benchmark")
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    config = StubConfig(args.latency, args.jitter, args.error_rate, args.seed)
+    with StubServer(config) as server:
+        configure_environment(args, server)
+        import forecasting
+
+        report = {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "arguments": vars(args),
+            "results": [
+                run_size(forecasting, args, size) for size in args.sizes
+            ],
+            "server": server.stats(),
+        }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results are written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
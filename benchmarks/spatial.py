@@ -0,0 +1,53 @@
+"""
+Lookup latency of CitySpatialIndex on a synthetic catalog.
+
+    python -m benchmarks.spatial [--cities 100000] [--queries 10000]
+"""
+import argparse
+import math
+import random
+import time
+
+from city_repository import City
+from spatial import CitySpatialIndex
+
+
+def random_position(rnd: random.Random) -> tuple:
+    """Uniformly distributed over the sphere."""
+    return (
+        math.degrees(math.asin(rnd.uniform(-1, 1))),
+        rnd.uniform(-180, 180),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cities", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=10_000)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    cities = [
+        City(str(number), "", *reversed(random_position(rnd)))
+        for number in range(args.cities)
+    ]
+    started = time.perf_counter()
+    index = CitySpatialIndex(cities)
+    print(f"build: {time.perf_counter() - started:.2f} s")
+
+    queries = [random_position(rnd) for _ in range(args.queries)]
+    for name, lookup in (
+        ("nearest", lambda lat, lon: index.nearest(lat, lon, 1)),
+        ("nearest-10", lambda lat, lon: index.nearest(lat, lon, 10)),
+        ("within 50 km", lambda lat, lon: index.within(lat, lon, 50)),
+        ("snap 10 km", lambda lat, lon: index.snap(lat, lon, 10)),
+    ):
+        started = time.perf_counter()
+        for latitude, longitude in queries:
+            lookup(latitude, longitude)
+        elapsed = (time.perf_counter() - started) / len(queries)
+        print(f"{name}: {elapsed * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Local stand-in for Yandex Weather and Geocoder APIs.
+
+    python -m benchmarks.stub_server --port 8000 --latency 0.05
+
+Weather responses are derived from examples/response.json,
+geocoder responses place every address at a stable pseudo-random point.
+Bodies are gzipped when the client accepts it, and weather responses
+carry ETag and Last-Modified and are answered 304 when unchanged.
+GET /_stats returns counters of served requests.
+"""
+import argparse
+import copy
+import functools
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import threading
+import time
+from dataclasses import asdict, dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+RESPONSE_FILE = os.path.join(
+    os.path.dirname(__file__), "..", "examples", "response.json"
+)
+WEATHER_PATH = "/v2/forecast"
+GEO_PATH = "/1.x"
+STATS_PATH = "/_stats"
+VARIANTS_COUNT = 16
+
+
+@dataclass
+class StubConfig:
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    seed: int = 0
+    compression: bool = True
+    validators: bool = True
+
+
+def make_weather_variants(count: int = VARIANTS_COUNT) -> list:
+    """Encoded weather responses with shifted temperatures."""
+    with open(RESPONSE_FILE, encoding="utf-8") as file:
+        response = json.load(file)
+    variants = []
+    for number in range(count):
+        variant = copy.deepcopy(response)
+        variant["geo_object"]["locality"]["name"] = f"Stub city {number}"
+        for forecast in variant["forecasts"]:
+            for hour in forecast["hours"]:
+                hour["temp"] += number
+        variants.append(json.dumps(variant).encode())
+    return variants
+
+
+def stable_hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+@functools.lru_cache(maxsize=1024)
+def compress(body: bytes) -> bytes:
+    return gzip.compress(body, mtime=0)
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.md5(body).hexdigest() + '"'
+
+
+def is_fresh(headers, etag: str, modified_at: float) -> bool:
+    """Whether validators of a conditional request match the body."""
+    if "If-None-Match" in headers:
+        tags = [tag.strip() for tag in headers["If-None-Match"].split(",")]
+        return etag in tags or "*" in tags
+    if "If-Modified-Since" in headers:
+        try:
+            since = parsedate_to_datetime(headers["If-Modified-Since"])
+        except (TypeError, ValueError):
+            return False
+        return int(modified_at) <= since.timestamp()
+    return False
+
+
+def make_geo_response(address: str) -> bytes:
+    number = stable_hash(address)
+    longitude = number % 36000 / 100 - 180
+    latitude = number // 36000 % 17000 / 100 - 85
+    return json.dumps(
+        {
+            "response": {
+                "GeoObjectCollection": {
+                    "metaDataProperty": {
+                        "GeocoderResponseMetaData": {
+                            "request": address,
+                            "found": "1",
+                        }
+                    },
+                    "featureMember": [
+                        {
+                            "GeoObject": {
+                                "Point": {"pos": f"{longitude} {latitude}"}
+                            }
+                        }
+                    ],
+                }
+            }
+        }
+    ).encode()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "StubHTTPServer"
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _send(self, status: int, body: bytes, headers=()) -> None:
+        accepted = self.headers.get("Accept-Encoding", "")
+        if (
+            body
+            and self.server.config.compression
+            and "gzip" in accepted.lower()
+        ):
+            body = compress(body)
+            headers = [*headers, ("Content-Encoding", "gzip")]
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(status, len(body))
+
+    def _send_validated(self, body: bytes) -> None:
+        """Body with validators, or 304 if the client has it already."""
+        if not self.server.config.validators:
+            self._send(200, body)
+            return
+        etag = make_etag(body)
+        headers = [
+            ("ETag", etag),
+            ("Last-Modified", formatdate(self.server.started_at, usegmt=True)),
+        ]
+        if is_fresh(self.headers, etag, self.server.started_at):
+            self._send(304, b"", headers)
+        else:
+            self._send(200, body, headers)
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        if url.path == STATS_PATH:
+            self._send(200, json.dumps(self.server.stats).encode())
+            return
+        config = self.server.config
+        delay = config.latency + random.uniform(-config.jitter, config.jitter)
+        time.sleep(max(0.0, delay))
+        if random.random() < config.error_rate:
+            self._send(503, b"{}")
+            return
+        query = parse_qs(url.query)
+        if url.path == WEATHER_PATH:
+            key = f"{query.get('lat')}:{query.get('lon')}"
+            variants = self.server.weather_variants
+            self._send_validated(variants[stable_hash(key) % len(variants)])
+        elif url.path == GEO_PATH:
+            self._send(200, make_geo_response(query.get("geocode", [""])[0]))
+        else:
+            self._send(404, b"{}")
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, config: StubConfig) -> None:
+        super().__init__(address, StubHandler)
+        self.config = config
+        self.weather_variants = make_weather_variants()
+        self.started_at = time.time()
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "not_modified": 0,
+            "bytes": 0,
+        }
+        self._lock = threading.Lock()
+        random.seed(config.seed)
+
+    def count(self, status: int, size: int) -> None:
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["errors"] += status >= 400
+            self.stats["not_modified"] += status == 304
+            self.stats["bytes"] += size
+
+
+def serve(config: StubConfig, port: int, ready: Optional[object] = None):
+    server = StubHTTPServer(("127.0.0.1", port), config)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StubServer:
+    """Stand-in server in a separate process, so it does not share the GIL."""
+
+    def __init__(self, config: StubConfig, port: int = 0) -> None:
+        self.config = config
+        self.port = port
+        self._process: Optional[multiprocessing.Process] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def weather_url(self) -> str:
+        return self.url + WEATHER_PATH
+
+    @property
+    def geo_url(self) -> str:
+        return self.url + GEO_PATH
+
+    def start(self) -> "StubServer":
+        ready = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=serve, args=(self.config, self.port, ready), daemon=True
+        )
+        self._process.start()
+        self.port = ready.get(timeout=10)
+        return self
+
+    def stats(self) -> dict:
+        from urllib.request import urlopen
+
+        with urlopen(self.url + STATS_PATH) as response:
+            return json.load(response)
+
+    def stop(self) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+
+    def __enter__(self) -> "StubServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8000)
+    for field, value in asdict(StubConfig()).items():
+        option = f"--{field.replace('_', '-')}"
+        if isinstance(value, bool):
+            parser.add_argument(
+                option, action=argparse.BooleanOptionalAction, default=value
+            )
+        else:
+            parser.add_argument(option, type=type(value), default=value)
+    args = vars(parser.parse_args())
+    port = args.pop("port")
+    print(f"Serving on http://127.0.0.1:{port}")
+    serve(StubConfig(**args), port)
+
+
+if __name__ == "__main__":
+    main()
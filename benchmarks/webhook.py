@@ -0,0 +1,172 @@
+"""
+Throughput of the webhook mode against the number of worker processes.
+
+    python -m benchmarks.webhook [--workers 1 2 4] [--updates 200]
+
+Bot API is replaced by a local server answering after `--latency`
+seconds, so every /start update costs one round trip of a reply.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+from telegram.ext import Application, CommandHandler
+
+import webhook
+from bot import start
+
+PATH = "/telegram"
+SECRET = "benchmark"
+
+
+class BotAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.endswith("/getMe"):
+            result = {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "Bot",
+                "username": "bot",
+            }
+        else:
+            time.sleep(self.server.latency)
+            with self.server.lock:
+                self.server.replies += 1
+            result = {
+                "message_id": 1,
+                "date": 0,
+                "chat": {"id": 1, "type": "private"},
+            }
+        content = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class BotAPIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float) -> None:
+        super().__init__(("127.0.0.1", 0), BotAPIHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.replies = 0
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_update(number: int) -> dict:
+    return {
+        "update_id": number,
+        "message": {
+            "message_id": number,
+            "date": 0,
+            "chat": {"id": number, "type": "private"},
+            "from": {"id": number, "is_bot": False, "first_name": "User"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+async def post_updates(port: int, count: int, connections: int) -> None:
+    queue: asyncio.Queue = asyncio.Queue()
+    for number in range(count):
+        queue.put_nowait(make_update(number))
+    limits = httpx.Limits(max_connections=connections)
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{port}", limits=limits
+    ) as client:
+
+        async def send() -> None:
+            while not queue.empty():
+                response = await client.post(
+                    PATH,
+                    json=queue.get_nowait(),
+                    headers={webhook.SECRET_HEADER: SECRET},
+                )
+                response.raise_for_status()
+
+        await asyncio.gather(*(send() for _ in range(connections)))
+
+
+def wait_for_port(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Webhook is not served on port {port}")
+
+
+def measure(
+    api: BotAPIServer, workers: int, updates: int, connections: int
+) -> float:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{api.server_address[1]}/bot"
+
+    def build(number: int) -> Application:
+        application = (
+            Application.builder().token("1:benchmark").base_url(base_url)
+        ).build()
+        application.add_handler(CommandHandler("start", start))
+        return application
+
+    server = multiprocessing.get_context("fork").Process(
+        target=webhook.run,
+        args=(build, "127.0.0.1", port, PATH, SECRET, workers),
+    )
+    server.start()
+    wait_for_port(port)
+    try:
+        api.replies = 0
+        started = time.perf_counter()
+        asyncio.run(post_updates(port, updates, connections))
+        while api.replies < updates:
+            time.sleep(0.001)
+        return time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--connections", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.01)
+    args = parser.parse_args()
+
+    api = BotAPIServer(args.latency)
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    print(f"{'workers':>8} {'seconds':>8} {'updates/s':>10}")
+    for workers in args.workers:
+        elapsed = measure(api, workers, args.updates, args.connections)
+        print(f"{workers:>8} {elapsed:>8.2f} {args.updates / elapsed:>10.0f}")
+    api.shutdown()
+
+
+if __name__ == "__main__":
+    main()
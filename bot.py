@@ -1,9 +1,14 @@
+import asyncio
 import logging
 import os
+import time
 from enum import Enum
+from typing import TYPE_CHECKING, Optional
 
 from dotenv import load_dotenv
+from pymongo.errors import PyMongoError
 from telegram import (
+    Bot,
     KeyboardButton,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
@@ -15,14 +20,44 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
+import exporting
+import metrics
+from conversations import SharedConversationHandler, create_loading_handler
+from delivery import SendQueue
+from settings import (
+    BEST_WEATHER_TOP_MAX,
+    BOT_MODE,
+    CONVERSATION_STORE_BACKEND,
+    METRICS_PORT,
+    SUBSCRIPTION_DEFAULT_TIME,
+    WEBHOOK_HOST,
+    WEBHOOK_MAX_CONNECTIONS,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    WEBHOOK_WORKERS,
+)
+from subscription_repository import Subscription, SubscriptionRepository
+from subscriptions import SubscriptionScheduler, format_time, parse_time
+
+if TYPE_CHECKING:
+    from reports import ReportService, ReportSnapshot
+
 load_dotenv()
 
+# Startup time is measured from the moment the bot module has loaded
+LAUNCHED_AT = time.monotonic()
 
 TOKEN = os.getenv("BOT_TOKEN")
-FORECASTS_FILENAME = os.getenv("FORECASTS_FILENAME", "forecasts.xls")
+# Name of the report file; its extension is replaced by the report format
+FORECASTS_FILENAME = os.path.splitext(
+    os.getenv("FORECASTS_FILENAME", "forecasts.xls")
+)[0]
 CRYING_FACE = "\U0001F622"
 REPLY_DEFAULT = (
     f"Извините, я Вас не понимаю {CRYING_FACE}\n"
@@ -31,9 +66,13 @@ REPLY_DEFAULT = (
 REPLY_HELP = """
 /my_weather - погода рядом
 /get_weather - погода в любой точке мира
-/best_weather - топ городов с лучшей погодой сегодня:
+/best_weather - топ городов с лучшей погодой сегодня файлом,
+/best_weather csv - тот же топ в формате xlsx, xls, csv или json,
+/best_weather N - первые N городов топа сообщением:
  • макс. средняя температура, температура днём +18..+27 °C
  • макс. часов приятных погодных условий: только безоблачная и малооблачная погода
+/subscribe ЧЧ:ММ - погода рядом каждый день в это время,
+/unsubscribe - отменить подписку
 """
 REPLY_PROMO = "📌Приглашай людей по реферальной ссылке и улучшай карму"
 REPLY_START = (
@@ -47,6 +86,31 @@ REPLY_WEATHER = (
     "По данным Яндекс.Погоды,"
     " сегодня в городе {location} в среднем {temperature:.1f} °C"
 )
+REPLY_REPORT = "Подробный прогноз здесь (обновлён {created_at:%d.%m %H:%M})"
+REPLY_BEST_CITIES = (
+    "Топ-{count} городов с лучшей погодой"
+    " (обновлён {created_at:%d.%m %H:%M}):"
+)
+REPLY_BEST_CITY = (
+    "{number}. {name}: {hours:.1f} ч приятной погоды, {temperature:.1f} °C"
+)
+REPLY_BEST_USAGE = (
+    "Укажите число городов от 1 до {limit}, например /best_weather 5,"
+    " или формат файла: {formats}"
+)
+REPLY_FORMAT_UNAVAILABLE = (
+    "Отчёт нельзя сохранить в формате {format}, выберите другой: {formats}"
+)
+REPLY_SUBSCRIBED = (
+    "Готово! Погода будет приходить каждый день в {time}."
+    " Отменить подписку: /unsubscribe"
+)
+REPLY_SUBSCRIBE_USAGE = (
+    "Укажите время в формате ЧЧ:ММ, например /subscribe 07:30"
+)
+REPLY_UNSUBSCRIBED = "Подписка отменена"
+REPLY_NOT_SUBSCRIBED = "У Вас нет подписки. Оформить: /subscribe"
+REPLY_DAILY_WEATHER = "Доброе утро! " + REPLY_WEATHER
 REPLY_NEED_PLACE = "Напишите место, где вы хотите узнать погоду"
 BTN_REQUEST_GEO = "Отправить свою геолокацию"
 
@@ -57,6 +121,7 @@ logger = logging.getLogger(__name__)
 class ConversationState(int, Enum):
     LOCATION = 0
     PLACE = 1
+    SUBSCRIPTION_LOCATION = 2
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -93,7 +158,16 @@ async def location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     longitude = update.message.location.longitude
     logger.info("User %s: %f / %f", user.first_name, latitude, longitude)
     await update.message.reply_text(REPLY_WAIT)
-    weather = context.application.forecast_service.get_weather_by_position(
+    # Daily forecasts follow the last location of a subscriber; saved
+    # aside, so that an unavailable MongoDB does not delay the reply
+    context.application.create_task(
+        save_subscription_location(
+            context, update.effective_chat.id, latitude, longitude
+        ),
+        update=update,
+    )
+    forecast_service = context.application.forecast_service
+    weather = await forecast_service.get_weather_by_position_async(
         latitude, longitude
     )
     logger.info("Weather: %s", weather)
@@ -119,21 +193,89 @@ async def cancel_command(
     return ConversationHandler.END
 
 
-async def best_weather_command(
-    update: Update, context: ContextTypes.DEFAULT_TYPE
+async def send_report(
+    update: Update,
+    report_service: "ReportService",
+    report: "ReportSnapshot",
+    export_format: Optional[str],
 ) -> None:
-    """Send a message when the command /best_weather is issued."""
-    await update.message.reply_text(REPLY_WAIT)
-    dataset = context.application.forecast_service.forecast_weather()
-    with open("forecasts.xls", "wb") as f:
-        f.write(dataset.export("xls"))
+    """Send the report file, or formats to choose from if it does not fit."""
+    export_format = export_format or report_service.export_format
+    formats = exporting.get_formats(report.analysis.rows_count)
+    try:
+        if export_format not in formats:
+            raise ValueError(f"Report is too large for {export_format}")
+        # Sent from memory; encoded once per report version and format
+        document = await report_service.export(report, export_format)
+    except ValueError as error:
+        logger.warning("Report is not exported: %s", error)
+        await update.message.reply_text(
+            REPLY_FORMAT_UNAVAILABLE.format(
+                format=export_format,
+                formats=", ".join(
+                    other for other in formats if other != export_format
+                ),
+            )
+        )
+        return
     await update.message.reply_document(
-        document=open(f"./{FORECASTS_FILENAME}", "rb"),
-        filename=f"{FORECASTS_FILENAME}",
-        caption="Подробный прогноз здесь",
+        document=document,
+        filename=f"{FORECASTS_FILENAME}.{export_format}",
+        caption=REPLY_REPORT.format(created_at=report.created_at),
     )
 
 
+async def best_weather_command(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """
+    Send a message when the command /best_weather is issued:
+    the report file, the file in a format with /best_weather csv,
+    or the first N cities with /best_weather N.
+    """
+    count = export_format = None
+    if context.args:
+        argument = context.args[0].lower()
+        if argument in exporting.FORMATS:
+            export_format = argument
+        else:
+            try:
+                count = int(argument)
+            except ValueError:
+                count = 0
+            if not 1 <= count <= BEST_WEATHER_TOP_MAX:
+                await update.message.reply_text(
+                    REPLY_BEST_USAGE.format(
+                        limit=BEST_WEATHER_TOP_MAX,
+                        formats=", ".join(exporting.FORMATS),
+                    )
+                )
+                return
+    report_service = context.application.forecast_service.report_service
+    if report_service.snapshot is None:
+        await update.message.reply_text(REPLY_WAIT)
+    report = await report_service.get()
+    if count is None:
+        await send_report(update, report_service, report, export_format)
+        return
+    best_cities = report.top(count)
+    lines = [
+        REPLY_BEST_CITIES.format(
+            count=len(best_cities), created_at=report.created_at
+        ),
+        *(
+            REPLY_BEST_CITY.format(
+                number=number,
+                name=city.name,
+                hours=city.hours_total_avg,
+                temperature=city.temperature_total_avg,
+            )
+            for number, city in enumerate(best_cities, 1)
+        ),
+    ]
+    await update.message.reply_text("\n".join(lines))
+
+
 async def get_weather_command(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> int:
@@ -146,7 +288,7 @@ async def get_weather_command(
 
 async def place(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(REPLY_WAIT)
-    weather = context.application.forecast_service.get_weather(
+    weather = await context.application.forecast_service.get_weather_async(
         update.message.text
     )
     await update.message.reply_text(
@@ -158,8 +300,130 @@ async def place(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+async def get_subscriptions(
+    context: ContextTypes.DEFAULT_TYPE,
+) -> SubscriptionRepository:
+    services = context.application.forecast_service.services
+    await services.load_async("subscriptions")
+    return services.subscriptions
+
+
+async def save_subscription_location(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    latitude: float,
+    longitude: float,
+) -> None:
+    try:
+        subscriptions = await get_subscriptions(context)
+        await asyncio.to_thread(
+            subscriptions.update_location, chat_id, latitude, longitude
+        )
+    except PyMongoError as error:
+        logger.warning("Location of a subscription is not saved: %s", error)
+
+
+async def reply_subscribed(update: Update, minute: int) -> None:
+    await update.message.reply_text(
+        REPLY_SUBSCRIBED.format(time=format_time(minute)),
+        reply_markup=ReplyKeyboardRemove(),
+    )
+
+
+async def subscribe_command(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> int:
+    """
+    Send a message when the command /subscribe is issued:
+    subscribe to daily weather at the location, asked if it is unknown.
+    """
+    try:
+        minute = parse_time(
+            context.args[0] if context.args else SUBSCRIPTION_DEFAULT_TIME
+        )
+    except ValueError:
+        await update.message.reply_text(REPLY_SUBSCRIBE_USAGE)
+        return ConversationHandler.END
+    chat_id = update.effective_chat.id
+    subscriptions = await get_subscriptions(context)
+    await asyncio.to_thread(
+        subscriptions.save, Subscription(chat_id, minute=minute)
+    )
+    subscription = await asyncio.to_thread(
+        subscriptions.first, chat_id=chat_id
+    )
+    if subscription.latitude is None:
+        keyboard = [[KeyboardButton(BTN_REQUEST_GEO, request_location=True)]]
+        await update.message.reply_text(
+            REPLY_LOCATION_REQUEST + "\n" + REPLY_HOW_TO_CANCEL,
+            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True),
+        )
+        return ConversationState.SUBSCRIPTION_LOCATION
+    await reply_subscribed(update, minute)
+    return ConversationHandler.END
+
+
+async def subscription_location(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> int:
+    """Complete the subscription with the location of the user."""
+    chat_id = update.effective_chat.id
+    subscriptions = await get_subscriptions(context)
+    await asyncio.to_thread(
+        subscriptions.save,
+        Subscription(
+            chat_id,
+            latitude=update.message.location.latitude,
+            longitude=update.message.location.longitude,
+        ),
+    )
+    subscription = await asyncio.to_thread(
+        subscriptions.first, chat_id=chat_id
+    )
+    await reply_subscribed(update, subscription.minute)
+    return ConversationHandler.END
+
+
+async def unsubscribe_command(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """Send a message when the command /unsubscribe is issued."""
+    subscriptions = await get_subscriptions(context)
+    if await asyncio.to_thread(subscriptions.delete, update.effective_chat.id):
+        await update.message.reply_text(REPLY_UNSUBSCRIBED)
+    else:
+        await update.message.reply_text(REPLY_NOT_SUBSCRIBED)
+
+
+def render_daily_weather(weather: dict) -> str:
+    return REPLY_DAILY_WEATHER.format(
+        location=weather.get("city"),
+        temperature=weather.get("temperature_total_avg"),
+    )
+
+
+async def run_subscriptions(application: Application) -> None:
+    """Deliver daily weather to subscribers through the send queue."""
+    services = application.forecast_service.services
+    await services.load_async("subscriptions")
+    subscriptions = services.subscriptions
+
+    async def unsubscribe(chat_id: int) -> None:
+        # The user has blocked the bot
+        await asyncio.to_thread(subscriptions.delete, chat_id)
+
+    queue = SendQueue(application.bot.send_message, on_forbidden=unsubscribe)
+    scheduler = SubscriptionScheduler(
+        subscriptions,
+        application.forecast_service.get_weather_by_position_async,
+        render_daily_weather,
+        queue,
+    )
+    await asyncio.gather(queue.run(), scheduler.run())
+
+
 def create_my_weather_handler():
-    conversation_handler = ConversationHandler(
+    conversation_handler = SharedConversationHandler(
         entry_points=[CommandHandler("my_weather", my_weather_command)],
         states={
             ConversationState.LOCATION: [
@@ -168,13 +432,30 @@ def create_my_weather_handler():
             ]
         },
         fallbacks=[CommandHandler("cancel", cancel_command)],
-        conversation_timeout=30,
+        name="my_weather",
+        timeout=30,
+    )
+    return conversation_handler
+
+
+def create_subscribe_handler():
+    conversation_handler = SharedConversationHandler(
+        entry_points=[CommandHandler("subscribe", subscribe_command)],
+        states={
+            ConversationState.SUBSCRIPTION_LOCATION: [
+                MessageHandler(filters.LOCATION, subscription_location),
+                CommandHandler("cancel", cancel_command),
+            ]
+        },
+        fallbacks=[CommandHandler("cancel", cancel_command)],
+        name="subscribe",
+        timeout=60,
     )
     return conversation_handler
 
 
 def create_get_weather_handler():
-    conversation_handler = ConversationHandler(
+    conversation_handler = SharedConversationHandler(
         entry_points=[CommandHandler("get_weather", get_weather_command)],
         states={
             ConversationState.PLACE: [
@@ -183,7 +464,8 @@ def create_get_weather_handler():
             ]
         },
         fallbacks=[CommandHandler("cancel", cancel_command)],
-        conversation_timeout=60,
+        name="get_weather",
+        timeout=60,
     )
     return conversation_handler
 
@@ -193,28 +475,127 @@ async def default(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(REPLY_DEFAULT)
 
 
-def main() -> None:
-    """Start the bot."""
+def log_startup(stage: str) -> None:
+    logger.info(
+        "Bot %s in %.3f s after launch", stage, time.monotonic() - LAUNCHED_AT
+    )
+
+
+async def first_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Report the startup time once the first update is answered."""
+    if not context.application.has_replied:
+        context.application.has_replied = True
+        log_startup("has replied for the first time")
+
+
+async def startup(application: Application) -> None:
+    """Start background jobs of forecast services."""
+    log_startup("is ready")
+    application.has_replied = False
+    # Every webhook worker serves its own metrics
+    application.metrics_server = metrics.start_http_server(
+        port=METRICS_PORT + application.worker
+    )
+    # One webhook worker refreshes the report, others build it on demand
+    application.report_job = (
+        asyncio.create_task(application.forecast_service.report_service.run())
+        if application.worker == 0
+        else None
+    )
+    # One webhook worker sends daily weather; replicas share slots in MongoDB
+    application.subscriptions_job = (
+        asyncio.create_task(run_subscriptions(application))
+        if application.worker == 0
+        else None
+    )
+
+
+async def shutdown(application: Application) -> None:
+    """Stop background jobs and release resources of forecast services."""
+    if application.report_job is not None:
+        application.report_job.cancel()
+    if application.subscriptions_job is not None:
+        application.subscriptions_job.cancel()
+    await application.forecast_service.shutdown()
+    if application.metrics_server is not None:
+        application.metrics_server.shutdown()
+
+
+def create_application(worker: int = 0) -> Application:
+    """Build the bot with forecast services and handlers."""
     import forecasting
 
-    logging.basicConfig(
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        level=logging.INFO,
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(startup)
+        .post_shutdown(shutdown)
+        .build()
     )
-    # Disable telegram library`s httpx message logging
-    logging.getLogger("httpx").setLevel(logging.WARNING)
-    app = Application.builder().token(TOKEN).build()
+    # Number of the webhook process, 0 for polling
+    app.worker = worker
     # Save forecast services
     app.forecast_service = forecasting
+    my_weather, get_weather, subscribe = conversations = [
+        create_my_weather_handler(),
+        create_get_weather_handler(),
+        create_subscribe_handler(),
+    ]
+    # Earlier group: states of conversations are read before they are used
+    app.add_handler(create_loading_handler(conversations), group=-1)
     # Register commands - answers in Telegram
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(create_my_weather_handler())
-    app.add_handler(create_get_weather_handler())
+    app.add_handler(my_weather)
+    app.add_handler(get_weather)
     app.add_handler(CommandHandler("best_weather", best_weather_command))
+    app.add_handler(subscribe)
+    app.add_handler(CommandHandler("unsubscribe", unsubscribe_command))
     # Register user`s non-command request reply
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, default))
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Later group: runs after the reply is sent
+    app.add_handler(TypeHandler(Update, first_reply), group=1)
+    return app
+
+
+def main() -> None:
+    """Start the bot."""
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    # Disable telegram library`s httpx message logging
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if BOT_MODE != "webhook":
+        app = create_application()
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+        return
+
+    if WEBHOOK_WORKERS > 1 and CONVERSATION_STORE_BACKEND != "mongo":
+        raise RuntimeError(
+            "Conversations of several webhook workers have to be kept "
+            "in MongoDB: set CONVERSATION_STORE_BACKEND=mongo "
+            "or WEBHOOK_WORKERS=1"
+        )
+
+    import webhook
+
+    asyncio.run(
+        webhook.set_webhook(
+            Bot(TOKEN),
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    )
+    webhook.run(
+        create_application,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        path=WEBHOOK_PATH,
+        secret=WEBHOOK_SECRET,
+        workers=WEBHOOK_WORKERS,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple, Union
+
+import pymongo
+from pymongo.errors import PyMongoError
+
+from city_repository import MongoDBRepository
+
+logger = logging.getLogger(__name__)
+
+
+def quantize_coordinates(
+    latitude: float, longitude: float, grid: float
+) -> Tuple[float, float]:
+    """Snap coordinates to the nearest node of a `grid`-degree mesh."""
+    return (
+        round(round(latitude / grid) * grid, 6),
+        round(round(longitude / grid) * grid, 6),
+    )
+
+
+class TTLCache:
+    """Bounded in-memory cache with per-entry expiry and LRU eviction."""
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        timer: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires_at <= self._timer():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (self._timer() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+def normalize_address(address: str) -> str:
+    return " ".join(address.casefold().split())
+
+
+class FileCacheStore:
+    """Cache entries persisted as a JSON document on local disk."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = self._read()
+
+    def _read(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as error:
+            logger.warning(f"Cache file {self.path} is ignored: {error}")
+            return {}
+
+    def _write(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, delete=False, encoding="utf-8"
+        ) as file:
+            json.dump(self._entries, file, ensure_ascii=False)
+        os.replace(file.name, self.path)
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._entries.get(key)
+
+    def save_many(self, entries: Dict[str, Dict[str, Any]]) -> None:
+        now = time.time()
+        with self._lock:
+            self._entries = {
+                key: entry
+                for key, entry in self._entries.items()
+                if entry["expires_at"] > now
+            }
+            self._entries.update(entries)
+            self._write()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries = {}
+            self._write()
+
+
+class MongoCacheStore(MongoDBRepository):
+    """Cache entries persisted in a MongoDB collection."""
+
+    def __init__(self, collection_name: str = "geocoder_cache", **kwargs):
+        super().__init__(collection_name=collection_name, **kwargs)
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.db[self.collection_name].find_one(
+            {"_id": key}, {"_id": 0}
+        )
+
+    def save_many(self, entries: Dict[str, Dict[str, Any]]) -> None:
+        if not entries:
+            return
+        self.db[self.collection_name].bulk_write(
+            [
+                pymongo.ReplaceOne({"_id": key}, entry, upsert=True)
+                for key, entry in entries.items()
+            ],
+            ordered=False,
+        )
+
+    def clear(self) -> None:
+        self.db[self.collection_name].delete_many({})
+
+
+class GeocoderCache:
+    """
+    Address -> coordinates cache that survives restarts.
+    Addresses which could not be resolved are cached as well,
+    with a shorter `negative_ttl`.
+    """
+
+    def __init__(
+        self,
+        store: Union[FileCacheStore, MongoCacheStore],
+        ttl: float,
+        negative_ttl: float,
+    ) -> None:
+        self.store = store
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(
+        self, address: str
+    ) -> Tuple[bool, Optional[Tuple[float, float]]]:
+        """
+        :param address: address as it was requested
+        :return: whether address is cached and its coordinates
+            (None for addresses that could not be resolved)
+        """
+        try:
+            entry = self.store.load(normalize_address(address))
+        except PyMongoError as error:
+            # Unavailable cache is a miss: the address is geocoded again
+            logger.warning(f"Geocoder cache is not read: {error}")
+            entry = None
+        if entry is None or entry["expires_at"] <= time.time():
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        coordinates = entry["coordinates"]
+        return True, None if coordinates is None else tuple(coordinates)
+
+    def set_many(
+        self, results: Dict[str, Optional[Tuple[float, float]]]
+    ) -> None:
+        now = time.time()
+        try:
+            self.store.save_many(
+                {
+                    normalize_address(address): {
+                        "coordinates": coordinates,
+                        "expires_at": now
+                        + (self.ttl if coordinates else self.negative_ttl),
+                    }
+                    for address, coordinates in results.items()
+                }
+            )
+        except PyMongoError as error:
+            logger.warning(f"Geocoder cache is not saved: {error}")
+
+    def clear(self) -> None:
+        self.store.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
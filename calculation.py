@@ -0,0 +1,140 @@
+"""Columnar calculation of weather parameters for many cities at once."""
+import functools
+import logging
+from array import array
+from typing import List, Tuple
+
+from constants import (
+    FORECAST_TARGET_HOURS,
+    PLEASANT_CONDITIONS,
+    PLEASANT_TEMPERATURE_RANGE,
+)
+from models import CONDITION_CODES, CityForecast, HourlyBlock
+
+# NumPy is slow to import, so it is imported on first calculation
+np = None
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def is_available() -> bool:
+    global np
+    try:
+        import numpy
+    except ImportError:  # pragma: no cover
+        return False
+    np = numpy
+    return True
+
+
+class ForecastColumns:
+    """Hours of all cities packed into columns."""
+
+    def __init__(self, blocks: List[HourlyBlock]) -> None:
+        self.blocks = blocks
+        # One entry per hour
+        self.hour = array("b")
+        self.temp = array("d")
+        self.condition = array("b")
+        # One entry per forecast day
+        self.day_size = array("l")
+        self.day_city = array("l")
+        self._pack()
+
+    def _pack(self) -> None:
+        for city_index, block in enumerate(self.blocks):
+            self.hour.extend(block.hours)
+            self.temp.extend(block.temps)
+            self.condition.extend(block.conditions)
+            self.day_size.extend(block.day_sizes)
+            self.day_city.extend([city_index] * len(block.dates))
+
+    def to_arrays(self) -> Tuple["np.ndarray", ...]:
+        """Day index, hour, temperature and condition code of every hour."""
+        day = np.repeat(
+            np.arange(len(self.day_size)),
+            np.frombuffer(self.day_size, dtype=np.int_),
+        )
+        hour = np.frombuffer(self.hour, dtype=np.int8)
+        temp = np.frombuffer(self.temp, dtype=np.float64)
+        condition = np.frombuffer(self.condition, dtype=np.int8)
+        return day, hour, temp, condition
+
+
+def calculate_cities_data(blocks: List[HourlyBlock]) -> List[CityForecast]:
+    """
+    Same result as DataCalculationTask.calculate_city_data for every city,
+    computed with grouped reductions over packed columns.
+    """
+    if not blocks:
+        return []
+    columns = ForecastColumns(blocks)
+    days_count = len(columns.day_size)
+    day, hour, temp, condition = columns.to_arrays()
+    day_city = np.frombuffer(columns.day_city, dtype=np.int_)
+
+    selected = np.isin(hour, list(FORECAST_TARGET_HOURS))
+    temp_min, temp_max = PLEASANT_TEMPERATURE_RANGE
+    pleasant = (
+        selected
+        & np.isin(condition, [CONDITION_CODES[c] for c in PLEASANT_CONDITIONS])
+        & (temp_min <= temp)
+        & (temp <= temp_max)
+    )
+    hours_count = np.bincount(day[selected], minlength=days_count)
+    temp_sum = np.bincount(
+        day[selected], weights=temp[selected], minlength=days_count
+    )
+    pleasant_hours = np.bincount(day[pleasant], minlength=days_count)
+
+    # Days without target hours are skipped, as in the per-city calculation
+    valid = hours_count > 0
+    temperature_avg = np.zeros(days_count)
+    np.divide(temp_sum, hours_count, out=temperature_avg, where=valid)
+    cities_count = len(blocks)
+    city_days = np.bincount(day_city[valid], minlength=cities_count)
+    city_temperature = np.bincount(
+        day_city[valid],
+        weights=temperature_avg[valid],
+        minlength=cities_count,
+    )
+    city_hours = np.bincount(
+        day_city[valid],
+        weights=pleasant_hours[valid],
+        minlength=cities_count,
+    )
+
+    pleasant_hours = pleasant_hours.astype(np.intc)
+    cities = []
+    start = 0
+    for city_index, block in enumerate(blocks):
+        # Days of a city follow each other
+        end = start + len(block.dates)
+        city_valid = valid[start:end]
+        city_temperature_avg = temperature_avg[start:end][city_valid]
+        city_pleasant_hours = pleasant_hours[start:end][city_valid]
+        start = end
+        if not city_days[city_index]:
+            logger.warning(f"No forecast hours for {block.location}")
+            continue
+        cities.append(
+            CityForecast(
+                city=block.city,
+                location=block.location,
+                dates=tuple(
+                    date
+                    for date, is_valid in zip(block.dates, city_valid)
+                    if is_valid
+                ),
+                temperature_avg=array("d", city_temperature_avg.tobytes()),
+                pleasant_hours=array("i", city_pleasant_hours.tobytes()),
+                temperature_total_avg=float(
+                    city_temperature[city_index] / city_days[city_index]
+                ),
+                hours_total_avg=float(
+                    city_hours[city_index] / city_days[city_index]
+                ),
+            )
+        )
+    return cities
@@ -0,0 +1,295 @@
+"""
+City catalog loading: streaming CSV reader and a binary snapshot.
+
+Snapshot layout, in native byte order:
+header, latitudes and longitudes (float64, NaN if unknown),
+offsets of names and sources (uint64, count + 1 each),
+then UTF-8 names and sources.
+"""
+import csv
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from collections.abc import Sequence
+from typing import Iterable, Iterator, List, Optional, Union
+
+from city_repository import City
+from utils import parse_coords
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"CITYSNAP"
+SNAPSHOT_VERSION = 1
+# Magic, version, CSV mtime and size, cities count, names and sources sizes
+HEADER = struct.Struct("=8sQqqQQQ")
+# Bad rows are reported one by one up to this number, then only counted
+REPORTED_ROWS_LIMIT = 20
+
+ERROR_NO_COLUMN = "Cities file {path} has no {column!r} column"
+WARNING_BAD_ROW = "Cities file {path}, line {line}: {error}. Row is skipped"
+WARNING_BAD_ROWS = "Cities file {path}: {count} bad rows are skipped"
+
+
+def read_cities_csv(path: str) -> Iterator[City]:
+    """Cities of a CSV file row by row; bad rows are logged and skipped."""
+    bad_rows = 0
+    with open(path, newline="", encoding="utf-8") as csvfile:
+        reader = csv.reader(csvfile, delimiter=",", escapechar="\\")
+        header = next(reader, [])
+        if "city" not in header:
+            logger.error(ERROR_NO_COLUMN.format(path=path, column="city"))
+            return
+        columns = {column: number for number, column in enumerate(header)}
+        name_column = columns["city"]
+        coords_column = columns.get("coords")
+        source_column = columns.get("source")
+        for row in reader:
+            try:
+                if len(row) != len(header):
+                    raise ValueError(
+                        f"{len(row)} fields instead of {len(header)}"
+                    )
+                if not (name := row[name_column]):
+                    raise ValueError("empty city name")
+                coords = parse_coords(
+                    row[coords_column] if coords_column is not None else None
+                )
+            except ValueError as error:
+                bad_rows += 1
+                if bad_rows <= REPORTED_ROWS_LIMIT:
+                    logger.warning(
+                        WARNING_BAD_ROW.format(
+                            path=path, line=reader.line_num, error=error
+                        )
+                    )
+                continue
+            yield City(
+                name=name,
+                url_source=(
+                    row[source_column] if source_column is not None else ""
+                ),
+                **coords,
+            )
+    if bad_rows:
+        logger.warning(WARNING_BAD_ROWS.format(path=path, count=bad_rows))
+
+
+class CitySnapshot(Sequence):
+    """
+    Cities of a memory-mapped snapshot.
+    Nothing is read until a city is asked for.
+    """
+
+    def __init__(self, path: str, written: bool = False) -> None:
+        """:param written: the snapshot is just made from a changed file"""
+        self.path = path
+        self.written = written
+        # Views of the map are released before it is closed
+        self._views: List[memoryview] = []
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse()
+        except (struct.error, TypeError, ValueError):
+            self.close()
+            raise ValueError(f"Snapshot {path} is damaged")
+
+    def _parse(self) -> None:
+        (
+            magic,
+            version,
+            self.source_mtime,
+            self.source_size,
+            count,
+            names_size,
+            sources_size,
+        ) = HEADER.unpack_from(self._map)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError
+        view = self._view(memoryview(self._map))
+        sizes = (8 * count, 8 * count, 8 * (count + 1), 8 * (count + 1))
+        start = HEADER.size
+        columns = []
+        for size in sizes:
+            end = start + size
+            columns.append(self._view(view[start:end]))
+            start = end
+        names_end = start + names_size
+        if names_end + sources_size != len(self._map):
+            raise ValueError
+        self.latitudes = self._view(columns[0].cast("d"))
+        self.longitudes = self._view(columns[1].cast("d"))
+        self._name_offsets = self._view(columns[2].cast("Q"))
+        self._source_offsets = self._view(columns[3].cast("Q"))
+        self._names = self._view(view[start:names_end])
+        self._sources = self._view(view[names_end:])
+        self._count = count
+
+    def _view(self, view: memoryview) -> memoryview:
+        self._views.append(view)
+        return view
+
+    @classmethod
+    def open_fresh(
+        cls, path: str, source: os.stat_result
+    ) -> Optional["CitySnapshot"]:
+        """Snapshot made from the current version of the source file."""
+        try:
+            snapshot = cls(path)
+        except (OSError, ValueError) as error:
+            if not isinstance(error, FileNotFoundError):
+                logger.warning(f"Snapshot is not used: {error}")
+            return None
+        if (snapshot.source_mtime, snapshot.source_size) != (
+            source.st_mtime_ns,
+            source.st_size,
+        ):
+            snapshot.close()
+            return None
+        return snapshot
+
+    def __len__(self) -> int:
+        return self._count
+
+    @staticmethod
+    def _coordinate(value: float) -> Optional[float]:
+        return None if math.isnan(value) else value
+
+    @staticmethod
+    def _text(data: memoryview, offsets: memoryview, index: int) -> str:
+        start, end = offsets[index], offsets[index + 1]
+        return str(data[start:end], "utf-8")
+
+    def _get(self, index: int) -> City:
+        return City(
+            name=self._text(self._names, self._name_offsets, index),
+            url_source=self._text(self._sources, self._source_offsets, index),
+            latitude=self._coordinate(self.latitudes[index]),
+            longitude=self._coordinate(self.longitudes[index]),
+        )
+
+    def __iter__(self) -> Iterator[City]:
+        # Same as _get, without lookups per city
+        names, sources = self._names, self._sources
+        coordinate = self._coordinate
+        for name_start, name_end, source_start, source_end, lat, lon in zip(
+            self._name_offsets,
+            self._name_offsets[1:],
+            self._source_offsets,
+            self._source_offsets[1:],
+            self.latitudes,
+            self.longitudes,
+        ):
+            yield City(
+                name=str(names[name_start:name_end], "utf-8"),
+                url_source=str(sources[source_start:source_end], "utf-8"),
+                latitude=coordinate(lat),
+                longitude=coordinate(lon),
+            )
+
+    def __getitem__(self, index: Union[int, slice]):
+        if isinstance(index, slice):
+            return [self._get(i) for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("City index out of range")
+        return self._get(index)
+
+    def close(self) -> None:
+        while self._views:
+            self._views.pop().release()
+        self._map.close()
+
+
+def write_snapshot(
+    path: str, cities: Iterable[City], source: os.stat_result
+) -> int:
+    """Write cities to a snapshot atomically; returns their number."""
+    latitudes, longitudes = array("d"), array("d")
+    name_offsets, source_offsets = array("Q", [0]), array("Q", [0])
+    names, sources = bytearray(), bytearray()
+    for city in cities:
+        latitudes.append(
+            math.nan if city.latitude is None else city.latitude
+        )
+        longitudes.append(
+            math.nan if city.longitude is None else city.longitude
+        )
+        names += city.name.encode()
+        name_offsets.append(len(names))
+        sources += city.url_source.encode()
+        source_offsets.append(len(sources))
+    count = len(latitudes)
+    if not count:
+        # Nothing to speed up; problems of the file are reported every time
+        return count
+    directory = os.path.dirname(path) or "."
+    descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(
+                HEADER.pack(
+                    SNAPSHOT_MAGIC,
+                    SNAPSHOT_VERSION,
+                    source.st_mtime_ns,
+                    source.st_size,
+                    count,
+                    len(names),
+                    len(sources),
+                )
+            )
+            for column in (
+                latitudes,
+                longitudes,
+                name_offsets,
+                source_offsets,
+            ):
+                file.write(column.tobytes())
+            file.write(names)
+            file.write(sources)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return count
+
+
+def load_catalog(
+    path: str, snapshot_path: Optional[str] = None
+) -> Union[CitySnapshot, List[City]]:
+    """
+    Cities of a CSV file. With `snapshot_path`, cities are loaded
+    from the snapshot while the file is unchanged, and the snapshot
+    is made again otherwise.
+    """
+    try:
+        source = os.stat(path)
+    except OSError as error:
+        logger.error(f"Cities file is not loaded: {error}")
+        return []
+    try:
+        if not snapshot_path:
+            return list(read_cities_csv(path))
+        snapshot = CitySnapshot.open_fresh(snapshot_path, source)
+        if snapshot is not None:
+            return snapshot
+        try:
+            count = write_snapshot(
+                snapshot_path, read_cities_csv(path), source
+            )
+        except OSError as error:
+            logger.warning(f"Snapshot is not written: {error}")
+            return list(read_cities_csv(path))
+    except (csv.Error, ValueError) as error:
+        # Damaged file, as opposed to bad rows which are skipped
+        logger.error(f"Cities file is not loaded: {error}")
+        return []
+    if not count:
+        return []
+    logger.info(f"Snapshot of {count} cities is written to {snapshot_path}")
+    return CitySnapshot(snapshot_path, written=True)
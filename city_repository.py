@@ -1,9 +1,14 @@
+import logging
+from dataclasses import asdict, dataclass, fields
+
 import pymongo
-from dataclasses import dataclass, asdict
+from pymongo.errors import OperationFailure
 
 import settings
 from utils import get_cities_from_csv
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class City:
@@ -18,6 +23,10 @@ class CityNotExist(RuntimeError):
 
 
 class MongoDBRepository:
+    model: type | None = None
+    # Fields identifying a document: unique index, key for upserts
+    unique_fields: tuple[str, ...] = ()
+
     def __init__(
         self,
         db_url: str = "",
@@ -28,48 +37,185 @@ class MongoDBRepository:
         self.mongodb_name = db_name or settings.MONGODB_DBNAME
         self.collection_name = collection_name
         self.db = self._get_database()
+        self.projection = self._get_projection()
+        self._create_indexes()
 
     def _get_database(self) -> pymongo.MongoClient:
         """Get MongoDB database."""
         return pymongo.MongoClient(self.mongodb_url)[self.mongodb_name]
 
-    def get_multi(self) -> list:
-        return self.db[self.collection_name]
+    def _get_projection(self) -> dict:
+        if self.model is None:
+            return {"_id": 0}
+        return {"_id": 0, **{field.name: 1 for field in fields(self.model)}}
+
+    def _create_indexes(self) -> None:
+        if not self.unique_fields:
+            return
+        try:
+            self.db[self.collection_name].create_index(
+                [(field, pymongo.ASCENDING) for field in self.unique_fields],
+                unique=True,
+            )
+        except OperationFailure as error:
+            logger.warning(
+                f"Unique index on {self.collection_name} is not created: "
+                f"{error}. Remove duplicated documents"
+            )
+
+    def _to_document(self, obj: object) -> dict:
+        return asdict(obj)
+
+    def _to_model(self, document: dict | None) -> object | None:
+        if document is None or self.model is None:
+            return document
+        return self.model(**document)
 
-    def create_multi(self, objects: list[object]) -> bool:
-        return self.db[self.collection_name].insert_many(
-            [asdict(obj) for obj in objects]
+    def get_multi(self, **filters) -> list:
+        return [
+            self._to_model(document)
+            for document in self.db[self.collection_name].find(
+                filters, self.projection
+            )
+        ]
+
+    def create_multi(self, objects: list[object]):
+        """
+        Insert objects; objects with the same unique fields are updated.
+        Empty fields do not overwrite stored values.
+        """
+        if not self.unique_fields:
+            return self.db[self.collection_name].insert_many(
+                [self._to_document(obj) for obj in objects]
+            )
+        requests = []
+        for obj in objects:
+            document = self._to_document(obj)
+            key = {field: document.pop(field) for field in self.unique_fields}
+            values = {
+                field: value
+                for field, value in document.items()
+                if value is not None
+            }
+            defaults = {
+                field: value
+                for field, value in document.items()
+                if value is None
+            }
+            update = {"$set": values, "$setOnInsert": defaults}
+            update = {
+                operator: fields_values
+                for operator, fields_values in update.items()
+                if fields_values
+            } or {"$setOnInsert": key}
+            requests.append(pymongo.UpdateOne(key, update, upsert=True))
+        if not requests:
+            return None
+        return self.db[self.collection_name].bulk_write(
+            requests, ordered=False
         )
 
     def get(self, **filters) -> object:
-        try:
-            return next(
-                obj
-                for obj in self.db[self.collection_name]
-                if all(getattr(obj, key) == value for key, value in filters)
-            )
-        except StopIteration:
+        if (obj := self.first(**filters)) is None:
             raise RuntimeError("Object does not exist.")
+        return obj
 
     def first(self, **filters) -> object | None:
-        try:
-            return next(
-                obj
-                for obj in self.db[self.collection_name]
-                if all(getattr(obj, key) == value for key, value in filters)
-            )
-        except StopIteration:
-            return None
+        return self._to_model(
+            self.db[self.collection_name].find_one(filters, self.projection)
+        )
+
+    def update(self, values: dict, **filters) -> None:
+        self.db[self.collection_name].update_one(filters, {"$set": values})
 
 
 class CityRepository(MongoDBRepository):
+    model = City
+    unique_fields = ("name",)
+
     def __init__(
         self, cities: list[City] | None = None, *args, **kwargs
     ) -> None:
-        if cities is not None:
-            self.create_multi(cities)
+        kwargs.setdefault("collection_name", "cities")
         super().__init__(*args, **kwargs)
+        if cities:
+            self.create_multi(cities)
+
+    @staticmethod
+    def _to_geo_point(latitude: float, longitude: float) -> dict:
+        return {"type": "Point", "coordinates": [longitude, latitude]}
+
+    def _to_document(self, city: City) -> dict:
+        document = asdict(city)
+        if city.latitude is not None and city.longitude is not None:
+            document["location"] = self._to_geo_point(
+                city.latitude, city.longitude
+            )
+        return document
+
+    def _create_indexes(self) -> None:
+        super()._create_indexes()
+        self.db[self.collection_name].create_index(
+            [("location", pymongo.GEOSPHERE)]
+        )
+
+    def update_coordinates(
+        self, name: str, latitude: float, longitude: float
+    ) -> None:
+        self.update(
+            {
+                "latitude": latitude,
+                "longitude": longitude,
+                "location": self._to_geo_point(latitude, longitude),
+            },
+            name=name,
+        )
+
+    def geo_near(
+        self,
+        latitude: float,
+        longitude: float,
+        limit: int | None = None,
+        max_distance: float | None = None,
+    ) -> list[tuple[City, float]]:
+        """
+        Cities closest to a position, using 2dsphere index.
+        :param max_distance: in km
+        :return: cities with distances in km, closest first
+        """
+        geo_near = {
+            "near": self._to_geo_point(latitude, longitude),
+            "distanceField": "distance",
+            "key": "location",
+            "spherical": True,
+        }
+        if max_distance is not None:
+            geo_near["maxDistance"] = max_distance * 1000
+        pipeline = [{"$geoNear": geo_near}]
+        if limit is not None:
+            pipeline.append({"$limit": limit})
+        pipeline.append({"$project": {**self.projection, "distance": 1}})
+        return [
+            (self._to_model(document), distance / 1000)
+            for document in self.db[self.collection_name].aggregate(pipeline)
+            if (distance := document.pop("distance")) is not None
+        ]
 
     @classmethod
     def from_csv(cls):
-        return cls(cities=get_cities_from_csv())
+        """
+        Repository of the cities file. Cities are saved to MongoDB when
+        the file has changed since its snapshot was made, or when the
+        collection is empty: an unchanged catalog is not upserted again.
+        """
+        from catalog import CitySnapshot
+
+        cities = get_cities_from_csv()
+        repository = cls()
+        if (
+            not isinstance(cities, CitySnapshot)
+            or cities.written
+            or repository.first() is None
+        ):
+            repository.create_multi(cities)
+        return repository
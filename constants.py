@@ -9,7 +9,34 @@ ERROR_GEO_PARSING_API = (
     "Возникла ошибка {error}"
     " при обработке ответа API Яндекс Геокодера. Адрес: {address}"
 )
+ERROR_NO_FORECAST = "Прогноз погоды для {latitude}, {longitude} не получен"
 TIMEOUT_PERIOD = 25
 PLEASANT_CONDITIONS = {"clear", "partly-cloudy", "cloudy", "overcast"}
 PLEASANT_TEMPERATURE_RANGE = (18, 27)
 FORECAST_TARGET_HOURS = set(range(9, 20))
+# Сколько лучших городов рейтинга выводится в лог
+RATING_LOGGED_CITIES = 10
+# Сколько городов отчёта обрабатывается за раз при построении строк
+ANALYZING_BATCH_SIZE = 1000
+# Значения condition в ответе API Яндекс Погоды, см. examples/conditions.txt
+CONDITIONS = (
+    "clear",
+    "partly-cloudy",
+    "cloudy",
+    "overcast",
+    "drizzle",
+    "light-rain",
+    "rain",
+    "moderate-rain",
+    "heavy-rain",
+    "continuous-heavy-rain",
+    "showers",
+    "wet-snow",
+    "light-snow",
+    "snow",
+    "snow-showers",
+    "hail",
+    "thunderstorm",
+    "thunderstorm-with-rain",
+    "thunderstorm-with-hail",
+)
@@ -0,0 +1,250 @@
+"""
+Conversation states shared by bot processes.
+
+ConversationHandler keeps states in a dict of its own process, so the
+next message of a user has to reach the same process. Handlers built
+here keep states in a store, and with the MongoDB store any process
+may continue a conversation.
+
+ConversationHandler reads the state of every update it checks, so
+stores answer from memory and never make the event loop wait.
+"""
+import asyncio
+import datetime
+import logging
+import time
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import pymongo
+from pymongo.errors import PyMongoError
+from telegram import Update
+from telegram.ext import ContextTypes, ConversationHandler, TypeHandler
+
+from city_repository import MongoDBRepository
+from settings import CONVERSATION_STORE_BACKEND
+
+logger = logging.getLogger(__name__)
+
+ConversationKey = Tuple[int, ...]
+
+
+class ConversationStore(MutableMapping):
+    """
+    In-memory states of one process.
+    A state expires `timeout` seconds after it is set.
+    """
+
+    def __init__(self, name: str, timeout: float) -> None:
+        self.name = name
+        self.timeout = timeout
+        self._states: Dict[ConversationKey, Tuple[int, Any]] = {}
+
+    def _expires_at(self) -> Any:
+        return time.monotonic() + self.timeout
+
+    def _is_expired(self, expires_at: Any) -> bool:
+        return expires_at <= time.monotonic()
+
+    def __getitem__(self, key: ConversationKey) -> int:
+        state, expires_at = self._states[key]
+        if self._is_expired(expires_at):
+            self._states.pop(key, None)
+            raise KeyError(key)
+        return state
+
+    def __setitem__(self, key: ConversationKey, state: Any) -> None:
+        # Blocking handlers only: states of running tasks are not stored
+        self._states[key] = int(state), self._expires_at()
+
+    def __delitem__(self, key: ConversationKey) -> None:
+        del self._states[key]
+
+    def __iter__(self) -> Iterator[ConversationKey]:
+        return iter(
+            [
+                key
+                for key, (_, expires_at) in self._states.items()
+                if not self._is_expired(expires_at)
+            ]
+        )
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class MongoConversationStore(ConversationStore):
+    """
+    States kept in a MongoDB collection, one document per conversation.
+    Before an update is handled, `load` reads the state of its key
+    from MongoDB in a thread into an in-memory mirror, from which
+    ConversationHandler reads it; writes change the mirror and go to
+    MongoDB from another thread, in order.
+    Ended conversations are kept without a state until they expire,
+    so that other processes see the end instead of an older state.
+    Expired documents are ignored and later removed by a TTL index.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        timeout: float,
+        collection_name: str = "conversations",
+        **kwargs,
+    ) -> None:
+        super().__init__(name, timeout)
+        # Repository methods clash with the mapping ones, so it is not a base
+        repository = MongoDBRepository(
+            collection_name=collection_name, **kwargs
+        )
+        self.collection = repository.db[collection_name]
+        self.collection.create_index(
+            [("expires_at", pymongo.ASCENDING)], expireAfterSeconds=0
+        )
+        # Time of the latest change of a key known to this process
+        self._updated_at: Dict[ConversationKey, datetime.datetime] = {}
+        # One thread keeps writes of a key in order
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f"conversations-{name}"
+        )
+
+    def _id(self, key: ConversationKey) -> str:
+        return ":".join(map(str, (self.name, *key)))
+
+    @staticmethod
+    def _now() -> datetime.datetime:
+        # Naive UTC, as pymongo returns dates by default
+        return datetime.datetime.utcnow()
+
+    def _expires_at(self) -> datetime.datetime:
+        return self._now() + datetime.timedelta(seconds=self.timeout)
+
+    def _is_expired(self, expires_at: datetime.datetime) -> bool:
+        return expires_at <= self._now()
+
+    def _find(self, key: ConversationKey) -> Optional[Dict[str, Any]]:
+        return self.collection.find_one(
+            {"_id": self._id(key), "expires_at": {"$gt": self._now()}},
+            {"_id": 0, "state": 1, "updated_at": 1, "expires_at": 1},
+        )
+
+    def _apply(
+        self, key: ConversationKey, document: Optional[Dict[str, Any]]
+    ) -> None:
+        """Take the stored state unless this process knows a newer one."""
+        known = self._updated_at.get(key)
+        if document is None:
+            # A change of this process may not be written yet
+            if known is None:
+                self._states.pop(key, None)
+            return
+        updated_at = document["updated_at"]
+        if known is not None and known >= updated_at:
+            return
+        self._updated_at[key] = updated_at
+        if document["state"] is None:
+            self._states.pop(key, None)
+        else:
+            self._states[key] = document["state"], document["expires_at"]
+
+    async def load(self, key: ConversationKey) -> None:
+        """Read the state of a key, which any process may have changed."""
+        try:
+            document = await asyncio.to_thread(self._find, key)
+        except PyMongoError as error:
+            logger.warning(
+                f"Conversation {self._id(key)} is not loaded: {error}"
+            )
+            return
+        self._apply(key, document)
+        # Forget change times of ended conversations
+        if len(self._updated_at) > 2 * len(self._states) + 1000:
+            self._updated_at = {
+                key: updated_at
+                for key, updated_at in self._updated_at.items()
+                if key in self._states
+            }
+
+    def _write(self, key: ConversationKey, state: Optional[int]) -> None:
+        """Store a change of this process; `state` None ends it."""
+        updated_at = self._now()
+        self._updated_at[key] = updated_at
+        document = {
+            "conversation": self.name,
+            "key": list(key),
+            "state": state,
+            "updated_at": updated_at,
+            "expires_at": updated_at
+            + datetime.timedelta(seconds=self.timeout),
+        }
+        self._writer.submit(self._save, self._id(key), document)
+
+    def _save(self, document_id: str, document: Dict[str, Any]) -> None:
+        try:
+            self.collection.replace_one(
+                {"_id": document_id}, document, upsert=True
+            )
+        except PyMongoError as error:
+            logger.warning(f"Conversation {document_id} is not saved: {error}")
+
+    def __setitem__(self, key: ConversationKey, state: Any) -> None:
+        super().__setitem__(key, state)
+        self._write(key, int(state))
+
+    def __delitem__(self, key: ConversationKey) -> None:
+        super().__delitem__(key)
+        self._write(key, None)
+
+    def close(self) -> None:
+        """Wait for pending writes."""
+        self._writer.shutdown(wait=True)
+
+
+def create_store(name: str, timeout: float) -> MutableMapping:
+    if CONVERSATION_STORE_BACKEND == "mongo":
+        return MongoConversationStore(name, timeout)
+    return ConversationStore(name, timeout)
+
+
+class SharedConversationHandler(ConversationHandler):
+    """
+    ConversationHandler with states in a store of `create_store`.
+    The store also ends conversations after `timeout` seconds,
+    which does not need a JobQueue.
+    """
+
+    def __init__(self, *args, name: str, timeout: float, **kwargs) -> None:
+        super().__init__(*args, name=name, **kwargs)
+        self._conversations = create_store(name, timeout)
+
+    async def load_state(self, update: object) -> None:
+        """Read the state of the update's conversation from a shared store."""
+        if not isinstance(self._conversations, MongoConversationStore):
+            return
+        if not isinstance(update, Update):
+            return
+        try:
+            key = self._get_key(update)
+        except RuntimeError:
+            # No chat or user: check_update skips such updates too
+            return
+        await self._conversations.load(key)
+
+
+def create_loading_handler(
+    handlers: List[SharedConversationHandler],
+) -> TypeHandler:
+    """
+    Handler loading the states of `handlers` for every update.
+    It has to be added to a group before the one of the handlers.
+    """
+
+    async def load_states(
+        update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> None:
+        await asyncio.gather(
+            *(handler.load_state(update) for handler in handlers)
+        )
+
+    return TypeHandler(Update, load_states)
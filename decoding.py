@@ -0,0 +1,106 @@
+"""Decoding of API responses, keeping only the fields that are used."""
+import json
+import zlib
+from typing import Any, BinaryIO, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Fields of a forecast hour used by the calculation
+HOUR_FIELDS = ("hour", "temp", "condition")
+# Content codings which responses may use, brotli only when installed
+CONTENT_ENCODINGS = ("gzip", "deflate") + (("br",) if brotli else ())
+ACCEPT_ENCODING = ", ".join(CONTENT_ENCODINGS)
+CHUNK_SIZE = 64 * 1024
+
+
+class ContentEncodingError(ValueError):
+    """Response body cannot be decompressed."""
+
+
+class _BrotliDecompressor:
+    """Brotli decompressor with the interface of zlib ones."""
+
+    def __init__(self) -> None:
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor.process(data)
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def _get_decompressor(encoding: str) -> Any:
+    if encoding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    if encoding == "deflate":
+        return zlib.decompressobj()
+    if encoding == "br" and brotli is not None:
+        return _BrotliDecompressor()
+    raise ContentEncodingError(f"Unsupported content encoding {encoding!r}")
+
+
+def read_body(
+    stream: BinaryIO, encoding: Optional[str] = None
+) -> Tuple[bytes, int]:
+    """
+    Body of a response decompressed chunk by chunk as it is read,
+    and the number of bytes received.
+    """
+    encoding = (encoding or "identity").strip().lower()
+    if encoding == "identity":
+        content = stream.read()
+        return content, len(content)
+    decompressor = _get_decompressor(encoding)
+    chunks, received = [], 0
+    try:
+        while chunk := stream.read(CHUNK_SIZE):
+            received += len(chunk)
+            chunks.append(decompressor.decompress(chunk))
+        chunks.append(decompressor.flush())
+    except (zlib.error, getattr(brotli, "error", zlib.error)) as error:
+        raise ContentEncodingError(error) from error
+    return b"".join(chunks), received
+
+
+def loads(content: bytes) -> Any:
+    """Parse JSON, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def select_forecast(document: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Copy of a weather response with the locality name and, for each day,
+    date and hour, temperature and condition of every hour.
+    A response without the locality name raises KeyError.
+    """
+    return {
+        "geo_object": {
+            "locality": {"name": document["geo_object"]["locality"]["name"]}
+        },
+        "forecasts": [
+            {
+                "date": forecast["date"],
+                "hours": [
+                    {field: hour[field] for field in HOUR_FIELDS}
+                    for hour in forecast.get("hours", ())
+                ],
+            }
+            for forecast in document.get("forecasts", ())
+        ],
+    }
+
+
+def decode_forecast(content: bytes) -> Dict[str, Any]:
+    """Weather response reduced right after parsing."""
+    return select_forecast(loads(content))
@@ -0,0 +1,106 @@
+"""Messages sent by the bot on its own, within Telegram limits."""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from telegram.error import Forbidden, RetryAfter, TelegramError
+
+import metrics
+from settings import SEND_CHAT_INTERVAL, SEND_CONCURRENCY, SEND_RATE
+from throttling import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Attempts of a message answered with RetryAfter
+SEND_ATTEMPTS = 3
+# Times of recent chats are forgotten once there are more of them
+CHAT_TIMES_MAXSIZE = 10000
+
+Send = Callable[[int, str], Awaitable[Any]]
+
+
+class SendQueue:
+    """
+    Queue of text messages, sent by `concurrency` workers at most `rate`
+    messages per second and one per `chat_interval` seconds to a chat.
+    """
+
+    def __init__(
+        self,
+        send: Send,
+        rate: float = SEND_RATE,
+        chat_interval: float = SEND_CHAT_INTERVAL,
+        concurrency: int = SEND_CONCURRENCY,
+        on_forbidden: Optional[Callable[[int], Awaitable[Any]]] = None,
+    ) -> None:
+        """
+        :param send: coroutine function sending a text to a chat
+        :param on_forbidden: called for chats which have blocked the bot
+        """
+        self.send = send
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_interval = chat_interval
+        self.concurrency = concurrency
+        self.on_forbidden = on_forbidden
+        self._queue: "asyncio.Queue[tuple]" = asyncio.Queue()
+        self._chat_ready_at: Dict[int, float] = {}
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    def put(self, chat_id: int, text: str) -> None:
+        self._queue.put_nowait((chat_id, text))
+
+    def _reserve_chat(self, chat_id: int) -> float:
+        """Take the next turn of a chat; returns how long to wait for it."""
+        now = time.monotonic()
+        if len(self._chat_ready_at) > CHAT_TIMES_MAXSIZE:
+            self._chat_ready_at = {
+                chat: ready_at
+                for chat, ready_at in self._chat_ready_at.items()
+                if ready_at > now
+            }
+        ready_at = max(now, self._chat_ready_at.get(chat_id, now))
+        self._chat_ready_at[chat_id] = ready_at + self.chat_interval
+        return ready_at - now
+
+    async def _deliver(self, chat_id: int, text: str) -> str:
+        for _ in range(SEND_ATTEMPTS):
+            await self.bucket.acquire_async()
+            # Last wait before sending, so turns of a chat stay apart
+            if delay := self._reserve_chat(chat_id):
+                await asyncio.sleep(delay)
+            try:
+                await self.send(chat_id, text)
+                return "sent"
+            except RetryAfter as error:
+                logger.warning(f"Sending is limited for {error.retry_after} s")
+                await asyncio.sleep(error.retry_after)
+            except Forbidden:
+                if self.on_forbidden is not None:
+                    await self.on_forbidden(chat_id)
+                return "forbidden"
+            except TelegramError as error:
+                logger.warning(f"Message to chat {chat_id} failed: {error}")
+                return "failed"
+        return "failed"
+
+    async def _work(self) -> None:
+        while True:
+            chat_id, text = await self._queue.get()
+            try:
+                metrics.SENT_MESSAGES.inc(await self._deliver(chat_id, text))
+            except Exception:
+                logger.exception(f"Message to chat {chat_id} failed")
+                metrics.SENT_MESSAGES.inc("failed")
+            finally:
+                self._queue.task_done()
+
+    async def run(self) -> None:
+        """Send queued messages forever."""
+        await asyncio.gather(*(self._work() for _ in range(self.concurrency)))
+
+    async def join(self) -> None:
+        """Wait until every queued message is handled."""
+        await self._queue.join()
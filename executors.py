@@ -0,0 +1,126 @@
+"""Pools of threads and processes shared by tasks."""
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Iterable, List, Optional, TypeVar, Union
+
+from settings import (
+    EXECUTOR_CPU_THRESHOLD,
+    EXECUTOR_CPU_WORKERS,
+    EXECUTOR_IO_WORKERS,
+)
+
+logger = logging.getLogger(__name__)
+
+Item = TypeVar("Item")
+Result = TypeVar("Result")
+
+
+def _ready(_: int) -> None:
+    """Task that only makes a worker process start."""
+
+
+class ExecutorService:
+    """
+    Threads for requests and processes for calculations, started once
+    and kept until shutdown. Small inputs are processed in the calling
+    thread: handing them over would cost more than the work itself.
+    """
+
+    def __init__(
+        self,
+        io_workers: int = EXECUTOR_IO_WORKERS,
+        cpu_workers: int = EXECUTOR_CPU_WORKERS or os.cpu_count() or 1,
+        cpu_threshold: int = EXECUTOR_CPU_THRESHOLD,
+    ) -> None:
+        """
+        :param cpu_threshold: least number of items sent to processes
+        """
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.cpu_threshold = cpu_threshold
+        self._lock = threading.Lock()
+        self._io_pool: Optional[ThreadPoolExecutor] = None
+        self._cpu_pool: Optional[ProcessPoolExecutor] = None
+        self._closed = False
+
+    def _get_io_pool(self) -> Optional[ThreadPoolExecutor]:
+        with self._lock:
+            if self._io_pool is None and not self._closed:
+                self._io_pool = ThreadPoolExecutor(
+                    self.io_workers, thread_name_prefix="io"
+                )
+            return self._io_pool
+
+    def _get_cpu_pool(self) -> Optional[ProcessPoolExecutor]:
+        with self._lock:
+            if self._cpu_pool is None and not self._closed:
+                self._cpu_pool = ProcessPoolExecutor(self.cpu_workers)
+            return self._cpu_pool
+
+    def map_io(
+        self, func: Callable[[Item], Result], items: Iterable[Item]
+    ) -> List[Result]:
+        """Results of blocking calls, made by threads of the pool."""
+        items = list(items)
+        if len(items) < 2 or (pool := self._get_io_pool()) is None:
+            return list(map(func, items))
+        return list(pool.map(func, items))
+
+    def map_cpu(
+        self, func: Callable[[Item], Result], items: Iterable[Item]
+    ) -> List[Result]:
+        """
+        Results of calculations, made by processes of the pool
+        if there are at least `cpu_threshold` items.
+        `func` and items are pickled for processes.
+        """
+        items = list(items)
+        if (
+            self.cpu_workers < 2
+            or len(items) < self.cpu_threshold
+            or (pool := self._get_cpu_pool()) is None
+        ):
+            return list(map(func, items))
+        # A few chunks per process: less pickling, still balanced
+        chunksize = max(1, len(items) // (self.cpu_workers * 4))
+        try:
+            return list(pool.map(func, items, chunksize=chunksize))
+        except BrokenProcessPool:
+            logger.exception("Process pool is broken and will be restarted")
+            with self._lock:
+                if self._cpu_pool is pool:
+                    self._cpu_pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+            return list(map(func, items))
+
+    def warm(self) -> None:
+        """Start processes ahead of the first calculation."""
+        if self.cpu_workers > 1 and (pool := self._get_cpu_pool()):
+            list(pool.map(_ready, range(self.cpu_workers)))
+
+    def shutdown(self) -> None:
+        """Stop the pools; later calls are processed in the caller."""
+        with self._lock:
+            self._closed = True
+            pools = (self._io_pool, self._cpu_pool)
+            self._io_pool = self._cpu_pool = None
+        for pool in pools:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+
+class InlineExecutor:
+    """Processes everything in the calling thread."""
+
+    def map_io(
+        self, func: Callable[[Item], Result], items: Iterable[Item]
+    ) -> List[Result]:
+        return list(map(func, items))
+
+    map_cpu = map_io
+
+
+Executor = Union[ExecutorService, InlineExecutor]
@@ -0,0 +1,134 @@
+"""
+Report writers fed row by row: csv, json, xls and xlsx.
+
+Rows are encoded as they are produced, so a large report is not held
+in memory as a tablib Dataset before it is written.
+"""
+import csv
+import io
+import json
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Sequence
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+Row = Sequence[object]
+Writer = Callable[[BinaryIO, Row, Iterable[Row]], None]
+
+SHEET_TITLE = "Forecasts"
+# Rows per sheet of the legacy Excel format, including the header
+XLS_MAX_ROWS = 65536
+# Finished xls rows are encoded in batches and their cells released
+XLS_FLUSH_ROWS = 1000
+
+
+def _dumps(value: Any) -> bytes:
+    """Compact JSON, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(
+        value, ensure_ascii=False, separators=(",", ":")
+    ).encode()
+
+
+def write_csv(stream: BinaryIO, headers: Row, rows: Iterable[Row]) -> None:
+    text = io.TextIOWrapper(
+        stream, encoding="utf-8", newline="", write_through=True
+    )
+    try:
+        writer = csv.writer(text)
+        writer.writerow(headers)
+        writer.writerows(rows)
+    finally:
+        # Leave the binary stream open for the caller
+        text.detach()
+
+
+def write_xls(stream: BinaryIO, headers: Row, rows: Iterable[Row]) -> None:
+    import xlwt
+
+    workbook = xlwt.Workbook(encoding="utf8")
+    sheet = workbook.add_sheet(SHEET_TITLE)
+    bold = xlwt.easyxf("font: bold on")
+    for column, value in enumerate(headers):
+        sheet.write(0, column, value, bold)
+    sheet.panes_frozen = True
+    sheet.horz_split_pos = 1
+    for number, row in enumerate(rows, 1):
+        if number >= XLS_MAX_ROWS:
+            raise ValueError(
+                f"Report has more than {XLS_MAX_ROWS} rows, "
+                "which xls does not support"
+            )
+        for column, value in enumerate(row):
+            sheet.write(number, column, value)
+        if number % XLS_FLUSH_ROWS == 0:
+            sheet.flush_row_data()
+    workbook.save(stream)
+
+
+def write_xlsx(stream: BinaryIO, headers: Row, rows: Iterable[Row]) -> None:
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+
+    # Write-only sheets keep no cells: rows go straight to the archive
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(SHEET_TITLE)
+    sheet.freeze_panes = "A2"
+    bold = Font(bold=True)
+    header_cells = []
+    for value in headers:
+        cell = WriteOnlyCell(sheet, value)
+        cell.font = bold
+        header_cells.append(cell)
+    sheet.append(header_cells)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(stream)
+
+
+def write_json(stream: BinaryIO, headers: Row, rows: Iterable[Row]) -> None:
+    """Object with `headers` and `rows`, each row an array of cells."""
+    stream.write(b'{"headers":' + _dumps(list(headers)) + b',"rows":[')
+    separator = b""
+    for row in rows:
+        stream.write(separator + _dumps(list(row)))
+        separator = b","
+    stream.write(b"]}")
+
+
+WRITERS: Dict[str, Writer] = {
+    "csv": write_csv,
+    "json": write_json,
+    "xls": write_xls,
+    "xlsx": write_xlsx,
+}
+FORMATS = tuple(WRITERS)
+# Formats which cannot hold any number of rows, including the header
+MAX_ROWS = {"xls": XLS_MAX_ROWS}
+
+
+def get_formats(rows: int) -> tuple:
+    """Formats able to hold a report of `rows` rows with the header."""
+    return tuple(
+        export_format
+        for export_format in FORMATS
+        if rows <= MAX_ROWS.get(export_format, rows)
+    )
+
+
+def write(
+    stream: BinaryIO, export_format: str, headers: Row, rows: Iterable[Row]
+) -> None:
+    """Encode `rows` under `headers` into a binary `stream`."""
+    try:
+        writer = WRITERS[export_format]
+    except KeyError:
+        raise ValueError(
+            f"Unknown export format {export_format!r}, "
+            f"expected one of {', '.join(FORMATS)}"
+        ) from None
+    writer(stream, headers, rows)
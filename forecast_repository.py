@@ -0,0 +1,130 @@
+import datetime
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+from cache import quantize_coordinates
+from city_repository import MongoDBRepository
+from models import CityForecast
+from settings import (
+    FORECAST_CACHE_GRID,
+    FORECAST_STORE_RESPONSES,
+    FORECAST_STORE_TTL,
+)
+
+logger = logging.getLogger(__name__)
+
+Position = Tuple[float, float]
+
+
+class ForecastRepository(MongoDBRepository):
+    """
+    Forecasts shared by all bot replicas, so that a place is fetched
+    and calculated once. A document is identified by a grid cell and
+    the forecast date and holds the calculated forecast and, if
+    `keep_responses` is set, the weather API response.
+    Expired documents are skipped and later removed by a TTL index.
+    """
+
+    # A cell is a string: an index on an array would treat each
+    # coordinate as a separate key, so that cells of a row would clash
+    unique_fields = ("cell", "date")
+    # Upserts racing with other replicas are retried this many times
+    upsert_attempts = 3
+
+    def __init__(
+        self,
+        ttl: float = FORECAST_STORE_TTL,
+        grid: float = FORECAST_CACHE_GRID,
+        keep_responses: bool = FORECAST_STORE_RESPONSES,
+        **kwargs,
+    ) -> None:
+        kwargs.setdefault("collection_name", "forecasts")
+        self.ttl = ttl
+        self.grid = grid
+        self.keep_responses = keep_responses
+        super().__init__(**kwargs)
+
+    def _create_indexes(self) -> None:
+        super()._create_indexes()
+        self.db[self.collection_name].create_index(
+            [("expires_at", pymongo.ASCENDING)], expireAfterSeconds=0
+        )
+
+    def get_position(self, latitude: float, longitude: float) -> Position:
+        return quantize_coordinates(latitude, longitude, self.grid)
+
+    @staticmethod
+    def get_cell(position: Position) -> str:
+        latitude, longitude = position
+        return f"{latitude}:{longitude}"
+
+    @staticmethod
+    def _now() -> datetime.datetime:
+        # Naive UTC, as pymongo returns dates by default
+        return datetime.datetime.utcnow()
+
+    def _upsert(self, position: Position, date: str, values: dict) -> None:
+        """Set fields of a document atomically, creating it if needed."""
+        values["expires_at"] = self._now() + datetime.timedelta(
+            seconds=self.ttl
+        )
+        key = {"cell": self.get_cell(position), "date": date}
+        for attempt in range(1, self.upsert_attempts + 1):
+            try:
+                self.db[self.collection_name].update_one(
+                    key, {"$set": values}, upsert=True
+                )
+                return
+            except DuplicateKeyError:
+                # Other replica has inserted the document first,
+                # so the next attempt updates it
+                if attempt == self.upsert_attempts:
+                    raise
+
+    def _find_latest(self, position: Position, field: str) -> Optional[Any]:
+        document = self.db[self.collection_name].find_one(
+            {
+                "cell": self.get_cell(position),
+                field: {"$exists": True},
+                "expires_at": {"$gt": self._now()},
+            },
+            {"_id": 0, field: 1},
+            sort=[("date", pymongo.DESCENDING)],
+        )
+        return None if document is None else document[field]
+
+    def find(self, latitude: float, longitude: float) -> Optional[dict]:
+        """Latest calculated forecast near the location, as `to_dict`."""
+        forecast = self._find_latest(
+            self.get_position(latitude, longitude), "forecast"
+        )
+        if forecast is not None:
+            forecast["location"] = tuple(forecast["location"])
+        return forecast
+
+    def save(self, forecast: CityForecast) -> None:
+        self._upsert(
+            self.get_position(*forecast.location),
+            forecast.dates[0],
+            {"forecast": forecast.to_dict()},
+        )
+
+    def find_response(self, position: Position) -> Optional[Dict[str, Any]]:
+        """Latest weather API response for a grid cell."""
+        if not self.keep_responses:
+            return None
+        return self._find_latest(position, "response")
+
+    def save_response(
+        self, position: Position, response: Dict[str, Any]
+    ) -> None:
+        if not self.keep_responses or not response["forecasts"]:
+            return
+        self._upsert(
+            position,
+            response["forecasts"][0]["date"],
+            {"response": response},
+        )
@@ -1,9 +1,31 @@
+import asyncio
 import logging
-from typing import Any, Dict, List, Tuple, Type
+import sys
+from typing import Any, Dict, List, Optional, Tuple, Type
 
-from api_client import YandexGeoAPI, YandexWeatherAPI
-from city_repository import CityRepository
+from pymongo.errors import PyMongoError
+
+import exporting
+import metrics
+from api_client import WARNING_STORE, close_async_clients
+from cache import normalize_address, quantize_coordinates
+from coalescing import AsyncSingleFlight, SingleFlight
+from constants import ERROR_NO_FORECAST
+from models import CityForecast
+from pipeline import Stage, StreamingPipeline
+from reports import ReportService
+from services import ServiceContainer
+from settings import (
+    FORECAST_CACHE_GRID,
+    PIPELINE_BUFFER_SIZE,
+    PIPELINE_FETCHING_CONCURRENCY,
+    PIPELINE_GEOCODING_CONCURRENCY,
+    REPORT_FORMAT,
+    REPORT_REFRESH_INTERVAL,
+    SNAP_DISTANCE_KM,
+)
 from tasks import (
+    CityLocatingTask,
     DataAggregationTask,
     DataAnalyzingTask,
     DataCalculationTask,
@@ -15,73 +37,349 @@ from tasks import (
 
 
 logger = logging.getLogger()
-city_service = CityRepository.from_csv()
-weather_api = YandexWeatherAPI(city_service=city_service)
+# Services connect to MongoDB and load the catalog on first use
+services = ServiceContainer()
+
+# Concurrent requests for the same place share one pending calculation
+weather_flights = SingleFlight()
+async_weather_flights = AsyncSingleFlight()
+
+TaskList = List[Tuple[Type[Task], Dict[str, Any]]]
+
+
+def snap_position(latitude: float, longitude: float) -> Tuple[float, float]:
+    """Coordinates of a known city near the position, if there is one."""
+    if SNAP_DISTANCE_KM > 0 and (
+        city := services.spatial_index.snap(
+            latitude, longitude, SNAP_DISTANCE_KM
+        )
+    ):
+        return city.latitude, city.longitude
+    return latitude, longitude
+
 
+def _prepare_params(params: Dict[str, Any], data: Any) -> Dict[str, Any]:
+    params = dict(params)
+    if (parameter := params.pop("_input", None)) is not None:
+        params = {f"{parameter}": data, **params}
+    return params
 
-def process_tasks(tasks: List[Tuple[Type[Task], Dict[str, Any]]]):
+
+def process_tasks(tasks: TaskList):
     """
     "_input" в списке параметров -
     куда направить результат работы предыдущей задачи.
     Значение None означает, что входные данные не требуются.
     Первая задача должна иметь этот параметр равным None.
     """
+    data = None
     for task, params in tasks:
-        if (parameter := params.pop("_input", None)) is not None:
-            params = {f"{parameter}": data, **params}
-        data = task(**params).worker()
+        data = task(**_prepare_params(params, data)).worker()
     return data
 
 
-def forecast_weather():
-    """Анализ погодных условий по городам."""
-    tasks = [
+async def process_tasks_async(tasks: TaskList):
+    """Асинхронный вариант process_tasks."""
+    data = None
+    for task, params in tasks:
+        data = await task(**_prepare_params(params, data)).worker_async()
+    return data
+
+
+def _forecast_weather_tasks(geo_api, weather_api) -> TaskList:
+    return [
         (
-            GeoDataFetchingTask,
+            CityLocatingTask,
             {
-                "api": YandexGeoAPI(),
-                "addresses": [city.name for city in city_service.get_multi()],
+                "cities": services.city_service.get_multi(),
+                "api": geo_api,
+                "city_service": services.city_service,
+                "cache": services.geocoder_cache,
+                "executor": services.executor,
                 "_input": None,
             },
         ),
-        (GeoDataParsingTask, {"_input": "locations"}),
-        (DataFetchingTask, {"api": weather_api, "_input": "locations"}),
-        (DataCalculationTask, {"_input": "forecasts"}),
+        (
+            DataFetchingTask,
+            {
+                "api": weather_api,
+                "executor": services.executor,
+                "_input": "locations",
+            },
+        ),
+        (
+            DataCalculationTask,
+            {"executor": services.executor, "_input": "forecasts"},
+        ),
         (DataAggregationTask, {"_input": "city_aggregations"}),
-        (DataAnalyzingTask, {"_input": "cities"}),
+        (
+            DataAnalyzingTask,
+            {"executor": services.executor, "_input": "cities"},
+        ),
     ]
-    return process_tasks(tasks)
 
 
-def get_weather(location: str) -> Dict[str, Any]:
-    tasks = [
+def _locate_place_tasks(location: str, geo_api) -> TaskList:
+    return [
         (
             GeoDataFetchingTask,
-            {"api": YandexGeoAPI(), "addresses": (location,), "_input": None},
+            {
+                "api": geo_api,
+                "addresses": (location,),
+                "cache": services.geocoder_cache,
+                "executor": services.executor,
+                "_input": None,
+            },
+        ),
+        (
+            GeoDataParsingTask,
+            {
+                "cache": services.geocoder_cache,
+                "executor": services.executor,
+                "_input": "locations",
+            },
         ),
-        (GeoDataParsingTask, {"_input": "locations"}),
-        (DataFetchingTask, {"api": weather_api, "_input": "locations"}),
-        (DataCalculationTask, {"_input": "forecasts"}),
     ]
-    result: List[Dict[str, Any]] = process_tasks(tasks)
-    return result.pop()
 
 
-def get_weather_by_position(
-    latitude: float, longitude: float
-) -> Dict[str, Any]:
-    """Calculate weather for a location."""
-    tasks = [
+def _get_weather_by_position_tasks(
+    latitude: float, longitude: float, weather_api
+) -> TaskList:
+    return [
         (
             DataFetchingTask,
-            {"api": weather_api, "locations": ((latitude, longitude),)},
+            {
+                "api": weather_api,
+                "locations": ((latitude, longitude),),
+                "executor": services.executor,
+            },
+        ),
+        (
+            DataCalculationTask,
+            {"executor": services.executor, "_input": "forecasts"},
         ),
-        (DataCalculationTask, {"_input": "forecasts"}),
     ]
-    result: List[Dict[str, Any]] = process_tasks(tasks)
+
+
+def forecast_weather():
+    """Анализ погодных условий по городам."""
+    return process_tasks(
+        _forecast_weather_tasks(services.geo_api, services.weather_api)
+    )
+
+
+async def rate_cities_async() -> List[CityForecast]:
+    """
+    Рейтинг городов без блокировки цикла событий.
+    Каждый город независимо проходит геокодирование и загрузку прогноза,
+    так что этапы выполняются одновременно для разных городов.
+    Расчёт идёт после загрузки сразу по всем городам в отдельном потоке,
+    векторно через NumPy или в пуле процессов.
+    """
+    await services.load_async(
+        "city_service",
+        "geocoder_cache",
+        "async_geo_api",
+        "async_weather_api",
+        "executor",
+    )
+    locating = CityLocatingTask(
+        cities=await asyncio.to_thread(services.city_service.get_multi),
+        api=services.async_geo_api,
+        city_service=services.city_service,
+        cache=services.geocoder_cache,
+        executor=services.executor,
+    )
+    fetching = DataFetchingTask(api=services.async_weather_api, locations=[])
+    pipeline = StreamingPipeline(
+        [
+            Stage(
+                "locate",
+                locating.locate_async,
+                PIPELINE_GEOCODING_CONCURRENCY,
+            ),
+            Stage(
+                "fetch",
+                fetching.load_url_async,
+                PIPELINE_FETCHING_CONCURRENCY,
+            ),
+        ],
+        buffer_size=PIPELINE_BUFFER_SIZE,
+    )
+    forecasts = await pipeline.run(locating.cities)
+    city_aggregations = await DataCalculationTask(
+        forecasts, executor=services.executor
+    ).worker_async()
+    await asyncio.to_thread(locating.save_resolved)
+    if locating.resolved:
+        # Rebuild with the new coordinates on next use
+        services.reset("spatial_index")
+    return await DataAggregationTask(
+        city_aggregations=city_aggregations
+    ).worker_async()
+
+
+async def forecast_weather_async():
+    """Анализ погодных условий по городам без блокировки цикла событий."""
+    return await DataAnalyzingTask(
+        cities=await rate_cities_async(), executor=services.executor
+    ).worker_async()
+
+
+def _place_key(location: str) -> Tuple[str, str]:
+    return "place", normalize_address(location)
+
+
+def _position_key(
+    latitude: float, longitude: float
+) -> Tuple[str, Tuple[float, float]]:
+    return "position", quantize_coordinates(
+        latitude, longitude, FORECAST_CACHE_GRID
+    )
+
+
+def _get_weather(location: str) -> Dict[str, Any]:
+    locations = process_tasks(
+        _locate_place_tasks(location, services.geo_api)
+    )
+    return _get_weather_by_position(*locations.pop())
+
+
+def analyze_cities(cities: List[CityForecast]) -> DataAnalyzingTask:
+    return DataAnalyzingTask(cities, services.executor)
+
+
+report_service = ReportService(
+    rate_cities_async,
+    REPORT_REFRESH_INTERVAL,
+    export_format=REPORT_FORMAT,
+    analyze=analyze_cities,
+)
+metrics.watch_cache("report_export", report_service)
+
+
+def get_weather(location: str) -> Dict[str, Any]:
+    """Calculate weather for a place, sharing concurrent identical calls."""
+    return weather_flights.do(_place_key(location), _get_weather, location)
+
+
+async def _get_weather_async(location: str) -> Dict[str, Any]:
+    await services.load_async("geocoder_cache", "async_geo_api", "executor")
+    locations = await process_tasks_async(
+        _locate_place_tasks(location, services.async_geo_api)
+    )
+    return await _get_weather_by_position_async(*locations.pop())
+
+
+async def get_weather_async(location: str) -> Dict[str, Any]:
+    return await async_weather_flights.do(
+        _place_key(location), _get_weather_async, location
+    )
+
+
+def _find_stored(latitude: float, longitude: float) -> Optional[Dict]:
+    """Forecast calculated by any bot replica, if it is still fresh."""
+    if services.forecast_store is None:
+        return None
+    try:
+        return services.forecast_store.find(latitude, longitude)
+    except PyMongoError as error:
+        logger.warning(WARNING_STORE.format(error=error))
+        return None
+
+
+def _store(forecast: CityForecast) -> None:
+    if services.forecast_store is None:
+        return
+    try:
+        services.forecast_store.save(forecast)
+    except PyMongoError as error:
+        logger.warning(WARNING_STORE.format(error=error))
+
+
+def _first_forecast(
+    result: List[CityForecast], latitude: float, longitude: float
+) -> CityForecast:
+    """Прогноз места; RuntimeError, если его не удалось получить."""
+    if not result:
+        raise RuntimeError(
+            ERROR_NO_FORECAST.format(latitude=latitude, longitude=longitude)
+        )
     return result.pop()
 
 
+def _get_weather_by_position(
+    latitude: float, longitude: float
+) -> Dict[str, Any]:
+    if (weather := _find_stored(latitude, longitude)) is not None:
+        return weather
+    result: List[CityForecast] = process_tasks(
+        _get_weather_by_position_tasks(
+            latitude, longitude, services.weather_api
+        )
+    )
+    forecast = _first_forecast(result, latitude, longitude)
+    _store(forecast)
+    return forecast.to_dict()
+
+
+def get_weather_by_position(
+    latitude: float, longitude: float
+) -> Dict[str, Any]:
+    """Calculate weather for a location."""
+    latitude, longitude = snap_position(latitude, longitude)
+    return weather_flights.do(
+        _position_key(latitude, longitude),
+        _get_weather_by_position,
+        latitude,
+        longitude,
+    )
+
+
+async def _get_weather_by_position_async(
+    latitude: float, longitude: float
+) -> Dict[str, Any]:
+    await services.load_async(
+        "forecast_store", "async_weather_api", "executor"
+    )
+    if (
+        weather := await asyncio.to_thread(_find_stored, latitude, longitude)
+    ) is not None:
+        return weather
+    result: List[CityForecast] = await process_tasks_async(
+        _get_weather_by_position_tasks(
+            latitude, longitude, services.async_weather_api
+        )
+    )
+    forecast = _first_forecast(result, latitude, longitude)
+    await asyncio.to_thread(_store, forecast)
+    return forecast.to_dict()
+
+
+async def get_weather_by_position_async(
+    latitude: float, longitude: float
+) -> Dict[str, Any]:
+    """Calculate weather for a location without blocking the event loop."""
+    latitude, longitude = await asyncio.to_thread(
+        snap_position, latitude, longitude
+    )
+    return await async_weather_flights.do(
+        _position_key(latitude, longitude),
+        _get_weather_by_position_async,
+        latitude,
+        longitude,
+    )
+
+
+async def shutdown() -> None:
+    """Release pooled upstream connections and stop executors."""
+    await close_async_clients()
+    if services.is_loaded("executor"):
+        await asyncio.to_thread(services.executor.shutdown)
+        # A closed executor takes no tasks: build a new one on next use
+        services.reset("executor")
+
+
 if __name__ == "__main__":
     logging.basicConfig(
         format="[%(levelname)s] - %(asctime)s - %(message)s",
@@ -89,7 +387,12 @@ if __name__ == "__main__":
         datefmt="%H:%M:%S",
     )
 
-    dataset = forecast_weather()
-    # Write spreadsheet to disk
-    with open("forecasts.xls", "wb") as f:
-        f.write(dataset.export("xls"))
+    export_format = sys.argv[1] if len(sys.argv) > 1 else "xls"
+    if export_format not in exporting.FORMATS:
+        sys.exit(f"Usage: forecasting.py [{'|'.join(exporting.FORMATS)}]")
+    tasks = _forecast_weather_tasks(services.geo_api, services.weather_api)
+    cities = process_tasks(tasks[:-1])
+    # Write report to disk row by row
+    with open(f"forecasts.{export_format}", "wb") as f:
+        DataAnalyzingTask(cities, services.executor).write(f, export_format)
+    services.executor.shutdown()
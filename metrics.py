@@ -0,0 +1,376 @@
+"""
+Process metrics in Prometheus text format.
+
+Metrics are collected only when METRICS_ENABLED is set;
+otherwise every metric is a no-op and tasks are not wrapped at all.
+"""
+import abc
+import asyncio
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from settings import METRICS_ENABLED, METRICS_HOST, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return (
+        value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    )
+
+
+def _format_labels(names: Labels, values: Labels) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(str(value))}"'
+        for name, value in zip(names, values)
+    )
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    return "+Inf" if value == float("inf") else repr(value)
+
+
+class Metric(abc.ABC):
+    type = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Labels = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _header(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+
+    def _sample(
+        self,
+        value: float,
+        labels: Labels,
+        suffix: str = "",
+        extra: Tuple[Tuple[str, str], ...] = (),
+    ) -> str:
+        names = self.labelnames + tuple(name for name, _ in extra)
+        values = labels + tuple(value for _, value in extra)
+        return (
+            f"{self.name}{suffix}{_format_labels(names, values)}"
+            f" {_format_value(value)}"
+        )
+
+    @abc.abstractmethod
+    def collect(self) -> List[str]:
+        pass
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Labels, float] = defaultdict(float)
+
+    def inc(self, *labels: Any, amount: float = 1.0) -> None:
+        key = tuple(str(label) for label in labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return self._header() + [
+            self._sample(value, labels) for labels, value in values.items()
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # Per labels: counts of observations by bucket and their sum
+        self._counts: Dict[Labels, List[int]] = {}
+        self._sums: Dict[Labels, float] = defaultdict(float)
+
+    def observe(self, value: float, *labels: Any) -> None:
+        key = tuple(str(label) for label in labels)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * len(self.buckets)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._sums[key] += value
+
+    @contextmanager
+    def time(self, *labels: Any) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            counts = {key: list(value) for key, value in self._counts.items()}
+            sums = dict(self._sums)
+        lines = self._header()
+        for labels, bucket_counts in counts.items():
+            total = 0
+            for bound, count in zip(self.buckets, bucket_counts):
+                total += count
+                le = (("le", _format_value(bound)),)
+                lines.append(self._sample(total, labels, "_bucket", le))
+            lines.append(self._sample(sums[labels], labels, "_sum"))
+            lines.append(self._sample(total, labels, "_count"))
+        return lines
+
+
+class CallbackCounter(Metric):
+    """Counter read from other objects when metrics are collected."""
+
+    type = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._sources: Dict[Labels, Callable[[], float]] = {}
+
+    def add_source(self, func: Callable[[], float], *labels: Any) -> None:
+        with self._lock:
+            self._sources[tuple(str(label) for label in labels)] = func
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            sources = dict(self._sources)
+        return self._header() + [
+            self._sample(func(), labels) for labels, func in sources.items()
+        ]
+
+
+class NullMetric:
+    """Stand-in for every metric when collecting is turned off."""
+
+    def inc(self, *labels: Any, amount: float = 1.0) -> None:
+        pass
+
+    def observe(self, value: float, *labels: Any) -> None:
+        pass
+
+    def time(self, *labels: Any):
+        return nullcontext()
+
+    def add_source(self, func: Callable[[], float], *labels: Any) -> None:
+        pass
+
+
+class Registry:
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.metrics: List[Metric] = []
+
+    def _register(self, metric_class: type, *args, **kwargs):
+        if not self.enabled:
+            return NullMetric()
+        metric = metric_class(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames=(),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        return self._register(
+            Histogram, name, documentation, labelnames, buckets=buckets
+        )
+
+    def callback_counter(self, name: str, documentation: str, labelnames=()):
+        return self._register(
+            CallbackCounter, name, documentation, labelnames
+        )
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.collect())
+            except Exception:
+                logger.exception(f"Metric {metric.name} is not collected")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry(METRICS_ENABLED)
+
+TASK_DURATION = REGISTRY.histogram(
+    "weather_task_duration_seconds",
+    "Duration of Task.worker runs",
+    ("task",),
+)
+TASK_ITEMS = REGISTRY.counter(
+    "weather_task_items_total", "Items returned by tasks", ("task",)
+)
+TASK_FAILURES = REGISTRY.counter(
+    "weather_task_failures_total", "Task runs which raised", ("task",)
+)
+PIPELINE_STAGE_DURATION = REGISTRY.histogram(
+    "weather_pipeline_stage_duration_seconds",
+    "Time one item spends in a streaming pipeline stage",
+    ("stage",),
+)
+UPSTREAM_REQUESTS = REGISTRY.counter(
+    "weather_upstream_requests_total",
+    "Requests to Yandex APIs by response status",
+    ("api", "status"),
+)
+UPSTREAM_DURATION = REGISTRY.histogram(
+    "weather_upstream_request_duration_seconds",
+    "Duration of single requests to Yandex APIs",
+    ("api",),
+)
+UPSTREAM_RECEIVED_BYTES = REGISTRY.counter(
+    "weather_upstream_received_bytes_total",
+    "Response body bytes received from Yandex APIs, before decompression",
+    ("api",),
+)
+UPSTREAM_RETRIES = REGISTRY.counter(
+    "weather_upstream_retries_total",
+    "Retried requests to Yandex APIs",
+    ("api",),
+)
+CACHE_LOOKUPS = REGISTRY.callback_counter(
+    "weather_cache_lookups_total", "Cache lookups", ("cache", "result")
+)
+REPORT_DURATION = REGISTRY.histogram(
+    "weather_report_duration_seconds",
+    "Duration of report refresh steps",
+    ("step",),
+)
+SENT_MESSAGES = REGISTRY.counter(
+    "weather_sent_messages_total",
+    "Messages of the send queue by result",
+    ("result",),
+)
+SUBSCRIPTION_GROUPS = REGISTRY.counter(
+    "weather_subscription_groups_total",
+    "Forecasts fetched for groups of subscribers",
+    ("result",),
+)
+
+
+def watch_cache(name: str, cache: Any) -> None:
+    """Export hits and misses of a cache with `stats()`."""
+    CACHE_LOOKUPS.add_source(lambda: cache.stats()["hits"], name, "hit")
+    CACHE_LOOKUPS.add_source(lambda: cache.stats()["misses"], name, "miss")
+
+
+def _count_items(task: str, result: Any) -> None:
+    try:
+        TASK_ITEMS.inc(task, amount=len(result))
+    except TypeError:
+        pass
+
+
+def instrument_task(func: Callable, task: str) -> Callable:
+    """Record duration, returned items and failures of a task method."""
+    if asyncio.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                with TASK_DURATION.time(task):
+                    result = await func(*args, **kwargs)
+            except Exception:
+                TASK_FAILURES.inc(task)
+                raise
+            _count_items(task, result)
+            return result
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            with TASK_DURATION.time(task):
+                result = func(*args, **kwargs)
+        except Exception:
+            TASK_FAILURES.inc(task)
+            raise
+        _count_items(task, result)
+        return result
+
+    return wrapper
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(
+    host: str = METRICS_HOST, port: int = METRICS_PORT
+) -> Optional[ThreadingHTTPServer]:
+    """Serve /metrics in a background thread; None if metrics are off."""
+    if not REGISTRY.enabled:
+        return None
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="metrics", daemon=True
+    ).start()
+    logger.info(f"Metrics are served on http://{host}:{port}/metrics")
+    return server
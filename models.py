@@ -0,0 +1,161 @@
+"""Compact forecast structures passed between tasks."""
+from array import array
+from dataclasses import dataclass
+from operator import itemgetter
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from constants import CONDITIONS
+
+UNKNOWN_CODE = -1
+
+
+class Codes(dict):
+    def __missing__(self, key: Any) -> int:
+        return UNKNOWN_CODE
+
+
+CONDITION_CODES = Codes(
+    (condition, code) for code, condition in enumerate(CONDITIONS)
+)
+# API returns hours as strings
+HOUR_CODES = Codes(
+    [(str(hour), hour) for hour in range(24)]
+    + [(hour, hour) for hour in range(24)]
+)
+get_hour = itemgetter("hour")
+get_temp = itemgetter("temp")
+get_condition = itemgetter("condition")
+
+Location = Any
+Day = Tuple[str, array, array, array]
+
+
+@dataclass(slots=True)
+class HourlyBlock:
+    """
+    Hourly forecast of one location packed into arrays.
+    Hours of all days follow each other; `day_sizes` splits them by day.
+    Hours and conditions are stored as codes, unknown values as -1.
+    """
+
+    location: Location
+    city: str
+    dates: Tuple[str, ...]
+    day_sizes: array
+    hours: array
+    temps: array
+    conditions: array
+
+    @classmethod
+    def from_response(
+        cls, location: Location, response: Dict[str, Any]
+    ) -> "HourlyBlock":
+        """Pack a weather API response."""
+        dates = []
+        day_sizes = array("l")
+        hours, temps, conditions = array("b"), array("d"), array("b")
+        for forecast in response["forecasts"]:
+            day_hours = forecast["hours"]
+            dates.append(forecast["date"])
+            day_sizes.append(len(day_hours))
+            hours.extend(map(HOUR_CODES.__getitem__, map(get_hour, day_hours)))
+            temps.extend(map(get_temp, day_hours))
+            conditions.extend(
+                map(
+                    CONDITION_CODES.__getitem__,
+                    map(get_condition, day_hours),
+                )
+            )
+        return cls(
+            location=location,
+            city=response["geo_object"]["locality"]["name"],
+            dates=tuple(dates),
+            day_sizes=day_sizes,
+            hours=hours,
+            temps=temps,
+            conditions=conditions,
+        )
+
+    def days(self) -> Iterator[Day]:
+        """Date with hours, temperatures and conditions of every day."""
+        start = 0
+        for date, size in zip(self.dates, self.day_sizes):
+            end = start + size
+            yield (
+                date,
+                self.hours[start:end],
+                self.temps[start:end],
+                self.conditions[start:end],
+            )
+            start = end
+
+
+@dataclass(slots=True)
+class CityForecast:
+    """Calculated weather of a city: one column entry per forecast day."""
+
+    city: str
+    location: Location
+    dates: Tuple[str, ...]
+    temperature_avg: array
+    pleasant_hours: array
+    temperature_total_avg: float
+    hours_total_avg: float
+    rating: Optional[int] = None
+
+    @property
+    def forecast_days(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            date: {"temperature_avg": temperature, "pleasant_hours": hours}
+            for date, temperature, hours in zip(
+                self.dates, self.temperature_avg, self.pleasant_hours
+            )
+        }
+
+    def __reduce__(self) -> Tuple[Any, tuple]:
+        # Columns as tuples: no field names and array headers per city,
+        # which made a pickle larger than the one of to_dict
+        return _restore_city_forecast, (
+            self.city,
+            self.location,
+            self.dates,
+            tuple(self.temperature_avg),
+            tuple(self.pleasant_hours),
+            self.temperature_total_avg,
+            self.hours_total_avg,
+            self.rating,
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            "city": self.city,
+            "location": self.location,
+            "forecast_days": self.forecast_days,
+            "temperature_total_avg": self.temperature_total_avg,
+            "hours_total_avg": self.hours_total_avg,
+        }
+        if self.rating is not None:
+            data["rating"] = self.rating
+        return data
+
+
+def _restore_city_forecast(
+    city: str,
+    location: Location,
+    dates: Tuple[str, ...],
+    temperature_avg: Tuple[float, ...],
+    pleasant_hours: Tuple[int, ...],
+    temperature_total_avg: float,
+    hours_total_avg: float,
+    rating: Optional[int],
+) -> CityForecast:
+    return CityForecast(
+        city,
+        location,
+        dates,
+        array("d", temperature_avg),
+        array("i", pleasant_hours),
+        temperature_total_avg,
+        hours_total_avg,
+        rating,
+    )
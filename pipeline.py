@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, List
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    """
+    Step of a streaming pipeline.
+    `func` handles one item and may be a coroutine function;
+    None result drops the item.
+    """
+
+    name: str
+    func: Callable[[Any], Any]
+    concurrency: int = 1
+
+
+class StreamingPipeline:
+    """
+    Moves every item through all stages on its own.
+    Stages are connected with bounded queues: a stage waits
+    when the next one falls behind, so memory stays bounded.
+    """
+
+    def __init__(self, stages: List[Stage], buffer_size: int = 100) -> None:
+        self.stages = stages
+        self.buffer_size = buffer_size
+
+    async def _feed(self, items: Iterable[Any], queue: asyncio.Queue) -> None:
+        for item in items:
+            await queue.put(item)
+        await queue.put(_DONE)
+
+    async def _apply(self, stage: Stage, item: Any) -> Any:
+        with metrics.PIPELINE_STAGE_DURATION.time(stage.name):
+            if asyncio.iscoroutinefunction(stage.func):
+                return await stage.func(item)
+            return stage.func(item)
+
+    async def _run_stage(
+        self, stage: Stage, queue_in: asyncio.Queue, queue_out: asyncio.Queue
+    ) -> None:
+        async def work() -> None:
+            while (item := await queue_in.get()) is not _DONE:
+                if (result := await self._apply(stage, item)) is not None:
+                    await queue_out.put(result)
+            # Let the other workers of the stage see the end of input
+            await queue_in.put(_DONE)
+
+        await asyncio.gather(*(work() for _ in range(stage.concurrency)))
+        await queue_out.put(_DONE)
+
+    async def _collect(self, queue: asyncio.Queue) -> List[Any]:
+        results = []
+        while (item := await queue.get()) is not _DONE:
+            results.append(item)
+        return results
+
+    async def run(self, items: Iterable[Any]) -> List[Any]:
+        """Results of the last stage in order of completion."""
+        queues = [
+            asyncio.Queue(self.buffer_size)
+            for _ in range(len(self.stages) + 1)
+        ]
+        jobs = [
+            asyncio.ensure_future(self._feed(items, queues[0])),
+            *(
+                asyncio.ensure_future(
+                    self._run_stage(stage, queues[index], queues[index + 1])
+                )
+                for index, stage in enumerate(self.stages)
+            ),
+        ]
+        collecting = asyncio.ensure_future(self._collect(queues[-1]))
+        try:
+            await asyncio.gather(*jobs, collecting)
+        finally:
+            for job in (*jobs, collecting):
+                job.cancel()
+        return collecting.result()
@@ -0,0 +1,190 @@
+import asyncio
+import heapq
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+)
+
+import exporting
+import metrics
+from coalescing import AsyncSingleFlight
+from models import CityForecast
+from settings import BEST_WEATHER_TOP_MAX
+from tasks import DataAnalyzingTask
+
+logger = logging.getLogger(__name__)
+
+
+class RankedCity(NamedTuple):
+    name: str
+    hours_total_avg: float
+    temperature_total_avg: float
+
+
+def select_best_cities(
+    cities: Sequence[CityForecast], count: int
+) -> List[RankedCity]:
+    """
+    Best `count` cities in the order of DataAggregationTask:
+    more pleasant hours, then higher temperature, then earlier in the list.
+    A heap of `count` cities is kept instead of sorting all of them.
+    """
+    best = heapq.nlargest(
+        count,
+        (
+            (city.hours_total_avg, city.temperature_total_avg, -number)
+            for number, city in enumerate(cities)
+        ),
+    )
+    return [
+        RankedCity(cities[-number].city.lower().title(), hours, temperature)
+        for hours, temperature, number in best
+    ]
+
+
+@dataclass(frozen=True)
+class ReportSnapshot:
+    """Analyzed report kept in memory with its exports."""
+
+    analysis: DataAnalyzingTask
+    version: int
+    created_at: datetime
+    # Best cities first, up to BEST_WEATHER_TOP_MAX
+    best_cities: List[RankedCity]
+    # Encoded report by format, filled on first request
+    exports: Dict[str, bytes] = field(default_factory=dict, repr=False)
+
+    def top(self, count: int) -> List[RankedCity]:
+        return self.best_cities[:count]
+
+
+class ReportService:
+    """
+    Rebuilds the best weather report on an interval
+    and serves the latest snapshot from memory.
+    A snapshot is encoded once per format: the default format
+    before it is published, others when first requested.
+    Where `run` is not started, the report is built when it is asked
+    for, and a snapshot older than `interval` is rebuilt in background.
+    """
+
+    def __init__(
+        self,
+        build: Callable[[], Awaitable[List[CityForecast]]],
+        interval: float,
+        export_format: str = "xls",
+        analyze: Callable[
+            [List[CityForecast]], DataAnalyzingTask
+        ] = DataAnalyzingTask,
+    ) -> None:
+        """
+        :param build: coroutine function returning rated cities
+        :param analyze: task writing the report of rated cities
+        """
+        if export_format not in exporting.FORMATS:
+            raise ValueError(
+                f"Unknown report format {export_format!r}, "
+                f"expected one of {', '.join(exporting.FORMATS)}"
+            )
+        self.build = build
+        self.analyze = analyze
+        self.interval = interval
+        self.export_format = export_format
+        self.snapshot: Optional[ReportSnapshot] = None
+        self._lock = asyncio.Lock()
+        self._encoding = AsyncSingleFlight()
+        self._running = False
+        self._background: Optional[asyncio.Task] = None
+        self.hits = self.misses = 0
+
+    async def _refresh(self) -> ReportSnapshot:
+        with metrics.REPORT_DURATION.time("build"):
+            cities = await self.build()
+        snapshot = ReportSnapshot(
+            analysis=self.analyze(cities),
+            version=self.snapshot.version + 1 if self.snapshot else 1,
+            created_at=datetime.now(),
+            best_cities=select_best_cities(cities, BEST_WEATHER_TOP_MAX),
+        )
+        await self._encode(snapshot, self.export_format)
+        self.snapshot = snapshot
+        logger.info(f"Report version {snapshot.version} is ready")
+        return snapshot
+
+    async def _encode(self, snapshot: ReportSnapshot, export_format: str):
+        with metrics.REPORT_DURATION.time("export"):
+            content = await asyncio.to_thread(
+                snapshot.analysis.export, export_format
+            )
+        snapshot.exports[export_format] = content
+        return content
+
+    async def export(
+        self, snapshot: ReportSnapshot, export_format: Optional[str] = None
+    ) -> bytes:
+        """
+        Report of the snapshot encoded in `export_format`.
+        Concurrent requests for a new format share one encoding.
+        """
+        export_format = export_format or self.export_format
+        if (content := snapshot.exports.get(export_format)) is not None:
+            self.hits += 1
+            return content
+        self.misses += 1
+        return await self._encoding.do(
+            (snapshot.version, export_format),
+            self._encode,
+            snapshot,
+            export_format,
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    async def refresh(self) -> ReportSnapshot:
+        async with self._lock:
+            return await self._refresh()
+
+    def _is_stale(self, snapshot: ReportSnapshot) -> bool:
+        age = (datetime.now() - snapshot.created_at).total_seconds()
+        return not self._running and age > self.interval
+
+    async def get(self) -> ReportSnapshot:
+        """Latest snapshot; the first caller waits for the initial build."""
+        if (snapshot := self.snapshot) is not None:
+            # The lock is taken only once the task runs, so check the task
+            if (
+                self._is_stale(snapshot)
+                and not self._lock.locked()
+                and (self._background is None or self._background.done())
+            ):
+                self._background = asyncio.create_task(self.refresh())
+                self._background.add_done_callback(self._log_failure)
+            return snapshot
+        async with self._lock:
+            if self.snapshot is None:
+                await self._refresh()
+            return self.snapshot
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Report refresh has failed: {task.exception()}")
+
+    async def run(self) -> None:
+        """Refresh the report forever."""
+        self._running = True
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Report refresh has failed")
+            await asyncio.sleep(self.interval)
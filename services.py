@@ -0,0 +1,165 @@
+"""Forecasting services built on first use."""
+import asyncio
+import threading
+from typing import Any, Callable, Dict, Optional, Union
+
+import metrics
+from api_client import (
+    AsyncYandexGeoAPI,
+    AsyncYandexWeatherAPI,
+    YandexGeoAPI,
+    YandexWeatherAPI,
+)
+from cache import FileCacheStore, GeocoderCache, MongoCacheStore, TTLCache
+from city_repository import CityRepository
+from executors import ExecutorService
+from forecast_repository import ForecastRepository
+from settings import (
+    FORECAST_CACHE_MAXSIZE,
+    FORECAST_CACHE_TTL,
+    FORECAST_REVALIDATION_MAXSIZE,
+    FORECAST_REVALIDATION_TTL,
+    FORECAST_STORE_BACKEND,
+    GEOCODER_CACHE_BACKEND,
+    GEOCODER_CACHE_FILE,
+    GEOCODER_CACHE_NEGATIVE_TTL,
+    GEOCODER_CACHE_TTL,
+    SPATIAL_INDEX_BACKEND,
+)
+from spatial import CitySpatialIndex, MongoCitySpatialIndex
+from subscription_repository import SubscriptionRepository
+
+
+class lazy:
+    """
+    Like functools.cached_property, but a value is built once
+    even when several threads ask for it at the same time.
+    """
+
+    def __init__(self, func: Callable[[Any], Any]) -> None:
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.name = name
+
+    def __get__(self, container: Any, owner: type = None) -> Any:
+        if container is None:
+            return self
+        # Built values are kept in the instance dict and found there
+        # before this descriptor is asked again. A service is built under
+        # its own lock, so a slow one does not hold up the others
+        with container._get_lock(self.name):
+            if self.name not in container.__dict__:
+                container.__dict__[self.name] = self.func(container)
+            return container.__dict__[self.name]
+
+
+class ServiceContainer:
+    """
+    Services of forecasting. Nothing is connected or loaded
+    until a service is used, so the bot starts without waiting
+    for MongoDB and the city catalog.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._locks: Dict[str, threading.RLock] = {}
+
+    def _get_lock(self, name: str) -> threading.RLock:
+        with self._lock:
+            return self._locks.setdefault(name, threading.RLock())
+
+    @lazy
+    def executor(self) -> ExecutorService:
+        return ExecutorService()
+
+    @lazy
+    def city_service(self) -> CityRepository:
+        return CityRepository.from_csv()
+
+    @lazy
+    def forecast_cache(self) -> TTLCache:
+        cache = TTLCache(FORECAST_CACHE_MAXSIZE, FORECAST_CACHE_TTL)
+        metrics.watch_cache("forecast", cache)
+        return cache
+
+    @lazy
+    def forecast_revalidation(self) -> TTLCache:
+        cache = TTLCache(
+            FORECAST_REVALIDATION_MAXSIZE, FORECAST_REVALIDATION_TTL
+        )
+        metrics.watch_cache("forecast_revalidation", cache)
+        return cache
+
+    @lazy
+    def forecast_store(self) -> Optional[ForecastRepository]:
+        if FORECAST_STORE_BACKEND == "mongo":
+            return ForecastRepository()
+        return None
+
+    @lazy
+    def geocoder_cache(self) -> GeocoderCache:
+        cache = GeocoderCache(
+            store=(
+                MongoCacheStore()
+                if GEOCODER_CACHE_BACKEND == "mongo"
+                else FileCacheStore(GEOCODER_CACHE_FILE)
+            ),
+            ttl=GEOCODER_CACHE_TTL,
+            negative_ttl=GEOCODER_CACHE_NEGATIVE_TTL,
+        )
+        metrics.watch_cache("geocoder", cache)
+        return cache
+
+    @lazy
+    def weather_api(self) -> YandexWeatherAPI:
+        return YandexWeatherAPI(
+            city_service=self.city_service,
+            cache=self.forecast_cache,
+            store=self.forecast_store,
+            validated=self.forecast_revalidation,
+        )
+
+    @lazy
+    def geo_api(self) -> YandexGeoAPI:
+        return YandexGeoAPI()
+
+    @lazy
+    def async_weather_api(self) -> AsyncYandexWeatherAPI:
+        return AsyncYandexWeatherAPI(
+            city_service=self.city_service,
+            cache=self.forecast_cache,
+            store=self.forecast_store,
+            validated=self.forecast_revalidation,
+        )
+
+    @lazy
+    def async_geo_api(self) -> AsyncYandexGeoAPI:
+        return AsyncYandexGeoAPI()
+
+    @lazy
+    def subscriptions(self) -> SubscriptionRepository:
+        return SubscriptionRepository()
+
+    @lazy
+    def spatial_index(self) -> Union[CitySpatialIndex, MongoCitySpatialIndex]:
+        if SPATIAL_INDEX_BACKEND == "mongo":
+            return MongoCitySpatialIndex(self.city_service)
+        return CitySpatialIndex(self.city_service.get_multi())
+
+    def reset(self, name: str) -> None:
+        """Build the service again on next use."""
+        with self._get_lock(name):
+            self.__dict__.pop(name, None)
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self.__dict__
+
+    async def load_async(self, *names: str) -> None:
+        """Build services in a worker thread, not in the event loop."""
+        if not all(map(self.is_loaded, names)):
+            await asyncio.to_thread(
+                lambda: [getattr(self, name) for name in names]
+            )
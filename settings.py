@@ -18,13 +18,150 @@ YANDEX_GEO_API_URL = os.getenv("YANDEX_GEO_API_URL")
 YANDEX_GEO_API_KEY = os.getenv("YANDEX_GEO_API_KEY")
 YANDEX_GEO_API_LANGUAGE = os.getenv("YANDEX_GEO_API_LANGUAGE", "ru_RU")
 
+# Client-side limits: requests per second, burst size and requests in flight.
+# They are shared by sync and async clients of an API in one process;
+# every process, e.g. every webhook worker, has limits of its own
+YANDEX_WEATHER_API_RATE = float(os.getenv("YANDEX_WEATHER_API_RATE", 10))
+YANDEX_WEATHER_API_BURST = float(os.getenv("YANDEX_WEATHER_API_BURST", 20))
+YANDEX_WEATHER_API_CONCURRENCY = int(
+    os.getenv("YANDEX_WEATHER_API_CONCURRENCY", 10)
+)
+YANDEX_GEO_API_RATE = float(os.getenv("YANDEX_GEO_API_RATE", 10))
+YANDEX_GEO_API_BURST = float(os.getenv("YANDEX_GEO_API_BURST", 20))
+YANDEX_GEO_API_CONCURRENCY = int(os.getenv("YANDEX_GEO_API_CONCURRENCY", 10))
+# Retries of 429/5xx responses and timeouts with exponential backoff
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", 4))
+RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF", 0.5))
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", 30))
+
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 10))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(
+    os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", 20)
+)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 10)
+)
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30))
+
+# Forecasts for coordinates within one grid cell share a cache entry
+FORECAST_CACHE_GRID = float(os.getenv("FORECAST_CACHE_GRID", 0.05))
+FORECAST_CACHE_TTL = float(os.getenv("FORECAST_CACHE_TTL", 600))
+FORECAST_CACHE_MAXSIZE = int(os.getenv("FORECAST_CACHE_MAXSIZE", 10000))
+# Forecast responses are kept with their ETag/Last-Modified longer than in
+# the cache: an unchanged forecast is then revalidated, not downloaded
+FORECAST_REVALIDATION_TTL = float(
+    os.getenv("FORECAST_REVALIDATION_TTL", 6 * 3600)
+)
+FORECAST_REVALIDATION_MAXSIZE = int(
+    os.getenv("FORECAST_REVALIDATION_MAXSIZE", FORECAST_CACHE_MAXSIZE)
+)
+
+# User positions closer than SNAP_DISTANCE_KM to a known city are replaced
+# with the city coordinates (0 disables). Index is kept in memory ("memory")
+# or uses 2dsphere index of the cities collection ("mongo")
+SNAP_DISTANCE_KM = float(os.getenv("SNAP_DISTANCE_KM", 10))
+SPATIAL_INDEX_BACKEND = os.getenv("SPATIAL_INDEX_BACKEND", "memory")
+
+# "vectorized" (NumPy, single process) or "pool" (process per CPU)
+CALCULATION_MODE = os.getenv("CALCULATION_MODE", "vectorized")
+
+# Shared pools of tasks: threads for requests, processes for calculations
+# (0 - one per CPU). Fewer items than EXECUTOR_CPU_THRESHOLD are calculated
+# without processes
+EXECUTOR_IO_WORKERS = int(os.getenv("EXECUTOR_IO_WORKERS", 32))
+EXECUTOR_CPU_WORKERS = int(os.getenv("EXECUTOR_CPU_WORKERS", 0))
+EXECUTOR_CPU_THRESHOLD = int(os.getenv("EXECUTOR_CPU_THRESHOLD", 100))
+
+# Streaming /best_weather pipeline: queue size and requests in flight
+PIPELINE_BUFFER_SIZE = int(os.getenv("PIPELINE_BUFFER_SIZE", 100))
+PIPELINE_GEOCODING_CONCURRENCY = int(
+    os.getenv("PIPELINE_GEOCODING_CONCURRENCY", 10)
+)
+PIPELINE_FETCHING_CONCURRENCY = int(
+    os.getenv("PIPELINE_FETCHING_CONCURRENCY", 20)
+)
+
+# How often the /best_weather report is rebuilt, seconds
+REPORT_REFRESH_INTERVAL = float(os.getenv("REPORT_REFRESH_INTERVAL", 30 * 60))
+# Format of the report file: xlsx, xls (up to 65536 rows), csv or json
+REPORT_FORMAT = os.getenv("REPORT_FORMAT", "xlsx")
+# Largest N of "/best_weather N", answered with a text message
+BEST_WEATHER_TOP_MAX = int(os.getenv("BEST_WEATHER_TOP_MAX", 50))
+
+# Daily forecasts of /subscribe. Times are local to SUBSCRIPTION_TIMEZONE and
+# delivered in slots of SUBSCRIPTION_SLOT_MINUTES, at the start of a slot;
+# subscribers within one SUBSCRIPTION_GRID-degree cell share one forecast
+SUBSCRIPTION_TIMEZONE = os.getenv("SUBSCRIPTION_TIMEZONE", "Europe/Moscow")
+SUBSCRIPTION_DEFAULT_TIME = os.getenv("SUBSCRIPTION_DEFAULT_TIME", "08:00")
+SUBSCRIPTION_SLOT_MINUTES = int(os.getenv("SUBSCRIPTION_SLOT_MINUTES", 10))
+SUBSCRIPTION_GRID = float(os.getenv("SUBSCRIPTION_GRID", 0.1))
+SUBSCRIPTION_FETCH_CONCURRENCY = int(
+    os.getenv("SUBSCRIPTION_FETCH_CONCURRENCY", 10)
+)
+# Telegram limits of bot messages: about SEND_RATE per second overall and
+# one per SEND_CHAT_INTERVAL seconds to a chat; SEND_CONCURRENCY in flight
+SEND_RATE = float(os.getenv("SEND_RATE", 30))
+SEND_CHAT_INTERVAL = float(os.getenv("SEND_CHAT_INTERVAL", 1))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", 30))
+
+# Updates are received by "polling" or "webhook". Webhook is served by
+# WEBHOOK_WORKERS processes on one port; Telegram posts updates to
+# WEBHOOK_URL + WEBHOOK_PATH with WEBHOOK_SECRET in a header
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 1))
+# Connections Telegram opens to the webhook at the same time
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+
+# Prometheus text metrics on http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "False") == "True"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+
 DATA_ROOT = os.getenv("DATA_ROOT", "./data")
 DATA_FILE = "cities_data_debug.csv" if DEBUG else "cities_data.csv"
+# Binary copy of the cities file for fast loading; empty value turns it off
+CITIES_SNAPSHOT_FILE = os.getenv(
+    "CITIES_SNAPSHOT_FILE", f"{DATA_ROOT}/{DATA_FILE}.snapshot"
+)
 
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017/")
 MONGODB_DBNAME = os.getenv("MONGODB_DBNAME", "weather")
 USE_MONGODB = os.getenv("USE_MONGODB", "False") == "True"
 
+# Geocoder results are stored in MongoDB ("mongo") or in a local file ("file")
+GEOCODER_CACHE_BACKEND = os.getenv(
+    "GEOCODER_CACHE_BACKEND", "mongo" if USE_MONGODB else "file"
+)
+GEOCODER_CACHE_FILE = os.getenv(
+    "GEOCODER_CACHE_FILE", f"{DATA_ROOT}/geocoder_cache.json"
+)
+GEOCODER_CACHE_TTL = float(os.getenv("GEOCODER_CACHE_TTL", 30 * 24 * 60 * 60))
+GEOCODER_CACHE_NEGATIVE_TTL = float(
+    os.getenv("GEOCODER_CACHE_NEGATIVE_TTL", 24 * 60 * 60)
+)
+
+# Calculated forecasts and API responses shared by bot replicas in MongoDB
+# ("mongo"), or not shared ("none")
+FORECAST_STORE_BACKEND = os.getenv(
+    "FORECAST_STORE_BACKEND", "mongo" if USE_MONGODB else "none"
+)
+FORECAST_STORE_TTL = float(os.getenv("FORECAST_STORE_TTL", FORECAST_CACHE_TTL))
+FORECAST_STORE_RESPONSES = (
+    os.getenv("FORECAST_STORE_RESPONSES", "True") == "True"
+)
+
+# Conversation states are kept in process memory ("memory") or in MongoDB
+# ("mongo"), which lets any webhook worker continue a conversation
+CONVERSATION_STORE_BACKEND = os.getenv(
+    "CONVERSATION_STORE_BACKEND", "mongo" if USE_MONGODB else "memory"
+)
+
 
 def check_python_version():
     import sys
@@ -0,0 +1,173 @@
+"""Nearest known city lookups by coordinates."""
+import heapq
+import math
+from typing import Iterable, List, Optional, Tuple
+
+from city_repository import City, CityRepository
+
+EARTH_RADIUS_KM = 6371.0088
+
+Point = Tuple[float, float, float]
+
+
+def to_point(latitude: float, longitude: float) -> Point:
+    """Unit vector of a position on the sphere."""
+    phi, lam = math.radians(latitude), math.radians(longitude)
+    return (
+        math.cos(phi) * math.cos(lam),
+        math.cos(phi) * math.sin(lam),
+        math.sin(phi),
+    )
+
+
+def chord_to_km(chord: float) -> float:
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def km_to_chord(distance: float) -> float:
+    return 2 * math.sin(min(math.pi, distance / EARTH_RADIUS_KM) / 2)
+
+
+class CitySpatialIndex:
+    """
+    In-memory k-d tree over unit vectors of city positions.
+    Straight-line distance between unit vectors grows with
+    great-circle distance, so the tree needs no special cases
+    for poles and the antimeridian.
+    """
+
+    def __init__(self, cities: Iterable[City]) -> None:
+        self.cities = [
+            city
+            for city in cities
+            if city.latitude is not None and city.longitude is not None
+        ]
+        self.points = [
+            to_point(city.latitude, city.longitude) for city in self.cities
+        ]
+        # Tree is stored implicitly: median of a range is the node,
+        # left and right halves are its subtrees
+        self.order = list(range(len(self.points)))
+        self.axes = [0] * len(self.points)
+        self._build()
+
+    def __len__(self) -> int:
+        return len(self.cities)
+
+    def _build(self) -> None:
+        stack = [(0, len(self.order), 0)]
+        while stack:
+            low, high, depth = stack.pop()
+            if high - low <= 0:
+                continue
+            axis = depth % 3
+            self.order[low:high] = sorted(
+                self.order[low:high], key=lambda i: self.points[i][axis]
+            )
+            middle = (low + high) // 2
+            self.axes[middle] = axis
+            stack.append((low, middle, depth + 1))
+            stack.append((middle + 1, high, depth + 1))
+
+    def _search(
+        self, target: Point, k: int, max_chord: float
+    ) -> List[Tuple[float, int]]:
+        """Up to k nearest (squared chord, city number) within max_chord."""
+        if k <= 0 or not self.order:
+            return []
+        # Max-heap of the best candidates by negated squared distance
+        best: List[Tuple[float, int]] = []
+        limit = max_chord * max_chord
+        # Ranges to visit with squared distance to their splitting plane
+        stack = [(0, len(self.order), 0.0)]
+        while stack:
+            low, high, plane_distance = stack.pop()
+            bound = -best[0][0] if len(best) == k else limit
+            if high - low <= 0 or plane_distance > bound:
+                continue
+            middle = (low + high) // 2
+            index = self.order[middle]
+            point = self.points[index]
+            distance = (
+                (point[0] - target[0]) ** 2
+                + (point[1] - target[1]) ** 2
+                + (point[2] - target[2]) ** 2
+            )
+            if distance <= bound:
+                heapq.heappush(best, (-distance, index))
+                if len(best) > k:
+                    heapq.heappop(best)
+            axis = self.axes[middle]
+            delta = target[axis] - point[axis]
+            if delta < 0:
+                near, far = (low, middle), (middle + 1, high)
+            else:
+                near, far = (middle + 1, high), (low, middle)
+            # Far side is pushed first, so the near side is visited first
+            stack.append((*far, delta * delta))
+            stack.append((*near, 0.0))
+        return sorted((-distance, index) for distance, index in best)
+
+    def _result(
+        self, found: List[Tuple[float, int]]
+    ) -> List[Tuple[City, float]]:
+        return [
+            (self.cities[index], chord_to_km(math.sqrt(distance)))
+            for distance, index in found
+        ]
+
+    def nearest(
+        self, latitude: float, longitude: float, k: int = 1
+    ) -> List[Tuple[City, float]]:
+        """k nearest cities with distances in km, closest first."""
+        return self._result(
+            self._search(to_point(latitude, longitude), k, 2.0)
+        )
+
+    def within(
+        self, latitude: float, longitude: float, radius: float
+    ) -> List[Tuple[City, float]]:
+        """Cities within `radius` km, closest first."""
+        return self._result(
+            self._search(
+                to_point(latitude, longitude),
+                len(self.cities),
+                km_to_chord(radius),
+            )
+        )
+
+    def snap(
+        self, latitude: float, longitude: float, max_distance: float
+    ) -> Optional[City]:
+        """Nearest city not farther than `max_distance` km."""
+        found = self._search(
+            to_point(latitude, longitude), 1, km_to_chord(max_distance)
+        )
+        return self.cities[found[0][1]] if found else None
+
+
+class MongoCitySpatialIndex:
+    """Same lookups on the 2dsphere index of the cities collection."""
+
+    def __init__(self, city_service: CityRepository) -> None:
+        self.city_service = city_service
+
+    def nearest(
+        self, latitude: float, longitude: float, k: int = 1
+    ) -> List[Tuple[City, float]]:
+        return self.city_service.geo_near(latitude, longitude, limit=k)
+
+    def within(
+        self, latitude: float, longitude: float, radius: float
+    ) -> List[Tuple[City, float]]:
+        return self.city_service.geo_near(
+            latitude, longitude, max_distance=radius
+        )
+
+    def snap(
+        self, latitude: float, longitude: float, max_distance: float
+    ) -> Optional[City]:
+        found = self.city_service.geo_near(
+            latitude, longitude, limit=1, max_distance=max_distance
+        )
+        return found[0][0] if found else None
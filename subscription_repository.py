@@ -0,0 +1,91 @@
+import datetime
+import logging
+from dataclasses import dataclass
+from typing import List, Optional
+
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+from city_repository import MongoDBRepository
+
+logger = logging.getLogger(__name__)
+
+# Claimed delivery slots are kept long enough to outlive a day
+SLOT_CLAIM_TTL = 2 * 24 * 3600
+
+
+@dataclass
+class Subscription:
+    chat_id: int
+    # Preferred time of the daily forecast, minutes after midnight
+    minute: Optional[int] = None
+    # Last location of the user
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+
+
+class SubscriptionRepository(MongoDBRepository):
+    """
+    Daily forecast subscriptions, one document per chat.
+    A subscription is delivered once it has both a time and a location.
+    """
+
+    model = Subscription
+    unique_fields = ("chat_id",)
+
+    def __init__(
+        self, slots_collection_name: str = "subscription_slots", **kwargs
+    ) -> None:
+        kwargs.setdefault("collection_name", "subscriptions")
+        self.slots_collection_name = slots_collection_name
+        super().__init__(**kwargs)
+
+    def _create_indexes(self) -> None:
+        super()._create_indexes()
+        self.db[self.collection_name].create_index(
+            [("minute", pymongo.ASCENDING)]
+        )
+        self.db[self.slots_collection_name].create_index(
+            [("expires_at", pymongo.ASCENDING)], expireAfterSeconds=0
+        )
+
+    def save(self, subscription: Subscription) -> None:
+        """Create or update a subscription; empty fields are kept."""
+        self.create_multi([subscription])
+
+    def update_location(
+        self, chat_id: int, latitude: float, longitude: float
+    ) -> None:
+        """Remember a new location of an existing subscription."""
+        self.update(
+            {"latitude": latitude, "longitude": longitude}, chat_id=chat_id
+        )
+
+    def delete(self, chat_id: int) -> bool:
+        result = self.db[self.collection_name].delete_one({"chat_id": chat_id})
+        return bool(result.deleted_count)
+
+    def find_due(self, start: int, end: int) -> List[Subscription]:
+        """Located subscriptions with a time in [start, end) minutes."""
+        return self.get_multi(
+            minute={"$gte": start, "$lt": end},
+            latitude={"$ne": None},
+            longitude={"$ne": None},
+        )
+
+    def claim_slot(self, key: str) -> bool:
+        """
+        Whether this process is the first to deliver slot `key`,
+        so that bot replicas do not send the same forecasts twice.
+        """
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=SLOT_CLAIM_TTL
+        )
+        try:
+            self.db[self.slots_collection_name].insert_one(
+                {"_id": key, "expires_at": expires_at}
+            )
+        except DuplicateKeyError:
+            logger.info(f"Subscription slot {key} is delivered by a replica")
+            return False
+        return True
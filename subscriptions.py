@@ -0,0 +1,159 @@
+"""
+Daily forecasts of /subscribe.
+
+Subscriptions due in a time slot are grouped by a cell of a coordinate
+grid, so a forecast is fetched once per cell, not once per subscriber.
+Messages are handed to a SendQueue, which keeps Telegram limits.
+"""
+import asyncio
+import logging
+import re
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+from zoneinfo import ZoneInfo
+
+import metrics
+from cache import quantize_coordinates
+from delivery import SendQueue
+from settings import (
+    SUBSCRIPTION_FETCH_CONCURRENCY,
+    SUBSCRIPTION_GRID,
+    SUBSCRIPTION_SLOT_MINUTES,
+    SUBSCRIPTION_TIMEZONE,
+)
+from subscription_repository import Subscription, SubscriptionRepository
+
+logger = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+TIME_PATTERN = re.compile(r"(\d{1,2})[:.](\d{2})")
+
+Position = Tuple[float, float]
+
+
+def parse_time(value: str) -> int:
+    """Minutes after midnight of "HH:MM"; raises ValueError."""
+    if (match := TIME_PATTERN.fullmatch(value.strip())) is None:
+        raise ValueError(f"Time {value!r} is not HH:MM")
+    hours, minutes = map(int, match.groups())
+    if hours > 23 or minutes > 59:
+        raise ValueError(f"Time {value!r} is out of range")
+    return hours * 60 + minutes
+
+
+def format_time(minute: int) -> str:
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def group_subscriptions(
+    subscriptions: List[Subscription], grid: float
+) -> Dict[Position, List[int]]:
+    """Chats by the grid cell of their location."""
+    groups: Dict[Position, List[int]] = defaultdict(list)
+    for subscription in subscriptions:
+        cell = quantize_coordinates(
+            subscription.latitude, subscription.longitude, grid
+        )
+        groups[cell].append(subscription.chat_id)
+    return groups
+
+
+class SubscriptionScheduler:
+    """Sends forecasts to subscribers at the start of every slot."""
+
+    def __init__(
+        self,
+        repository: SubscriptionRepository,
+        forecast: Callable[[float, float], Awaitable[Dict[str, Any]]],
+        render: Callable[[Dict[str, Any]], str],
+        queue: SendQueue,
+        slot_minutes: int = SUBSCRIPTION_SLOT_MINUTES,
+        grid: float = SUBSCRIPTION_GRID,
+        concurrency: int = SUBSCRIPTION_FETCH_CONCURRENCY,
+        timezone: str = SUBSCRIPTION_TIMEZONE,
+    ) -> None:
+        """
+        :param forecast: coroutine function of a forecast for a location
+        :param render: text of a forecast message
+        """
+        self.repository = repository
+        self.forecast = forecast
+        self.render = render
+        self.queue = queue
+        self.slot_minutes = slot_minutes
+        self.grid = grid
+        self.concurrency = concurrency
+        self.timezone = ZoneInfo(timezone)
+
+    async def _notify(
+        self,
+        semaphore: asyncio.Semaphore,
+        position: Position,
+        chat_ids: List[int],
+    ) -> None:
+        # A failed group must not stop others of the claimed slot
+        try:
+            async with semaphore:
+                weather = await self.forecast(*position)
+            text = self.render(weather)
+        except Exception as error:
+            metrics.SUBSCRIPTION_GROUPS.inc("failed")
+            logger.error(f"Forecast for {position} has failed: {error!r}")
+            return
+        metrics.SUBSCRIPTION_GROUPS.inc("fetched")
+        for chat_id in chat_ids:
+            self.queue.put(chat_id, text)
+
+    async def deliver(self, day: date, slot: int) -> int:
+        """
+        Queue forecasts of subscriptions due in a slot of a day;
+        returns the number of fetched groups.
+        """
+        if not await asyncio.to_thread(
+            self.repository.claim_slot, f"{day.isoformat()}:{slot}"
+        ):
+            return 0
+        start = slot * self.slot_minutes
+        subscriptions = await asyncio.to_thread(
+            self.repository.find_due, start, start + self.slot_minutes
+        )
+        groups = group_subscriptions(subscriptions, self.grid)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(
+            *(
+                self._notify(semaphore, position, chat_ids)
+                for position, chat_ids in groups.items()
+            )
+        )
+        logger.info(
+            f"Slot {format_time(start)}: {len(subscriptions)} subscriptions"
+            f" in {len(groups)} groups"
+        )
+        return len(groups)
+
+    def _get_slot(self, now: datetime) -> Tuple[int, float]:
+        """Slot of a moment and seconds until the next slot."""
+        minute = now.hour * 60 + now.minute
+        slot = minute // self.slot_minutes
+        next_minute = min((slot + 1) * self.slot_minutes, MINUTES_PER_DAY)
+        delay = (
+            (next_minute - minute) * 60 - now.second - now.microsecond / 1e6
+        )
+        return slot, delay
+
+    async def run(self) -> None:
+        """Deliver every slot, starting with the current one, forever."""
+        delivered = None
+        while True:
+            now = datetime.now(self.timezone)
+            slot, delay = self._get_slot(now)
+            # A slow delivery may have run into the next slot
+            if (now.date(), slot) != delivered:
+                delivered = now.date(), slot
+                try:
+                    await self.deliver(*delivered)
+                except Exception:
+                    logger.exception("Subscriptions delivery has failed")
+                continue
+            await asyncio.sleep(delay)
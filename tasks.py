@@ -1,128 +1,217 @@
 import abc
+import asyncio
+import io
 import logging
-import queue
+from array import array
 from datetime import datetime
-from multiprocessing import Pool, Process, Queue, current_process
-from multiprocessing.dummy import Pool as ThreadPool
-from typing import Any, Dict, List, Tuple, Union
-
-from api_client import YandexGeoAPI, YandexWeatherAPI
+from functools import partial
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+import calculation
+import exporting
+import metrics
+from api_client import (
+    AsyncYandexGeoAPI,
+    AsyncYandexWeatherAPI,
+    YandexGeoAPI,
+    YandexWeatherAPI,
+)
+from cache import GeocoderCache
+from city_repository import City, CityRepository
 from constants import (
+    ANALYZING_BATCH_SIZE,
     ERROR_GEO_API,
     ERROR_GEO_PARSING_API,
     ERROR_WEATHER_API,
     FORECAST_TARGET_HOURS,
     PLEASANT_CONDITIONS,
     PLEASANT_TEMPERATURE_RANGE,
+    RATING_LOGGED_CITIES,
 )
+from executors import Executor, InlineExecutor
+from models import CONDITION_CODES, CityForecast, HourlyBlock
+from settings import CALCULATION_MODE
 
 logger = logging.getLogger(__name__)
 
+PLEASANT_CONDITION_CODES = {
+    CONDITION_CODES[condition] for condition in PLEASANT_CONDITIONS
+}
+
 
 class Task(abc.ABC):
+    def __init_subclass__(cls, **kwargs) -> None:
+        """Замер длительности и размера результата для каждой задачи."""
+        super().__init_subclass__(**kwargs)
+        if not metrics.REGISTRY.enabled:
+            return
+        for name in ("worker", "worker_async"):
+            if name in cls.__dict__:
+                setattr(
+                    cls,
+                    name,
+                    metrics.instrument_task(cls.__dict__[name], cls.__name__),
+                )
+
     @abc.abstractmethod
     def worker(self) -> Any:
         pass
 
+    async def worker_async(self) -> Any:
+        """Выполнение задачи без блокировки цикла событий."""
+        return await asyncio.to_thread(self.worker)
+
 
 class DataFetchingTask(Task):
     """Получение данных через API."""
 
-    def __init__(self, api: YandexWeatherAPI, locations: List[str]):
+    def __init__(
+        self,
+        api: Union[YandexWeatherAPI, AsyncYandexWeatherAPI],
+        locations: List[str],
+        executor: Optional[Executor] = None,
+    ):
         self.api = api
         self.locations = locations
+        self.executor = executor or InlineExecutor()
 
-    def load_url(self, location: Union[str, Tuple[float, float]]):
+    def load_url(
+        self, location: Union[str, Tuple[float, float]]
+    ) -> Optional[HourlyBlock]:
         try:
             json_response = self.api.get_forecasting(location)
-            result = dict(location=location, **json_response)
+            result = HourlyBlock.from_response(location, json_response)
         except RuntimeError as error:
             logger.error(ERROR_WEATHER_API.format(city=location, error=error))
             result = None
         finally:
             return result
 
+    async def load_url_async(
+        self, location: Union[str, Tuple[float, float]]
+    ) -> Optional[HourlyBlock]:
+        try:
+            json_response = await self.api.get_forecasting(location)
+            return HourlyBlock.from_response(location, json_response)
+        except RuntimeError as error:
+            logger.error(ERROR_WEATHER_API.format(city=location, error=error))
+            return None
+
     def worker(self):
-        with ThreadPool() as pool:
-            data = [
-                forecast
-                for forecast in pool.map(self.load_url, self.locations)
-                if forecast is not None
-            ]
-            logger.debug(f"{self.__class__.__name__} output: {data}")
-            return data
+        data = [
+            forecast
+            for forecast in self.executor.map_io(
+                self.load_url, self.locations
+            )
+            if forecast is not None
+        ]
+        logger.debug(f"{self.__class__.__name__} output: {data}")
+        return data
+
+    async def worker_async(self):
+        data = [
+            forecast
+            for forecast in await asyncio.gather(
+                *map(self.load_url_async, self.locations)
+            )
+            if forecast is not None
+        ]
+        logger.debug(f"{self.__class__.__name__} output: {data}")
+        return data
 
 
 class DataCalculationTask(Task):
     """Вычисление погодных параметров."""
 
-    def __init__(self, forecasts: List[Any]):
+    def __init__(
+        self,
+        forecasts: List[HourlyBlock],
+        mode: str = CALCULATION_MODE,
+        executor: Optional[Executor] = None,
+    ):
+        """
+        :param mode: "vectorized" - расчёт по всем городам сразу через NumPy,
+            "pool" - расчёт по каждому городу в пуле процессов
+        """
         self.forecasts = forecasts
+        self.mode = mode
+        self.executor = executor or InlineExecutor()
 
     @staticmethod
-    def select_forecast_hours(all_hours: List[Dict[str, Any]]):
-        """Фильтрует прогнозные данные по времени."""
-
-        hours = [
-            hour
-            for hour in all_hours
-            if int(hour["hour"]) in FORECAST_TARGET_HOURS
+    def select_forecast_hours(
+        hours: array, temps: array, conditions: array
+    ) -> List[Tuple[float, int]]:
+        """
+        Фильтрует прогнозные данные по времени.
+        :return: температура и код погодных условий каждого часа
+        """
+        return [
+            (temp, condition)
+            for hour, temp, condition in zip(hours, temps, conditions)
+            if hour in FORECAST_TARGET_HOURS
         ]
-        return hours
 
     @staticmethod
-    def calculate_avg_temperature(hours: List[Dict[str, Any]]):
+    def calculate_avg_temperature(hours: List[Tuple[float, int]]):
         """Считает среднюю температуру за период."""
 
-        temperature = sum(hour["temp"] for hour in hours) / len(hours)
+        temperature = sum(temp for temp, _ in hours) / len(hours)
         return temperature
 
     @staticmethod
-    def calculate_comfort_hours(hours: List[Dict[str, Any]]):
+    def calculate_comfort_hours(hours: List[Tuple[float, int]]):
         """Считает комфортное время за период."""
 
         temp_min, temp_max = PLEASANT_TEMPERATURE_RANGE
         pleasant_hours = sum(
             1
-            for hour in hours
+            for temp, condition in hours
             if (
-                hour["condition"] in PLEASANT_CONDITIONS
-                and temp_min <= hour["temp"] <= temp_max
+                condition in PLEASANT_CONDITION_CODES
+                and temp_min <= temp <= temp_max
             )
         )
         return pleasant_hours
 
-    def calculate_city_data(self, data: Dict[str, Any]):
-        days = {}
+    @classmethod
+    def calculate_city_data(
+        cls, block: HourlyBlock
+    ) -> Optional[CityForecast]:
+        dates = []
+        temperature_avg, pleasant_hours = array("d"), array("i")
 
-        for forecast in data["forecasts"]:
-            hours = self.select_forecast_hours(forecast["hours"])
+        for date, *columns in block.days():
+            hours = cls.select_forecast_hours(*columns)
             if not hours:
                 continue
-            day = {
-                "temperature_avg": self.calculate_avg_temperature(hours),
-                "pleasant_hours": self.calculate_comfort_hours(hours),
-            }
-            days[forecast["date"]] = day
-
-        temperature_total_avg = sum(
-            days[day]["temperature_avg"] for day in days
-        ) / len(days)
-        hours_total_avg = sum(
-            days[day]["pleasant_hours"] for day in days
-        ) / len(days)
-        city = {
-            "city": data["geo_object"]["locality"]["name"],
-            "location": data["location"],
-            "forecast_days": days,
-            "temperature_total_avg": temperature_total_avg,
-            "hours_total_avg": hours_total_avg,
-        }
-        return city
+            dates.append(date)
+            temperature_avg.append(cls.calculate_avg_temperature(hours))
+            pleasant_hours.append(cls.calculate_comfort_hours(hours))
+
+        if not dates:
+            logger.warning(f"No forecast hours for {block.location}")
+            return None
+        return CityForecast(
+            city=block.city,
+            location=block.location,
+            dates=tuple(dates),
+            temperature_avg=temperature_avg,
+            pleasant_hours=pleasant_hours,
+            temperature_total_avg=sum(temperature_avg) / len(dates),
+            hours_total_avg=sum(pleasant_hours) / len(dates),
+        )
 
-    def worker(self):
-        with Pool() as pool:
-            city_forecasts = pool.map(self.calculate_city_data, self.forecasts)
+    def worker(self) -> List[CityForecast]:
+        if self.mode == "vectorized" and calculation.is_available():
+            city_forecasts = calculation.calculate_cities_data(self.forecasts)
+        else:
+            city_forecasts = [
+                city
+                for city in self.executor.map_cpu(
+                    self.calculate_city_data, self.forecasts
+                )
+                if city is not None
+            ]
         logger.debug(f"{self.__class__.__name__} output: {city_forecasts}")
         return city_forecasts
 
@@ -130,26 +219,27 @@ class DataCalculationTask(Task):
 class DataAggregationTask(Task):
     """Объединение вычисленных данных."""
 
-    def __init__(self, city_aggregations: List[Any]):
+    def __init__(self, city_aggregations: List[CityForecast]):
         self.city_aggregations = city_aggregations
 
-    def worker(self):
+    def worker(self) -> List[CityForecast]:
         for number, city in enumerate(
             sorted(
                 self.city_aggregations,
                 key=lambda city: (
-                    -city["hours_total_avg"],
-                    -city["temperature_total_avg"],
+                    -city.hours_total_avg,
+                    -city.temperature_total_avg,
                 ),
             ),
             1,
         ):
-            logger.info(
-                f"{number:3}) {city['city']:15}"
-                f"   hours_avg:{city['hours_total_avg']:5.2f}"
-                f"   temp_avg:{city['temperature_total_avg']:5.2f}"
-            )
-            city["rating"] = number
+            if number <= RATING_LOGGED_CITIES:
+                logger.info(
+                    f"{number:3}) {city.city:15}"
+                    f"   hours_avg:{city.hours_total_avg:5.2f}"
+                    f"   temp_avg:{city.temperature_total_avg:5.2f}"
+                )
+            city.rating = number
         logger.debug(
             f"{self.__class__.__name__} output: {self.city_aggregations}"
         )
@@ -159,64 +249,60 @@ class DataAggregationTask(Task):
 class DataAnalyzingTask(Task):
     """Финальный анализ и получение результата."""
 
-    def __init__(self, cities: List[Any]):
-        self.cities = cities
+    def __init__(
+        self,
+        cities: List[CityForecast],
+        executor: Optional[Executor] = None,
+    ):
+        # Города без рейтинга остаются в конце в исходном порядке
+        self.cities = sorted(
+            cities,
+            key=lambda city: (city.rating is None, city.rating or 0),
+        )
         self.all_days = self.get_sorted_days(cities)
+        self.executor = executor or InlineExecutor()
 
     @staticmethod
-    def get_sorted_days(cities: List[Any]):
-        days_gen = (city["forecast_days"] for city in cities)
-        unique_days = set(key for days in days_gen for key in days.keys())
+    def get_sorted_days(cities: List[CityForecast]):
+        unique_days = set(date for city in cities for date in city.dates)
         sorted_days = sorted(unique_days)
         logger.info(f"unique days: {sorted_days}")
         return sorted_days
 
     @staticmethod
-    def prepare_city_rows(city: Dict[str, Any], all_days: List[str]):
-        days = city["forecast_days"]
+    def prepare_city_rows(city: CityForecast, all_days: List[str]):
+        days = {date: number for number, date in enumerate(city.dates)}
 
         temperature_avg_days = [
-            days.get(day, {}).get("temperature_avg", "") for day in all_days
+            city.temperature_avg[days[day]] if day in days else ""
+            for day in all_days
         ]
         temperature_row = [
-            city["city"].lower().title(),
+            city.city.lower().title(),
             "Температура, среднее",
             *[
                 f"{temperature:.1f}" if temperature else ""
                 for temperature in temperature_avg_days
             ],
-            f"{city['temperature_total_avg']:.1f}",
-            city["rating"],
+            f"{city.temperature_total_avg:.1f}",
+            city.rating,
         ]
         hours_avg_days = [
-            days.get(day, {}).get("pleasant_hours", "") for day in all_days
+            city.pleasant_hours[days[day]] if day in days else ""
+            for day in all_days
         ]
         hours_row = [
             "",
             "Без осадков, часов",
             *[f"{hours:.1f}" if hours else "" for hours in hours_avg_days],
-            f"{city['hours_total_avg']:.1f}",
+            f"{city.hours_total_avg:.1f}",
             "",
         ]
         return temperature_row, hours_row
 
-    def prepare_city_rows_parallel(self, active: Queue, finished: Queue):
-        while True:
-            try:
-                city = active.get_nowait()
-            except queue.Empty:
-                logging.debug(f"Process {current_process().pid} has finished")
-                break
-            else:
-                finished.put(self.prepare_city_rows(city, self.all_days))
-
-    def worker(self):
-        import os
-
-        import tablib
-
-        dataset = tablib.Dataset()
-        dataset.headers = [
+    @property
+    def headers(self) -> List[str]:
+        return [
             "Город/день",
             "",
             *[
@@ -227,29 +313,79 @@ class DataAnalyzingTask(Task):
             "Рейтинг",
         ]
 
-        queue_in, queue_out = Queue(), Queue()
-        [queue_in.put(city) for city in self.cities]
-        processes = []
-        for _ in range(os.cpu_count()):
-            process = Process(
-                target=self.prepare_city_rows_parallel(queue_in, queue_out)
-            )
-            process.start()
-            processes.append(process)
-        [process.join() for process in processes]
-        while not queue_out.empty():
-            dataset.extend(queue_out.get())
+    @property
+    def rows_count(self) -> int:
+        """Число строк отчёта с заголовком: по две строки на город."""
+        return 1 + 2 * len(self.cities)
+
+    def iter_rows(self) -> Iterator[list]:
+        """
+        Строки отчёта в порядке рейтинга.
+        Города обрабатываются пачками по ANALYZING_BATCH_SIZE,
+        в памяти одновременно находятся строки только одной пачки.
+        """
+        prepare = partial(self.prepare_city_rows, all_days=self.all_days)
+        for start in range(0, len(self.cities), ANALYZING_BATCH_SIZE):
+            end = start + ANALYZING_BATCH_SIZE
+            for city_rows in self.executor.map_cpu(
+                prepare, self.cities[start:end]
+            ):
+                yield from city_rows
+
+    def write(self, stream: BinaryIO, export_format: str) -> None:
+        """Запись отчёта в поток по мере построения строк."""
+        exporting.write(stream, export_format, self.headers, self.iter_rows())
+
+    def export(self, export_format: str) -> bytes:
+        stream = io.BytesIO()
+        self.write(stream, export_format)
+        return stream.getvalue()
+
+    def worker(self):
+        import tablib
+
+        dataset = tablib.Dataset(headers=self.headers)
+        for row in self.iter_rows():
+            dataset.append(row)
         return dataset
 
 
 class GeoDataFetchingTask(Task):
     """Получение данных через API Геокодера."""
 
-    def __init__(self, api: YandexGeoAPI, addresses: List[str]):
+    def __init__(
+        self,
+        api: Union[YandexGeoAPI, AsyncYandexGeoAPI],
+        addresses: List[str],
+        cache: Optional[GeocoderCache] = None,
+        executor: Optional[Executor] = None,
+    ):
         self.api = api
         self.addresses = addresses
+        self.cache = cache
+        self.executor = executor or InlineExecutor()
+
+    def load_cached(self, address: str) -> Tuple[bool, Optional[dict]]:
+        """Ищет координаты адреса в кэше, не обращаясь к API."""
+        if self.cache is None:
+            return False, None
+        found, coordinates = self.cache.lookup(address)
+        if not found or coordinates is None:
+            return found, None
+        return True, dict(address=address, coordinates=coordinates)
+
+    async def load_cached_async(
+        self, address: str
+    ) -> Tuple[bool, Optional[dict]]:
+        """load_cached в отдельном потоке: кэш может быть в MongoDB."""
+        if self.cache is None:
+            return False, None
+        return await asyncio.to_thread(self.load_cached, address)
 
     def load_url(self, address: str):
+        found, result = self.load_cached(address)
+        if found:
+            return result
         try:
             json_response = self.api.get_geolocation(address)
             result = dict(address=address, **json_response)
@@ -259,25 +395,57 @@ class GeoDataFetchingTask(Task):
         finally:
             return result
 
+    async def load_url_async(self, address: str):
+        found, result = await self.load_cached_async(address)
+        if found:
+            return result
+        try:
+            json_response = await self.api.get_geolocation(address)
+            return dict(address=address, **json_response)
+        except RuntimeError as error:
+            logger.error(ERROR_GEO_API.format(address=address, error=error))
+            return None
+
     def worker(self) -> List[Any]:
-        with ThreadPool() as pool:
-            data = [
-                location
-                for location in pool.map(self.load_url, self.addresses)
-                if location is not None
-            ]
-            logger.debug(f"{self.__class__.__name__} output: {data}")
-            return data
+        data = [
+            location
+            for location in self.executor.map_io(
+                self.load_url, self.addresses
+            )
+            if location is not None
+        ]
+        logger.debug(f"{self.__class__.__name__} output: {data}")
+        return data
+
+    async def worker_async(self) -> List[Any]:
+        data = [
+            location
+            for location in await asyncio.gather(
+                *map(self.load_url_async, self.addresses)
+            )
+            if location is not None
+        ]
+        logger.debug(f"{self.__class__.__name__} output: {data}")
+        return data
 
 
 class GeoDataParsingTask(Task):
     """Определение координат геообъекта."""
 
-    def __init__(self, locations: list[Any]):
+    def __init__(
+        self,
+        locations: list[Any],
+        cache: Optional[GeocoderCache] = None,
+        executor: Optional[Executor] = None,
+    ):
         self.locations = locations
+        self.cache = cache
+        self.executor = executor or InlineExecutor()
 
     @staticmethod
     def get_coordinates(location) -> tuple[float, float]:
+        if "coordinates" in location:
+            return tuple(location["coordinates"])
         try:
             collection = location["response"]["GeoObjectCollection"]
             count = collection["metaDataProperty"]["GeocoderResponseMetaData"][
@@ -295,17 +463,134 @@ class GeoDataParsingTask(Task):
                 "Point"
             ]["pos"].split()[:2]
             return float(latitude), float(longitude)
-        except (TypeError, KeyError, RuntimeError) as error:
+        except (TypeError, KeyError, IndexError, RuntimeError) as error:
             raise RuntimeError(
                 ERROR_GEO_PARSING_API.format(error=error, address=location)
             )
 
+    @classmethod
+    def parse_coordinates(cls, location) -> Optional[tuple[float, float]]:
+        try:
+            return cls.get_coordinates(location)
+        except RuntimeError as error:
+            logger.error(error)
+            return None
+
+    def resolve(self) -> Dict[str, Optional[Tuple[float, float]]]:
+        """Координаты по каждому адресу (None, если адрес не найден)."""
+        fetched = [
+            location
+            for location in self.locations
+            if "coordinates" not in location
+        ]
+        parsed = self.executor.map_cpu(self.parse_coordinates, fetched)
+        resolved = {
+            location["address"]: coords
+            for location, coords in zip(fetched, parsed)
+        }
+        if self.cache is not None and resolved:
+            self.cache.set_many(resolved)
+        return {
+            location["address"]: (
+                tuple(location["coordinates"])
+                if "coordinates" in location
+                else resolved[location["address"]]
+            )
+            for location in self.locations
+        }
+
     def worker(self) -> List[Any]:
-        with Pool() as pool:
-            data = [
-                coords
-                for coords in pool.map(self.get_coordinates, self.locations)
-                if coords is not None
-            ]
-            logger.debug(f"{self.__class__.__name__} output: {data}")
-            return data
+        data = [
+            coords for coords in self.resolve().values() if coords is not None
+        ]
+        logger.debug(f"{self.__class__.__name__} output: {data}")
+        return data
+
+
+class CityLocatingTask(Task):
+    """Координаты городов: из каталога или через API Геокодера."""
+
+    def __init__(
+        self,
+        cities: List[City],
+        api: Union[YandexGeoAPI, AsyncYandexGeoAPI],
+        city_service: CityRepository,
+        cache: Optional[GeocoderCache] = None,
+        executor: Optional[Executor] = None,
+    ):
+        self.cities = cities
+        self.api = api
+        self.city_service = city_service
+        self.cache = cache
+        self.executor = executor
+        self.resolved: Dict[str, Optional[Tuple[float, float]]] = {}
+        self.parsed: Dict[str, Optional[Tuple[float, float]]] = {}
+
+    @property
+    def unlocated(self) -> List[str]:
+        return [
+            city.name
+            for city in self.cities
+            if city.latitude is None or city.longitude is None
+        ]
+
+    def save_coordinates(
+        self, resolved: Dict[str, Optional[Tuple[float, float]]]
+    ) -> None:
+        """Сохраняет найденные координаты в каталог городов."""
+        for city in self.cities:
+            if (coords := resolved.get(city.name)) is not None:
+                city.latitude, city.longitude = coords
+                self.city_service.update_coordinates(city.name, *coords)
+
+    async def locate_async(self, city: City) -> Optional[Tuple[float, float]]:
+        """Координаты одного города для потоковой обработки."""
+        if city.latitude is not None and city.longitude is not None:
+            return city.latitude, city.longitude
+        location = await GeoDataFetchingTask(
+            self.api, [city.name], self.cache
+        ).load_url_async(city.name)
+        if location is None:
+            return None
+        coords = GeoDataParsingTask.parse_coordinates(location)
+        if "coordinates" not in location:
+            self.parsed[city.name] = coords
+        self.resolved[city.name] = coords
+        return coords
+
+    def save_resolved(self) -> None:
+        """Сохраняет результаты locate_async в кэш и каталог городов."""
+        if self.cache is not None and self.parsed:
+            self.cache.set_many(self.parsed)
+        self.save_coordinates(self.resolved)
+
+    def get_locations(self) -> List[Tuple[float, float]]:
+        data = [
+            (city.latitude, city.longitude)
+            for city in self.cities
+            if city.latitude is not None and city.longitude is not None
+        ]
+        logger.debug(f"{self.__class__.__name__} output: {data}")
+        return data
+
+    def worker(self) -> List[Tuple[float, float]]:
+        if addresses := self.unlocated:
+            locations = GeoDataFetchingTask(
+                self.api, addresses, self.cache, self.executor
+            ).worker()
+            self.save_coordinates(
+                GeoDataParsingTask(
+                    locations, self.cache, self.executor
+                ).resolve()
+            )
+        return self.get_locations()
+
+    async def worker_async(self) -> List[Tuple[float, float]]:
+        if addresses := self.unlocated:
+            locations = await GeoDataFetchingTask(
+                self.api, addresses, self.cache
+            ).worker_async()
+            parsing = GeoDataParsingTask(locations, self.cache, self.executor)
+            resolved = await asyncio.to_thread(parsing.resolve)
+            await asyncio.to_thread(self.save_coordinates, resolved)
+        return self.get_locations()
@@ -0,0 +1,116 @@
+import logging
+import math
+import os
+
+import pytest
+
+from catalog import (
+    REPORTED_ROWS_LIMIT,
+    CitySnapshot,
+    load_catalog,
+    read_cities_csv,
+    write_snapshot,
+)
+from city_repository import City
+
+CITIES = [
+    City(name="Москва", url_source="a", latitude=55.75, longitude=37.62),
+    City(name="São Paulo", url_source="", latitude=-23.55, longitude=-46.63),
+    City(name="東京", url_source="c"),
+    City(name="Reykjavík", url_source="d", latitude=64.15, longitude=None),
+]
+
+
+def write_csv(path, rows) -> os.stat_result:
+    path.write_text("city,coords,source\n" + "".join(rows), encoding="utf-8")
+    return os.stat(path)
+
+
+@pytest.fixture
+def source(tmp_path):
+    return write_csv(
+        tmp_path / "cities.csv",
+        [
+            'Москва,"[55.75,37.62]",a\n',
+            "Tokyo,,b\n",
+        ],
+    )
+
+
+def test_snapshot_round_trip(tmp_path, source):
+    path = str(tmp_path / "cities.snapshot")
+
+    assert write_snapshot(path, CITIES, source) == len(CITIES)
+    snapshot = CitySnapshot(path)
+    try:
+        assert len(snapshot) == len(CITIES)
+        assert list(snapshot) == CITIES
+        assert [snapshot[i] for i in range(len(CITIES))] == CITIES
+        assert snapshot[-1] == CITIES[-1]
+        assert snapshot[1:3] == CITIES[1:3]
+        assert math.isnan(snapshot.longitudes[3])
+        with pytest.raises(IndexError):
+            snapshot[len(CITIES)]
+    finally:
+        snapshot.close()
+
+
+def test_damaged_snapshot_is_rejected(tmp_path, source):
+    path = tmp_path / "cities.snapshot"
+    write_snapshot(str(path), CITIES, source)
+    content = path.read_bytes()
+
+    for damaged in (content[:-1], content + b"\0", b"JUNK" + content[4:]):
+        path.write_bytes(damaged)
+        with pytest.raises(ValueError):
+            CitySnapshot(str(path))
+        assert CitySnapshot.open_fresh(str(path), source) is None
+
+
+def test_stale_snapshot_is_rejected(tmp_path, source):
+    path = str(tmp_path / "cities.snapshot")
+    write_snapshot(path, CITIES, source)
+    changed = write_csv(tmp_path / "cities.csv", ["Tokyo,,b\n"])
+
+    assert CitySnapshot.open_fresh(path, changed) is None
+    snapshot = CitySnapshot.open_fresh(path, source)
+    assert snapshot is not None
+    snapshot.close()
+
+
+def test_load_catalog_rewrites_stale_snapshot(tmp_path, source):
+    csv_path = tmp_path / "cities.csv"
+    snapshot_path = str(tmp_path / "cities.snapshot")
+
+    first = load_catalog(str(csv_path), snapshot_path)
+    assert first.written
+    assert [city.name for city in first] == ["Москва", "Tokyo"]
+    first.close()
+
+    again = load_catalog(str(csv_path), snapshot_path)
+    assert not again.written
+    again.close()
+
+    write_csv(
+        csv_path, ["Tokyo,,b\n", 'Paris,"[48.85,2.35]",c\n', "Oslo,,d\n"]
+    )
+    changed = load_catalog(str(csv_path), snapshot_path)
+    assert changed.written
+    assert [city.name for city in changed] == ["Tokyo", "Paris", "Oslo"]
+    changed.close()
+
+
+def test_bad_rows_are_counted(tmp_path, caplog):
+    bad_rows = REPORTED_ROWS_LIMIT + 5
+    rows = ["Tokyo,,b\n"]
+    rows += [",,empty name\n"] * (bad_rows - 2)
+    rows += ['Kyiv,"[50.45]",x\n', "Lima,extra,field,x\n"]
+    write_csv(tmp_path / "cities.csv", rows)
+
+    with caplog.at_level(logging.WARNING, logger="catalog"):
+        cities = list(read_cities_csv(str(tmp_path / "cities.csv")))
+
+    assert [city.name for city in cities] == ["Tokyo"]
+    messages = [record.getMessage() for record in caplog.records]
+    assert len(messages) == REPORTED_ROWS_LIMIT + 1
+    assert messages[-1].endswith(f"{bad_rows} bad rows are skipped")
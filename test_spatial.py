@@ -0,0 +1,111 @@
+import math
+import random
+
+import pytest
+
+from city_repository import City
+from spatial import EARTH_RADIUS_KM, CitySpatialIndex
+
+
+def haversine(city: City, latitude: float, longitude: float) -> float:
+    phi1, phi2 = math.radians(city.latitude), math.radians(latitude)
+    delta_phi = phi2 - phi1
+    delta_lam = math.radians(longitude - city.longitude)
+    a = (
+        math.sin(delta_phi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lam / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def brute_force(cities, latitude: float, longitude: float):
+    return sorted(
+        (haversine(city, latitude, longitude), city.name) for city in cities
+    )
+
+
+@pytest.fixture(scope="module")
+def cities():
+    rnd = random.Random(42)
+    cities = [
+        City(
+            name=f"city {number}",
+            latitude=rnd.uniform(-90, 90),
+            longitude=rnd.uniform(-180, 180),
+        )
+        for number in range(500)
+    ]
+    # Poles, the antimeridian and a city without coordinates
+    cities += [
+        City(name="north", latitude=89.9, longitude=0.0),
+        City(name="south", latitude=-89.9, longitude=120.0),
+        City(name="east", latitude=10.0, longitude=179.9),
+        City(name="west", latitude=10.0, longitude=-179.9),
+        City(name="unknown"),
+    ]
+    return cities
+
+
+@pytest.fixture(scope="module")
+def index(cities):
+    return CitySpatialIndex(cities)
+
+
+def positions():
+    rnd = random.Random(7)
+    yield from [(90.0, 0.0), (-90.0, 0.0), (10.0, 180.0), (10.0, -180.0)]
+    for _ in range(100):
+        yield rnd.uniform(-90, 90), rnd.uniform(-180, 180)
+
+
+def names(found):
+    return [city.name for city, _ in found]
+
+
+def test_cities_without_coordinates_are_skipped(index, cities):
+    assert len(index) == len(cities) - 1
+
+
+@pytest.mark.parametrize("k", [1, 5])
+def test_nearest(index, k):
+    for latitude, longitude in positions():
+        expected = brute_force(index.cities, latitude, longitude)[:k]
+        found = index.nearest(latitude, longitude, k)
+        assert names(found) == [name for _, name in expected]
+        for (_, distance), (expected_distance, _) in zip(found, expected):
+            assert distance == pytest.approx(expected_distance, abs=1e-6)
+
+
+@pytest.mark.parametrize("radius", [0.0, 500.0, 3000.0])
+def test_within(index, radius):
+    for latitude, longitude in positions():
+        expected = [
+            name
+            for distance, name in brute_force(
+                index.cities, latitude, longitude
+            )
+            if distance <= radius
+        ]
+        assert names(index.within(latitude, longitude, radius)) == expected
+
+
+@pytest.mark.parametrize("max_distance", [100.0, 1000.0])
+def test_snap(index, max_distance):
+    for latitude, longitude in positions():
+        distance, name = brute_force(index.cities, latitude, longitude)[0]
+        city = index.snap(latitude, longitude, max_distance)
+        if distance <= max_distance:
+            assert city.name == name
+        else:
+            assert city is None
+
+
+def test_antimeridian_neighbours(index):
+    assert names(index.nearest(10.0, 179.95, 2)) == ["east", "west"]
+
+
+def test_empty_index():
+    index = CitySpatialIndex([])
+    assert index.nearest(0.0, 0.0) == []
+    assert index.within(0.0, 0.0, 1000.0) == []
+    assert index.snap(0.0, 0.0, 1000.0) is None
@@ -0,0 +1,148 @@
+import asyncio
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    """
+    Allows `rate` operations per second on average
+    and bursts of up to `capacity` operations.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token; returns how long to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated_at) * self.rate,
+            )
+            self._updated_at = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self) -> None:
+        if delay := self.reserve():
+            time.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        if delay := self.reserve():
+            await asyncio.sleep(delay)
+
+
+class Throttle:
+    """
+    Rate limit and limit of requests in flight for one API.
+    Sync and async requests take slots from one counter, so together
+    they never exceed `concurrency` in a process.
+    """
+
+    def __init__(self, rate: float, burst: float, concurrency: int) -> None:
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+        # Coroutines waiting for a slot, woken on every release
+        self._waiters: Dict[asyncio.Future, asyncio.AbstractEventLoop] = {}
+        self._lock = threading.Lock()
+
+    def _release(self) -> None:
+        self._semaphore.release()
+        with self._lock:
+            waiters, self._waiters = self._waiters, {}
+        for future, loop in waiters.items():
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                # Loop is closed
+                pass
+
+    async def _acquire_async(self) -> None:
+        if self._semaphore.acquire(blocking=False):
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            future = loop.create_future()
+            with self._lock:
+                self._waiters[future] = loop
+            # Registered first, so a release after this check wakes us
+            if self._semaphore.acquire(blocking=False):
+                with self._lock:
+                    self._waiters.pop(future, None)
+                return
+            try:
+                await future
+            finally:
+                with self._lock:
+                    self._waiters.pop(future, None)
+
+    @contextmanager
+    def slot(self):
+        self._semaphore.acquire()
+        try:
+            self.bucket.acquire()
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def slot_async(self):
+        await self._acquire_async()
+        try:
+            await self.bucket.acquire_async()
+            yield
+        finally:
+            self._release()
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Exponential backoff with full jitter."""
+
+    attempts: int = 4
+    backoff: float = 0.5
+    backoff_max: float = 30.0
+
+    @staticmethod
+    def is_retryable(status: int) -> bool:
+        return status == 429 or 500 <= status < 600
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """Retry-After header: delay in seconds or HTTP date."""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value).timestamp()
+            return max(0.0, retry_at - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def get_delay(
+        self, attempt: int, retry_after: Optional[str] = None
+    ) -> float:
+        if (delay := self.parse_retry_after(retry_after)) is not None:
+            return min(delay, self.backoff_max)
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff * 2**attempt)
+        )
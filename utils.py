@@ -1,39 +1,22 @@
-import csv
 import functools
+from collections.abc import Sequence
+
 import settings
 
 
+def parse_coords(coords: str | None) -> dict[str, float | None]:
+    """Parse `[latitude,longitude]` string of the cities file."""
+    if not coords:
+        return {"latitude": None, "longitude": None}
+    latitude, longitude = (float(f) for f in coords.strip("[]").split(","))
+    return {"latitude": latitude, "longitude": longitude}
+
+
 @functools.lru_cache(1)
-def get_cities_from_csv() -> list["City"]:
-    from city_repository import City
+def get_cities_from_csv() -> Sequence["City"]:
+    from catalog import load_catalog
 
-    cities: list[City] = []
-    try:
-        with open(f"{settings.DATA_ROOT}/{settings.DATA_FILE}") as csvfile:
-            cities = [
-                _
-                for _ in csv.DictReader(
-                    csvfile, delimiter=",", escapechar="\\"
-                )
-            ]
-        cities = [
-            City(
-                name=row["city"],
-                url_source=row.get("source", ""),
-                **[
-                    {"longitude": lon, "latitude": lat}
-                    for lon, lat in [
-                        [
-                            float(f)
-                            for f in row.get("coords", "[0,0]")
-                            .strip("[]")
-                            .split(",")
-                        ]
-                    ]
-                ][0],
-            )
-            for row in cities
-        ]
-    except (KeyError, ValueError):
-        cities = []
-    return cities
+    return load_catalog(
+        f"{settings.DATA_ROOT}/{settings.DATA_FILE}",
+        settings.CITIES_SNAPSHOT_FILE,
+    )
@@ -0,0 +1,310 @@
+"""
+Webhook mode: Telegram posts updates over HTTP to several bot processes
+listening on one port.
+
+Every worker binds its own socket with SO_REUSEPORT, so the kernel
+spreads connections between workers. Where the option is missing,
+workers share one socket bound before they are started.
+"""
+import asyncio
+import hmac
+import logging
+import multiprocessing
+import signal
+import socket
+import time
+from contextlib import suppress
+from multiprocessing.connection import wait
+from typing import Callable, Dict, Optional, Tuple
+
+from telegram import Bot, Update
+from telegram.ext import Application
+
+from decoding import loads
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+MAX_HEADER_SIZE = 16 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+# A worker exiting sooner is not restarted: it would fail again
+MIN_WORKER_UPTIME = 5
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+}
+
+ApplicationFactory = Callable[[int], Application]
+
+
+class WebhookServer:
+    """
+    Minimal HTTP/1.1 server for Telegram updates.
+    An update is answered as soon as it is put to the update queue,
+    handlers of the application process it afterwards.
+    """
+
+    def __init__(
+        self, application: Application, path: str, secret: str = ""
+    ) -> None:
+        self.application = application
+        self.path = path
+        self.secret = secret.encode()
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Serve requests of a connection until it is closed."""
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ConnectionError,
+        ):
+            pass
+        finally:
+            writer.close()
+            with suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def _handle_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> bool:
+        """Answer one request; returns whether the connection is kept."""
+        head = await reader.readuntil(b"\r\n\r\n")
+        try:
+            method, target, version, headers = self._parse_head(head)
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            return await self._respond(writer, 400, keep_alive=False)
+        if "transfer-encoding" in headers:
+            # Telegram sends Content-Length; chunked bodies are not read
+            return await self._respond(writer, 400, keep_alive=False)
+        if not 0 <= length <= MAX_BODY_SIZE:
+            return await self._respond(writer, 413, keep_alive=False)
+        body = await reader.readexactly(length)
+        keep_alive = (
+            version == "HTTP/1.1"
+            and headers.get("connection", "").lower() != "close"
+        )
+        status = await self._process(method, target, headers, body)
+        return await self._respond(writer, status, keep_alive)
+
+    @staticmethod
+    def _parse_head(head: bytes) -> Tuple[str, str, str, Dict[str, str]]:
+        request_line, *lines = head.decode("latin-1").split("\r\n")
+        method, target, version = request_line.split(" ")
+        headers = {}
+        for line in lines:
+            if line:
+                name, separator, value = line.partition(":")
+                if not separator:
+                    raise ValueError(f"Bad header line {line!r}")
+                headers[name.strip().lower()] = value.strip()
+        return method, target, version, headers
+
+    async def _process(
+        self, method: str, target: str, headers: Dict[str, str], body: bytes
+    ) -> int:
+        if target != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if self.secret and not hmac.compare_digest(
+            headers.get(SECRET_HEADER, "").encode("latin-1"), self.secret
+        ):
+            return 403
+        try:
+            data = loads(body)
+            if not isinstance(data, dict):
+                raise ValueError("Update is not an object")
+            update = Update.de_json(data, self.application.bot)
+        except (KeyError, TypeError, ValueError) as error:
+            logger.warning(f"Bad update is received: {error}")
+            return 400
+        await self.application.update_queue.put(update)
+        return 200
+
+    @staticmethod
+    async def _respond(
+        writer: asyncio.StreamWriter, status: int, keep_alive: bool
+    ) -> bool:
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            "Content-Length: 0\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            "\r\n".encode("latin-1")
+        )
+        await writer.drain()
+        return keep_alive
+
+
+async def set_webhook(
+    bot: Bot, url: str, secret: str, max_connections: int
+) -> None:
+    """Ask Telegram to post updates to `url`."""
+    async with bot:
+        await bot.set_webhook(
+            url=url,
+            secret_token=secret or None,
+            max_connections=max_connections,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    logger.info(f"Webhook is set to {url}")
+
+
+def listen(host: str, port: int, reuse_port: bool) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    return sock
+
+
+async def serve(
+    application: Application, sock: socket.socket, path: str, secret: str
+) -> None:
+    """Run the application with updates of the webhook until a signal."""
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    # Same steps as Application.run_webhook, with our server
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    server = await asyncio.start_server(
+        WebhookServer(application, path, secret).handle,
+        sock=sock,
+        limit=MAX_HEADER_SIZE,
+    )
+    logger.info(f"Webhook is served on {sock.getsockname()}{path}")
+    try:
+        await stopping.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def _run_worker(
+    build: ApplicationFactory,
+    number: int,
+    address: Tuple[str, int],
+    path: str,
+    secret: str,
+    sock: Optional[socket.socket],
+) -> None:
+    # Handlers of the supervisor are inherited with fork
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    if sock is None:
+        sock = listen(*address, reuse_port=True)
+    asyncio.run(serve(build(number), sock, path, secret))
+
+
+class Supervisor:
+    """Forked worker processes, started again when they stop."""
+
+    def __init__(
+        self,
+        build: ApplicationFactory,
+        address: Tuple[str, int],
+        path: str,
+        secret: str,
+    ) -> None:
+        self.args = (build, address, path, secret)
+        self.context = multiprocessing.get_context("fork")
+        # Without SO_REUSEPORT workers accept on the socket of the parent
+        self.socket = (
+            None
+            if hasattr(socket, "SO_REUSEPORT")
+            else listen(*address, reuse_port=False)
+        )
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self.started_at: Dict[int, float] = {}
+        self.stopping = False
+
+    def start(self, number: int) -> None:
+        build, address, path, secret = self.args
+        process = self.context.Process(
+            target=_run_worker,
+            args=(build, number, address, path, secret, self.socket),
+            name=f"webhook-worker-{number}",
+        )
+        process.start()
+        self.processes[number] = process
+        self.started_at[number] = time.monotonic()
+
+    def stop(self, signum: int = signal.SIGTERM, frame=None) -> None:
+        self.stopping = True
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+
+    def _restart(self, number: int, process: multiprocessing.Process) -> None:
+        uptime = time.monotonic() - self.started_at[number]
+        logger.error(
+            f"Webhook worker {number} exited with code "
+            f"{process.exitcode} after {uptime:.1f} s"
+        )
+        if uptime < MIN_WORKER_UPTIME:
+            self.stop()
+        else:
+            self.start(number)
+
+    def run(self, workers: int) -> None:
+        for number in range(workers):
+            self.start(number)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info(f"{workers} webhook workers are started")
+        while self.processes:
+            ready = wait(
+                [process.sentinel for process in self.processes.values()]
+            )
+            for number, process in list(self.processes.items()):
+                if process.sentinel in ready:
+                    process.join()
+                    del self.processes[number]
+                    if not self.stopping:
+                        self._restart(number, process)
+
+
+def run(
+    build: ApplicationFactory,
+    host: str,
+    port: int,
+    path: str,
+    secret: str,
+    workers: int = 1,
+) -> None:
+    """
+    Serve the webhook with `workers` processes, each running
+    an application of `build(worker_number)`.
+    """
+    if workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        logger.warning("Processes cannot be forked, one worker is started")
+        workers = 1
+    if workers == 1:
+        asyncio.run(
+            serve(build(0), listen(host, port, False), path, secret)
+        )
+        return
+    Supervisor(build, (host, port), path, secret).run(workers)